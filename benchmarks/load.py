@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+import os
+import time
+import socket
+import threading
+
+
+class LoadGenerator(object):
+    """
+    Blocking clients (one thread per connection) against a proxy.
+    Each test returns a dictionary of results
+    """
+    def __init__(self,port,ssl_context=None,address="127.0.0.1"):
+        """
+        Input Parameters:
+            port        : the proxy's port
+            ssl_context : ssl.SSLContext if the proxy listens with SSL (None: clear-text)
+        """
+        self.address=(address,port)
+        self.ssl_context=ssl_context
+
+    def connect(self):
+        sock=socket.create_connection(self.address)
+        sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        if self.ssl_context is not None:
+            sock=self.ssl_context.wrap_socket(sock)
+        return sock
+
+    def _run_threads(self,count,target):
+        errors=[]
+        def run(index):
+            try:
+                target(index)
+            except Exception as e:
+                errors.append(repr(e))
+        threads=[ threading.Thread(target=run,args=(index,)) for index in range(count) ]
+        start=time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed=time.time()-start
+        if errors:
+            raise RuntimeError("%d clients failed: %s" % (len(errors),errors[0]))
+        return elapsed
+
+    def throughput(self,connections=4,size=32*1024*1024,chunk_size=256*1024):
+        """
+        Each connection uploads "size" bytes (to the sink) and waits until the proxy closes the connection
+        (which happens once the proxy flushed everything to the server).
+        Returns MB/s (all connections)
+        """
+        chunk=os.urandom(chunk_size)
+        def client(index):
+            sock=self.connect()
+            sent=0
+            while sent<size:
+                data=chunk[:size-sent]
+                sock.sendall(data)
+                sent+=len(data)
+            sock.shutdown(socket.SHUT_WR)
+            while sock.recv(65536):
+                pass
+            sock.close()
+        elapsed=self._run_threads(connections,client)
+        return { "throughput_mb_s": connections*size/elapsed/(1024*1024) }
+
+    def latency(self,connections=8,requests=1000,size=64):
+        """
+        Each connection sends "requests" requests (of "size" bytes) to the echo server , one at a time.
+        Returns the p50/p99 round-trip (milliseconds) and the requests/sec (all connections)
+        """
+        samples=[]
+        payload=b"x"*size
+        def client(index):
+            sock=self.connect()
+            times=[]
+            for i in range(requests):
+                start=time.perf_counter()
+                sock.sendall(payload)
+                got=0
+                while got<size:
+                    data=sock.recv(size-got)
+                    if not data:
+                        raise IOError("connection closed")
+                    got+=len(data)
+                times.append(time.perf_counter()-start)
+            sock.close()
+            samples.extend(times)
+        elapsed=self._run_threads(connections,client)
+        samples.sort()
+        return {
+            "latency_p50_ms": percentile(samples,50)*1000,
+            "latency_p99_ms": percentile(samples,99)*1000,
+            "requests_per_sec": len(samples)/elapsed,
+        }
+
+    def connection_rate(self,connections=1000,concurrency=8):
+        """
+        Open a connection , do one (1 byte) round-trip with the echo server , and close. "concurrency" clients
+        open "connections" connections in total.
+        Returns connections/sec
+        """
+        per_client=connections//concurrency
+        def client(index):
+            for i in range(per_client):
+                sock=self.connect()
+                sock.sendall(b"x")
+                if not sock.recv(1):
+                    raise IOError("connection closed")
+                sock.close()
+        elapsed=self._run_threads(concurrency,client)
+        return { "connections_per_sec": per_client*concurrency/elapsed }
+
+    def idle_connections(self,connections,get_rss,settle=0.5):
+        """
+        Open "connections" connections (each one does one round-trip with the echo server , so the session is
+        established) , and keep them open. Returns the proxy's RSS growth per connection (bytes).
+        get_rss() returns the proxy's current RSS
+        """
+        before=get_rss()
+        socks=[]
+        try:
+            for i in range(connections):
+                sock=self.connect()
+                sock.sendall(b"x")
+                sock.recv(1)
+                socks.append(sock)
+            time.sleep(settle)
+            after=get_rss()
+        finally:
+            for sock in socks:
+                sock.close()
+        if before is None or after is None:
+            return { "rss_per_idle_connection": None }
+        return { "rss_per_idle_connection": float(after-before)/connections }
+
+
+def percentile(sorted_samples,p):
+    if not sorted_samples:
+        return 0.0
+    index=min(len(sorted_samples)-1,int(round(p/100.0*(len(sorted_samples)-1))))
+    return sorted_samples[index]
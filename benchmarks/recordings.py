@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import socket
+import struct
+
+# Run from the source tree (python -m benchmarks.replay) without installing maproxy
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import maproxy.capture
+import maproxy.httpsession
+
+
+class RecordedSession(object):
+    """
+    The byte streams of one recorded session: a list of (offset , c2s , data) events , where offset is the time
+    (seconds) since the session started and c2s is True for the client's data
+    """
+    __slots__=("start","events")
+
+    def __init__(self,start):
+        self.start=start
+        self.events=[]
+
+    def add(self,timestamp,c2s,data):
+        self.events.append((max(0.0,timestamp-self.start),c2s,bytes(data)))
+
+    def get_bytes(self,c2s):
+        return sum( len(data) for offset,is_c2s,data in self.events if is_c2s==c2s )
+
+    def get_stream(self,c2s):
+        return b"".join( data for offset,is_c2s,data in self.events if is_c2s==c2s )
+
+
+def load_sessions(paths,server_port=None):
+    """
+    Load the recorded sessions from files: maproxy capture records (see maproxy.capture) , pcap or pcap-ng (the TCP
+    connections). server_port: the server's port in pcap files (default: the side that received the SYN , or the
+    first packet). Returns the sessions (list of RecordedSession) , oldest first
+    """
+    sessions=[]
+    records={}
+    for path in paths:
+        with open(path,"rb") as f:
+            magic=f.read(len(maproxy.capture.RECORDS_MAGIC))
+        if magic==maproxy.capture.RECORDS_MAGIC:
+            # (the sessions may continue in the next file of the rotation)
+            _read_capture_records(path,records)
+        else:
+            sessions.extend(_read_tcp_sessions(path,server_port))
+    sessions.extend(records.values())
+    sessions=[ session for session in sessions if session.events ]
+    sessions.sort(key=lambda session: session.start)
+    return sessions
+
+
+def _read_capture_records(path,sessions):
+    for kind,session_id,timestamp,data,original_size in maproxy.capture.read_records(path):
+        session=sessions.get(session_id)
+        if session is None:
+            session=sessions[session_id]=RecordedSession(timestamp)
+        if kind==maproxy.capture.C2S or kind==maproxy.capture.S2C:
+            if len(data)<original_size:
+                # (a truncated chunk: the sizes matter more than the content)
+                data=data+b"\x00"*(original_size-len(data))
+            session.add(timestamp,kind==maproxy.capture.C2S,data)
+
+
+##########
+## pcap ##
+##########
+def read_packets(path):
+    """
+    Read a pcap or pcap-ng file. Yields (timestamp , link-type , packet)
+    """
+    with open(path,"rb") as f:
+        data=f.read()
+    if data[:4]==b"\x0a\x0d\x0d\x0a":
+        for packet in _read_pcapng(data):
+            yield packet
+        return
+    for endian in ("<",">"):
+        magic=struct.unpack_from(endian+"I",data,0)[0]
+        if magic in (0xa1b2c3d4,0xa1b23c4d):
+            break
+    else:
+        raise ValueError("%s is not a pcap/pcap-ng file" % path)
+    resolution=1e6 if magic==0xa1b2c3d4 else 1e9
+    link_type=struct.unpack_from(endian+"I",data,20)[0]
+    pos=24
+    while pos+16<=len(data):
+        seconds,fraction,captured,original=struct.unpack_from(endian+"IIII",data,pos)
+        yield seconds+fraction/resolution,link_type,data[pos+16:pos+16+captured]
+        pos+=16+captured
+
+
+def _read_pcapng(data):
+    endian="<"
+    interfaces=[]       # (link-type , timestamp resolution)
+    pos=0
+    while pos+12<=len(data):
+        if data[pos:pos+4]==b"\x0a\x0d\x0d\x0a":
+            # Section Header Block: the byte-order magic tells the endianness of the section
+            endian="<" if data[pos+8:pos+12]==b"\x4d\x3c\x2b\x1a" else ">"
+            interfaces=[]
+        block_type,block_size=struct.unpack_from(endian+"II",data,pos)
+        if block_size<12:
+            break
+        if block_type==1:
+            link_type=struct.unpack_from(endian+"H",data,pos+8)[0]
+            resolution=1e6
+            option=pos+16
+            while option+4<=pos+block_size-4:
+                code,length=struct.unpack_from(endian+"HH",data,option)
+                if code==0:
+                    break
+                if code==9:
+                    # if_tsresol
+                    value=data[option+4]
+                    resolution=2.0**(value&0x7f) if value&0x80 else 10.0**value
+                option+=4+length+(-length%4)
+            interfaces.append((link_type,resolution))
+        elif block_type==6 and interfaces:
+            interface,high,low,captured,original=struct.unpack_from(endian+"IIIII",data,pos+8)
+            link_type,resolution=interfaces[interface]
+            yield ((high<<32)|low)/resolution,link_type,data[pos+28:pos+28+captured]
+        elif block_type==3 and interfaces:
+            original=struct.unpack_from(endian+"I",data,pos+8)[0]
+            yield 0.0,interfaces[0][0],data[pos+12:pos+12+min(original,block_size-16)]
+        pos+=block_size
+
+
+def _ip_packet(link_type,packet):
+    """
+    The IP packet of a link-layer frame (None: not IP , or an unknown link-type)
+    """
+    if link_type in (101,228,229):
+        return packet
+    if link_type==1:
+        # Ethernet (and VLAN tags)
+        pos=12
+        while packet[pos:pos+2] in (b"\x81\x00",b"\x88\xa8"):
+            pos+=4
+        return packet[pos+2:] if packet[pos:pos+2] in (b"\x08\x00",b"\x86\xdd") else None
+    if link_type==0:
+        # BSD loopback
+        return packet[4:]
+    if link_type==113:
+        # Linux cooked capture
+        return packet[16:] if packet[14:16] in (b"\x08\x00",b"\x86\xdd") else None
+    if link_type==276:
+        return packet[20:] if packet[0:2] in (b"\x08\x00",b"\x86\xdd") else None
+    return None
+
+
+def _tcp_segment(ip):
+    """
+    (source , destination , flags , sequence , payload) of a TCP/IP packet , or None
+    """
+    if not ip:
+        return None
+    version=ip[0]>>4
+    if version==4:
+        header_size=(ip[0]&0x0f)*4
+        if ip[9]!=6:
+            return None
+        total=struct.unpack_from("!H",ip,2)[0]
+        source=(socket.inet_ntop(socket.AF_INET,ip[12:16]),)
+        destination=(socket.inet_ntop(socket.AF_INET,ip[16:20]),)
+        tcp=ip[header_size:total]
+    elif version==6:
+        if ip[6]!=6:
+            return None
+        total=struct.unpack_from("!H",ip,4)[0]
+        source=(socket.inet_ntop(socket.AF_INET6,ip[8:24]),)
+        destination=(socket.inet_ntop(socket.AF_INET6,ip[24:40]),)
+        tcp=ip[40:40+total]
+    else:
+        return None
+    if len(tcp)<20:
+        return None
+    source_port,destination_port,sequence=struct.unpack_from("!HHI",tcp,0)
+    return source+(source_port,),destination+(destination_port,),tcp[13],sequence,tcp[(tcp[12]>>4)*4:]
+
+
+class _Connection(object):
+    __slots__=("session","client","next_sequence")
+
+    def __init__(self,start,client):
+        self.session=RecordedSession(start)
+        self.client=client
+        self.next_sequence={}       # endpoint -> the next sequence number we expect
+
+
+def _read_tcp_sessions(path,server_port):
+    SYN,ACK=0x02,0x10
+    connections={}      # (endpoint , endpoint) -> _Connection
+    sessions=[]
+    for timestamp,link_type,packet in read_packets(path):
+        segment=_tcp_segment(_ip_packet(link_type,packet))
+        if segment is None:
+            continue
+        source,destination,flags,sequence,payload=segment
+        key=(source,destination) if source<destination else (destination,source)
+        connection=connections.get(key)
+        if flags&SYN and not flags&ACK and connection is not None and connection.session.events:
+            # (the ports were reused by a new connection)
+            sessions.append(connection.session)
+            connection=None
+        if connection is None:
+            if flags&SYN:
+                client=source if not flags&ACK else destination
+            elif server_port is not None:
+                client=destination if source[1]==server_port else source
+            else:
+                client=source
+            connection=connections[key]=_Connection(timestamp,client)
+        if flags&SYN:
+            connection.next_sequence[source]=(sequence+1)&0xffffffff
+            continue
+        if not payload:
+            continue
+        expected=connection.next_sequence.get(source,sequence)
+        offset=(sequence-expected+0x80000000)%0x100000000-0x80000000
+        if offset<0:
+            # A retransmission: drop what we already have
+            payload=payload[-offset:]
+            if not payload:
+                continue
+            sequence=expected
+        connection.next_sequence[source]=(sequence+len(payload))&0xffffffff
+        connection.session.add(timestamp,source==connection.client,payload)
+    sessions.extend( connection.session for connection in connections.values() )
+    return sessions
+
+
+##########
+## HTTP ##
+##########
+def split_http_messages(data,response=False,methods=()):
+    """
+    Split an HTTP/1.x stream into messages. Returns a list of (start-line , message , close-delimited).
+    For responses , "methods" are the methods of the requests (the response of a HEAD has no body)
+    """
+    messages=[]
+    pos=message_start=0
+    while pos<len(data):
+        end=data.find(b"\r\n\r\n",pos)
+        if end<0:
+            break
+        try:
+            start_line,headers=maproxy.httpsession.parse_head(data[pos:end+4])
+            body=end+4
+            close=False
+            if response:
+                status=int(start_line[1])
+                if 100<=status<200 and status!=101:
+                    # (an interim response belongs to the final one)
+                    pos=body
+                    continue
+                method=methods[len(messages)] if len(messages)<len(methods) else b"GET"
+                no_body=method==b"HEAD" or status in (204,304)
+            else:
+                no_body=False
+            transfer_encoding=maproxy.httpsession.get_tokens(headers,b"transfer-encoding")
+            length=maproxy.httpsession.get_content_length(headers)
+            if no_body:
+                pos=body
+            elif transfer_encoding and transfer_encoding[-1]==b"chunked":
+                pos=_chunked_end(data,body)
+            elif length is not None:
+                pos=body+length
+            elif response:
+                pos=len(data)
+                close=True
+            else:
+                pos=body
+        except (maproxy.httpsession.HTTPError,ValueError,IndexError):
+            break
+        messages.append((start_line,data[message_start:pos],close))
+        message_start=pos
+    return messages
+
+
+def _chunked_end(data,pos):
+    while True:
+        line_end=data.find(b"\r\n",pos)
+        if line_end<0:
+            return len(data)
+        size=int(data[pos:line_end].split(b";",1)[0].strip(),16)
+        pos=line_end+2
+        if not size:
+            # The trailer , up to an empty line
+            while True:
+                line_end=data.find(b"\r\n",pos)
+                if line_end<0:
+                    return len(data)
+                line=data[pos:line_end]
+                pos=line_end+2
+                if not line:
+                    return pos
+        pos+=size+2
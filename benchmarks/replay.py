@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+#
+# replay.py: replay recorded sessions (maproxy capture records , pcap , pcap-ng) through a ProxyServer , against a
+#            local stub backend that plays the servers' side of the recording. Reports the throughput and the
+#            response latency , directly against the backend and through the proxy (the difference is the latency
+#            that the proxy adds).
+#
+#   python -m benchmarks.replay /var/tmp/proxy-*.rec                       # the recorded timing
+#   python -m benchmarks.replay traffic.pcap --speedup 10 --repeat 20      # 10x faster , 20 copies of each session
+#   python -m benchmarks.replay http.pcapng --speedup 0 --backend http --session-factory http --concurrency 200
+#   python -m benchmarks.replay mqtt.rec --session-factory mqtt --proxy-kwargs '{"engine":"asyncio"}'
+
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import collections
+
+from benchmarks import servers
+from benchmarks import recordings
+from benchmarks.load import percentile
+import maproxy.session
+import maproxy.httpsession
+import maproxy.mqtt
+
+
+SESSION_FACTORIES={
+    "tcp":maproxy.session.SessionFactory,
+    "http":maproxy.httpsession.HTTPSessionFactory,
+    "mqtt":maproxy.mqtt.MQTTSessionFactory,
+}
+
+
+class ReplayStats(object):
+    def __init__(self):
+        self.sessions=0
+        self.errors=0
+        self.bytes_c2s=0
+        self.bytes_s2c=0
+        self.latencies=[]       # seconds , from a request to the first byte of its response
+
+    def get_results(self,elapsed):
+        self.latencies.sort()
+        return {
+            "sessions": self.sessions,
+            "errors": self.errors,
+            "elapsed": elapsed,
+            "throughput_mb_s": (self.bytes_c2s+self.bytes_s2c)/elapsed/(1024*1024),
+            "sessions_per_sec": self.sessions/elapsed,
+            "latency_p50_ms": percentile(self.latencies,50)*1000,
+            "latency_p99_ms": percentile(self.latencies,99)*1000,
+        }
+
+
+class Replay(object):
+    """
+    Replays sessions (list of recordings.RecordedSession) with asyncio clients , against a stub backend:
+        "stream": each backend connection plays the server's side of one session. The server's data is sent once
+                  the client's data that preceded it (in the recording) arrived. The connections are matched to
+                  the sessions by their order , so the sessions connect one at a time (a ProxyServer connects to
+                  the server when the client connects)
+        "http"  : the backend answers each request with a recorded response to the same method and target
+                  (for proxies that connect later and reuse the server's connections , see HTTPSession)
+    The clients send their data at the recorded times (divided by "speedup" , 0: as fast as possible) , but
+    never before the server's data that preceded it in the recording arrived
+    """
+    def __init__(self,sessions,speedup=1.0,concurrency=None,backend="stream",timeout=10.0):
+        """
+        Input Parameters:
+            sessions    : the recorded sessions
+            speedup     : compress the recorded timing (2: twice as fast , 0: no delays)
+            concurrency : maximum concurrent sessions (None: unlimited)
+            backend     : "stream" or "http"
+            timeout     : (seconds) a session fails if it waits longer than this for data
+        """
+        assert backend in ("stream","http") , "Unknown backend: %s" % backend
+        self.sessions=sessions
+        self.speedup=speedup
+        self.concurrency=concurrency
+        self.backend=backend
+        self.timeout=timeout
+        self.responses={}       # (method , target) -> deque of (response , close-delimited) , for the "http" backend
+        if backend=="http":
+            self._load_responses()
+        # The backend listens (on the same port) for all the runs
+        self.listener=socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        self.listener.bind(("127.0.0.1",0))
+        self.listener.listen(1024)
+        self.backend_port=self.listener.getsockname()[1]
+
+    def _load_responses(self):
+        for session in self.sessions:
+            requests=recordings.split_http_messages(session.get_stream(True))
+            responses=recordings.split_http_messages(session.get_stream(False),True,[ start_line[0] for start_line,message,close in requests ])
+            for (request_line,request,request_close),(response_line,response,close) in zip(requests,responses):
+                self.responses.setdefault((request_line[0],request_line[1]),collections.deque()).append((response,close))
+
+    def run(self,port):
+        """
+        Replay all the sessions against a port (the proxy's , or the backend's: self.backend_port). Returns the results
+        """
+        loop=asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(self._run(loop,port))
+        finally:
+            loop.close()
+
+    async def _run(self,loop,port):
+        self._pending=collections.deque()       # (session , future) waiting for their backend connection
+        self._connect_lock=asyncio.Lock()
+        self._semaphore=asyncio.Semaphore(self.concurrency) if self.concurrency else None
+        self._backend_tasks=set()
+        server=await asyncio.start_server(self._serve,sock=self.listener.dup())
+        stats=ReplayStats()
+        first=self.sessions[0].start if self.sessions else 0
+        start=loop.time()
+        clients=[ self._start_client(loop,session,port,stats,start+(session.start-first)/self.speedup if self.speedup else start)
+                  for session in self.sessions ]
+        await asyncio.gather(*clients)
+        elapsed=loop.time()-start
+        server.close()
+        await server.wait_closed()
+        # (the backend's connections end once they see the clients close)
+        if self._backend_tasks:
+            await asyncio.wait(self._backend_tasks,timeout=self.timeout)
+        return stats.get_results(elapsed)
+
+    async def _start_client(self,loop,session,port,stats,start_time):
+        delay=start_time-loop.time()
+        if delay>0:
+            await asyncio.sleep(delay)
+        if self._semaphore is None:
+            await self._client(loop,session,port,stats)
+            return
+        async with self._semaphore:
+            await self._client(loop,session,port,stats)
+
+    ############
+    ## Client ##
+    ############
+    async def _client(self,loop,session,port,stats):
+        writer=None
+        try:
+            if self.backend=="stream":
+                async with self._connect_lock:
+                    connected=loop.create_future()
+                    self._pending.append((session,connected))
+                    reader,writer=await asyncio.open_connection("127.0.0.1",port)
+                    await asyncio.wait_for(connected,self.timeout)
+            else:
+                reader,writer=await asyncio.open_connection("127.0.0.1",port)
+            writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+            await self._play(loop,session,True,reader,writer,stats)
+            stats.sessions+=1
+        except (asyncio.TimeoutError,OSError,asyncio.IncompleteReadError):
+            stats.errors+=1
+        finally:
+            if writer is not None:
+                writer.close()
+
+    async def _play(self,loop,session,c2s,reader,writer,stats=None):
+        """
+        Play one side of a session: send our data at its (compressed) time , once the peer's data that preceded
+        it in the recording arrived
+        """
+        start=loop.time()
+        received=[0]
+        arrived=asyncio.Event()
+        waiting=collections.deque()     # (send time , peer's bytes before the request) waiting for a response
+
+        async def read():
+            while True:
+                data=await reader.read(65536)
+                if not data:
+                    break
+                received[0]+=len(data)
+                if stats is not None:
+                    now=loop.time()
+                    while waiting and received[0]>waiting[0][1]:
+                        stats.latencies.append(now-waiting.popleft()[0])
+                arrived.set()
+            arrived.set()
+
+        reading=asyncio.ensure_future(read())
+        try:
+            expected=0          # the peer's bytes so far (in the recording)
+            events=session.events
+            for index,(offset,is_c2s,data) in enumerate(events):
+                if is_c2s!=c2s:
+                    expected+=len(data)
+                    continue
+                while received[0]<expected and not reading.done():
+                    arrived.clear()
+                    await asyncio.wait_for(arrived.wait(),self.timeout)
+                if self.speedup:
+                    delay=start+offset/self.speedup-loop.time()
+                    if delay>0:
+                        await asyncio.sleep(delay)
+                if stats is not None:
+                    if index+1<len(events) and events[index+1][1]!=c2s:
+                        waiting.append((loop.time(),expected))
+                    stats.bytes_c2s+=len(data)
+                writer.write(data)
+                await writer.drain()
+            if c2s:
+                # Wait for the rest of the server's data
+                while received[0]<expected and not reading.done():
+                    arrived.clear()
+                    await asyncio.wait_for(arrived.wait(),self.timeout)
+                stats.bytes_s2c+=received[0]
+            else:
+                # Wait until the client closes
+                await asyncio.wait_for(reading,self.timeout)
+        finally:
+            reading.cancel()
+
+    #############
+    ## Backend ##
+    #############
+    async def _serve(self,reader,writer):
+        loop=asyncio.get_event_loop()
+        task=asyncio.current_task() if hasattr(asyncio,"current_task") else asyncio.Task.current_task()
+        self._backend_tasks.add(task)
+        try:
+            if self.backend=="http":
+                await self._serve_http(reader,writer)
+            elif self._pending:
+                session,connected=self._pending.popleft()
+                if not connected.done():
+                    connected.set_result(None)
+                await self._play(loop,session,False,reader,writer)
+        except (asyncio.TimeoutError,OSError,asyncio.IncompleteReadError,asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+            self._backend_tasks.discard(task)
+
+    async def _serve_http(self,reader,writer):
+        while True:
+            try:
+                head=await reader.readuntil(b"\r\n\r\n")
+            except asyncio.IncompleteReadError:
+                return
+            start_line,headers=maproxy.httpsession.parse_head(head)
+            transfer_encoding=maproxy.httpsession.get_tokens(headers,b"transfer-encoding")
+            if transfer_encoding and transfer_encoding[-1]==b"chunked":
+                while True:
+                    size=int((await reader.readuntil(b"\r\n")).split(b";",1)[0].strip(),16)
+                    if not size:
+                        while await reader.readuntil(b"\r\n")!=b"\r\n":
+                            pass
+                        break
+                    await reader.readexactly(size+2)
+            else:
+                await reader.readexactly(maproxy.httpsession.get_content_length(headers) or 0)
+            responses=self.responses.get((start_line[0],start_line[1]))
+            if not responses:
+                writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+                continue
+            response,close=responses[0]
+            responses.rotate(-1)
+            writer.write(response)
+            await writer.drain()
+            if close:
+                return
+
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description="replay recorded sessions through a ProxyServer")
+    parser.add_argument("files",nargs="+",help="maproxy capture records (.rec) , pcap or pcap-ng files")
+    parser.add_argument("--server-port",type=int,help="the server's port (pcap files without the SYNs)")
+    parser.add_argument("--speedup",type=float,default=1.0,help="compress the recorded timing (0: no delays)")
+    parser.add_argument("--repeat",type=int,default=1,help="replay each session this many times (concurrently)")
+    parser.add_argument("--concurrency",type=int,help="maximum concurrent sessions")
+    parser.add_argument("--backend",default="stream",choices=("stream","http"),help="the stub backend (see Replay)")
+    parser.add_argument("--session-factory",default="tcp",choices=sorted(SESSION_FACTORIES),help="the proxy's sessions")
+    parser.add_argument("--proxy-kwargs",type=json.loads,default={},help="JSON dictionary of ProxyServer arguments")
+    parser.add_argument("--timeout",type=float,default=10.0,help="(seconds) a session fails if it waits longer for data")
+    parser.add_argument("--no-direct",action="store_true",help="don't run against the backend directly (no added-latency)")
+    parser.add_argument("--json",help="save the results to this file")
+    options=parser.parse_args(argv)
+
+    sessions=recordings.load_sessions(options.files,options.server_port)
+    if not sessions:
+        print("no sessions in the files",file=sys.stderr)
+        return 2
+    sessions=[ session for session in sessions for i in range(options.repeat) ]
+    print("%d sessions , %.1f MB" % (len(sessions),sum( session.get_bytes(True)+session.get_bytes(False) for session in sessions )/(1024*1024)),file=sys.stderr)
+    replay=Replay(sessions,options.speedup,options.concurrency,options.backend,options.timeout)
+
+    # (the proxy's process is forked before we run an event-loop)
+    proxy_kwargs=dict(options.proxy_kwargs,session_factory=SESSION_FACTORIES[options.session_factory]())
+    proxy=servers.Proxy("tcp2tcp",replay.backend_port,proxy_kwargs)
+    proxy.start()
+    results={}
+    try:
+        time.sleep(0.2)
+        if not options.no_direct:
+            print("running direct ...",file=sys.stderr)
+            results["direct"]=replay.run(replay.backend_port)
+        print("running proxy ...",file=sys.stderr)
+        results["proxy"]=replay.run(proxy.port)
+    finally:
+        proxy.stop()
+    if "direct" in results:
+        results["added_latency"]={ metric:results["proxy"][metric]-results["direct"][metric] for metric in ("latency_p50_ms","latency_p99_ms") }
+
+    for run,metrics in results.items():
+        print("%-14s %s" % (run,"  ".join( "%s=%s" % (metric,("%.2f" % value) if isinstance(value,float) else value)
+                                             for metric,value in sorted(metrics.items()) )))
+    if options.json:
+        with open(options.json,"w") as f:
+            json.dump({ "options": vars(options), "results": results },f,indent=2,sort_keys=True)
+    return 0
+
+
+if __name__=="__main__":
+    sys.exit(main())
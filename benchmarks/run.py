@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#
+# run.py: maproxy benchmarks. Starts local echo/sink backends (clear-text and SSL, using the demo certificate),
+#         a ProxyServer for each mode (TCP->TCP, TCP->SSL, SSL->TCP, SSL->SSL) and a load generator.
+#
+#   python -m benchmarks.run                                 # all the modes
+#   python -m benchmarks.run --modes tcp2tcp --json new.json # save the results
+#   python -m benchmarks.run --baseline old.json             # compare (exit code 1 on a regression)
+#   python -m benchmarks.run --proxy-kwargs '{"engine":"splice"}' --modes tcp2tcp
+#   python -m benchmarks.run --proxy-kwargs '{"engine":"asyncio"}' --modes tcp2tcp --uvloop
+
+import sys
+import json
+import time
+import argparse
+import platform
+
+from benchmarks import servers
+from benchmarks import load
+import maproxy.aioengine
+
+
+# metric -> True if higher is better
+METRICS={
+    "throughput_mb_s":True,
+    "latency_p50_ms":False,
+    "latency_p99_ms":False,
+    "requests_per_sec":True,
+    "connections_per_sec":True,
+    "rss_per_idle_connection":False,
+}
+
+
+def run_mode(mode,backends,options):
+    """
+    Run all the tests against one mode. Returns a dictionary of metric->value
+    """
+    client_ssl,server_ssl=servers.MODES[mode]
+    results={}
+    ssl_context=servers.client_context() if client_ssl else None
+
+    # Upload to the sink
+    proxy=servers.Proxy(mode,backends.port("sink",server_ssl),options.proxy_kwargs)
+    proxy.start()
+    try:
+        time.sleep(0.2)
+        generator=load.LoadGenerator(proxy.port,ssl_context)
+        results.update(generator.throughput(options.connections,options.size_mb*1024*1024))
+    finally:
+        proxy.stop()
+
+    # Round-trips with the echo server
+    proxy=servers.Proxy(mode,backends.port("echo",server_ssl),options.proxy_kwargs)
+    proxy.start()
+    try:
+        time.sleep(0.2)
+        generator=load.LoadGenerator(proxy.port,ssl_context)
+        results.update(generator.latency(options.connections,options.requests))
+        results.update(generator.connection_rate(options.new_connections,options.connections))
+        results.update(generator.idle_connections(options.idle,lambda: servers.get_rss(proxy.pid)))
+    finally:
+        proxy.stop()
+    return results
+
+
+def compare(results,baseline,tolerance):
+    """
+    Compare the results with a baseline. Returns a list of (mode,metric,baseline,current,change) of regressions
+    """
+    regressions=[]
+    for mode,metrics in results.items():
+        for metric,value in metrics.items():
+            base=baseline.get(mode,{}).get(metric)
+            if value is None or not base:
+                continue
+            change=(value-base)/base
+            worse=-change if METRICS[metric] else change
+            if worse>tolerance:
+                regressions.append((mode,metric,base,value,change))
+    return regressions
+
+
+def print_results(results,baseline=None):
+    modes=list(results)
+    print("%-26s" % "" + "".join( "%16s" % mode for mode in modes ))
+    for metric in METRICS:
+        line="%-26s" % metric
+        for mode in modes:
+            value=results[mode].get(metric)
+            cell="-" if value is None else "%.2f" % value
+            base=(baseline or {}).get(mode,{}).get(metric)
+            if value is not None and base:
+                cell+=" (%+.0f%%)" % ((value-base)/base*100)
+            line+="%16s" % cell
+        print(line)
+
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description="maproxy benchmarks")
+    parser.add_argument("--modes",default=",".join(servers.MODES),help="comma separated: "+",".join(servers.MODES))
+    parser.add_argument("--connections",type=int,default=4,help="concurrent connections (throughput/latency)")
+    parser.add_argument("--size-mb",type=int,default=64,help="MB to upload per connection (throughput)")
+    parser.add_argument("--requests",type=int,default=2000,help="requests per connection (latency)")
+    parser.add_argument("--new-connections",type=int,default=1000,help="connections to open (connections/sec)")
+    parser.add_argument("--idle",type=int,default=500,help="idle connections (RSS per connection)")
+    parser.add_argument("--proxy-kwargs",type=json.loads,default={},help="JSON dictionary of ProxyServer arguments")
+    parser.add_argument("--uvloop",action="store_true",help="run the proxies on uvloop (if it's installed)")
+    parser.add_argument("--json",help="save the results to this file")
+    parser.add_argument("--baseline",help="compare with the results in this file")
+    parser.add_argument("--tolerance",type=float,default=0.1,help="allowed regression (fraction , default: 0.1)")
+    options=parser.parse_args(argv)
+
+    if options.uvloop and not maproxy.aioengine.use_uvloop():
+        print("uvloop is not installed",file=sys.stderr)
+        return 2
+
+    baseline=None
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline=json.load(f)["results"]
+
+    backends=servers.Backends()
+    backends.start()
+    results={}
+    try:
+        time.sleep(0.2)
+        for mode in options.modes.split(","):
+            print("running %s ..." % mode,file=sys.stderr)
+            results[mode]=run_mode(mode,backends,options)
+    finally:
+        backends.stop()
+
+    print_results(results,baseline)
+    if options.json:
+        with open(options.json,"w") as f:
+            json.dump({ "python": platform.python_version(), "platform": platform.platform(),
+                        "options": vars(options), "results": results },f,indent=2,sort_keys=True)
+    if baseline is not None:
+        regressions=compare(results,baseline,options.tolerance)
+        for mode,metric,base,value,change in regressions:
+            print("REGRESSION %s %s: %.2f -> %.2f (%+.0f%%)" % (mode,metric,base,value,change*100))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__=="__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import ssl
+import signal
+import traceback
+import tornado.ioloop
+import tornado.netutil
+import tornado.tcpserver
+
+# Run from the source tree (python -m benchmarks.run) without installing maproxy
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import maproxy.proxyserver
+
+
+DEMOS_DIR=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),"demos")
+SSL_CERTS={ "certfile": os.path.join(DEMOS_DIR,"certificate.pem"),
+            "keyfile": os.path.join(DEMOS_DIR,"privatekey.pem") }
+
+# The proxy modes: (client_ssl , server_ssl)
+MODES={
+    "tcp2tcp":(False,False),
+    "tcp2ssl":(False,True),
+    "ssl2tcp":(True,False),
+    "ssl2ssl":(True,True),
+}
+
+
+class EchoServer(tornado.tcpserver.TCPServer):
+    """
+    Writes back whatever it reads
+    """
+    def handle_stream(self,stream,address):
+        stream.set_nodelay(True)
+        stream.read_until_close(lambda data: stream.close(),streaming_callback=lambda data: stream.write(data))
+
+
+class SinkServer(tornado.tcpserver.TCPServer):
+    """
+    Reads (and discards) everything. Closes the connection when the client does
+    """
+    def handle_stream(self,stream,address):
+        stream.read_until_close(lambda data: stream.close(),streaming_callback=lambda data: None)
+
+
+def _fork(target,*args):
+    """
+    Run target(*args) in a child process (with its own IOLoop). Returns the child's pid
+    """
+    pid=os.fork()
+    if pid:
+        return pid
+    exit_code=0
+    try:
+        signal.signal(signal.SIGINT,signal.SIG_IGN)
+        signal.signal(signal.SIGTERM,signal.SIG_DFL)
+        target(*args)
+        tornado.ioloop.IOLoop.current().start()
+    except Exception:
+        traceback.print_exc()
+        exit_code=1
+    finally:
+        os._exit(exit_code)
+
+
+def _bind():
+    return tornado.netutil.bind_sockets(0,"127.0.0.1")
+
+
+def _port(sockets):
+    return sockets[0].getsockname()[1]
+
+
+class Backends(object):
+    """
+    The target servers (in a child process): echo and sink , each one in clear-text and in SSL
+    """
+    def __init__(self):
+        self.sockets={ (kind,tls):_bind() for kind in ("echo","sink") for tls in (False,True) }
+        self.ports={ key:_port(sockets) for key,sockets in self.sockets.items() }
+        self.pid=None
+
+    def port(self,kind,tls):
+        return self.ports[(kind,tls)]
+
+    def start(self):
+        self.pid=_fork(self._run)
+        for sockets in self.sockets.values():
+            for sock in sockets:
+                sock.close()
+
+    def _run(self):
+        for (kind,tls),sockets in self.sockets.items():
+            cls=EchoServer if kind=="echo" else SinkServer
+            server=cls(ssl_options=SSL_CERTS if tls else None)
+            server.add_sockets(sockets)
+
+    def stop(self):
+        stop_process(self.pid)
+
+
+class Proxy(object):
+    """
+    A ProxyServer (in a child process) in one of the MODES , in front of one of the backends
+    """
+    def __init__(self,mode,target_port,proxy_kwargs=None):
+        self.client_ssl,self.server_ssl=MODES[mode]
+        self.target_port=target_port
+        self.proxy_kwargs=proxy_kwargs or {}
+        self.sockets=_bind()
+        self.port=_port(self.sockets)
+        self.pid=None
+
+    def start(self):
+        self.pid=_fork(self._run)
+        for sock in self.sockets:
+            sock.close()
+
+    def _run(self):
+        server=maproxy.proxyserver.ProxyServer("127.0.0.1",self.target_port,
+                                               client_ssl_options=SSL_CERTS if self.client_ssl else None,
+                                               server_ssl_options=True if self.server_ssl else None,
+                                               **self.proxy_kwargs)
+        server.add_sockets(self.sockets)
+
+    def stop(self):
+        stop_process(self.pid)
+
+
+def stop_process(pid):
+    if pid is None:
+        return
+    try:
+        os.kill(pid,signal.SIGTERM)
+        os.waitpid(pid,0)
+    except (ProcessLookupError,ChildProcessError):
+        pass
+
+
+def get_rss(pid):
+    """
+    Resident memory (bytes) of a process , None if unknown (Linux only)
+    """
+    try:
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])*1024
+    except (IOError,OSError):
+        pass
+    return None
+
+
+def client_context():
+    """
+    SSL context of the benchmark's clients (the demo certificate is self-signed , we don't verify it)
+    """
+    context=ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname=False
+    context.verify_mode=ssl.CERT_NONE
+    return context
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+import collections
+import tornado.ioloop
+import maproxy.shaping
+
+
+class AdmissionControl(object):
+    """
+    Admission control of a ProxyServer: every accepted connection is checked (before the SSL handshake and
+    before we create a session) against:
+        max_sessions    : the server's current sessions (and the connections in their SSL handshake , that will be
+                          sessions once the SNI hostname is known)
+        max_connecting  : the connections to the servers that are in progress (connect , SSL handshake)
+        client_rate     : new connections per second of each client IP (token-bucket)
+    A client that exceeds its rate is rejected (the connection is closed). When the server is full, the
+    connection waits in a short queue (up to queue_timeout seconds) for a free slot , and is rejected if the
+    queue is full or if it waited too long. While waiting , nothing is read from the client.
+    An admitted connection that waits for its SSL handshake (SNI routing) is closed after handshake_timeout
+    seconds , so connections that never send a ClientHello don't keep the slots.
+
+    The per-client buckets are kept only while they are in use: a full bucket is exactly like a new one ,
+    so it's dropped on the next cleanup (every CLEANUP_INTERVAL seconds).
+    """
+    # How often (seconds) we drop the buckets of the clients that are not connecting
+    CLEANUP_INTERVAL=10
+
+    def __init__(self,max_sessions=None,max_connecting=None,client_rate=None,queue_size=0,queue_timeout=1.0,
+                 handshake_timeout=10.0):
+        """
+        Input Parameters:
+            max_sessions    : maximum number of sessions (None: unlimited)
+            max_connecting  : maximum number of server-connections in progress (None: unlimited)
+            client_rate     : new connections/sec per client IP , or (connections/sec , burst). None: unlimited
+                              (the burst is at least 1 connection: a rate below 1/sec allows one connection
+                              every 1/rate seconds)
+            queue_size      : how many connections can wait for a free slot (0: reject immediately)
+            queue_timeout   : (seconds) how long a connection can wait in the queue
+            handshake_timeout : (seconds) how long an admitted connection can take its session's slot while it
+                              waits for the SSL handshake (SNI routing) before it's closed (None: no limit)
+        """
+        self.max_sessions=max_sessions
+        self.max_connecting=max_connecting
+        if client_rate is not None:
+            if isinstance(client_rate,(list,tuple)):
+                assert client_rate[1]>=1 , "The client_rate burst must be at least 1 connection"
+            else:
+                client_rate=(client_rate,max(1,client_rate))
+        self.client_rate=client_rate
+        self.queue_size=queue_size
+        self.queue_timeout=queue_timeout
+        self.handshake_timeout=handshake_timeout
+        self.proxy=None
+        self.connecting=0               # Server-connections in progress
+        self.handshaking=0              # Admitted connections in their SSL handshake (not sessions yet)
+        self._queue=collections.deque() # (deadline , stream , address) , oldest first
+        self._clients={}                # client IP -> maproxy.shaping.TokenBucket
+        self._ioloop=None
+        self._queue_timeout=None
+        self._cleanup_timeout=None
+
+        # Some statistics
+        self.admitted=0
+        self.queued=0
+        self.rejected_sessions=0        # Rejected: max_sessions/max_connecting (the queue was full or timed-out)
+        self.rejected_rate=0            # Rejected: client_rate
+        self.handshake_timeouts=0       # Closed: no SSL handshake within handshake_timeout
+
+    def bind(self,proxy):
+        """
+        Called by the ProxyServer (an AdmissionControl instance belongs to a single server)
+        """
+        assert self.proxy is None or self.proxy is proxy , "AdmissionControl can't be shared by a few servers"
+        self.proxy=proxy
+
+    def admit(self,stream,address):
+        """
+        Check a new connection. Returns True if the connection can start now. Otherwise the connection was either
+        rejected (closed) or queued (the ProxyServer's _accept is called once there's a free slot)
+        """
+        if self.client_rate is not None and not self._client_allowed(address[0]):
+            self.rejected_rate+=1
+            self.proxy.metrics.rejected_rate+=1
+            stream.close()
+            return False
+        if not self._queue and self._has_slot():
+            self.admitted+=1
+            return True
+        if len(self._queue)>=self.queue_size:
+            self._reject(stream)
+            return False
+        self.queued+=1
+        now=self._now()
+        self._queue.append((now+self.queue_timeout,stream,address))
+        if self._queue_timeout is None:
+            self._queue_timeout=self._ioloop.add_timeout(now+self.queue_timeout,self._expire)
+        return False
+
+    def connect_started(self):
+        self.connecting+=1
+
+    def handshake_started(self):
+        self.handshaking+=1
+
+    def handshake_done(self):
+        self.handshaking-=1
+
+    def connect_done(self):
+        self.connecting-=1
+        self.release()
+
+    def release(self):
+        """
+        A slot was freed (a session ended , or a connection to the server is done): start the queued connections
+        """
+        while self._queue and self._has_slot():
+            deadline,stream,address=self._queue.popleft()
+            if stream.closed():
+                continue
+            self.admitted+=1
+            self.proxy._accept(stream,address)
+
+    def get_queue_length(self):
+        return len(self._queue)
+
+    def get_stats(self):
+        return { "admitted": self.admitted, "queued": self.queued, "queue_length": len(self._queue),
+                 "connecting": self.connecting, "handshaking": self.handshaking, "rejected_sessions": self.rejected_sessions,
+                 "rejected_rate": self.rejected_rate, "handshake_timeouts": self.handshake_timeouts,
+                 "tracked_clients": len(self._clients) }
+
+    def _has_slot(self):
+        if self.max_sessions is not None and len(self.proxy.sessions)+self.handshaking>=self.max_sessions:
+            return False
+        if self.max_connecting is not None and self.connecting>=self.max_connecting:
+            return False
+        return True
+
+    def _reject(self,stream):
+        self.rejected_sessions+=1
+        self.proxy.metrics.rejected_sessions+=1
+        stream.close()
+
+    def _client_allowed(self,ip):
+        now=self._now()
+        bucket=self._clients.get(ip)
+        if bucket is None:
+            bucket=self._clients[ip]=maproxy.shaping._parse_limit(self.client_rate,now)
+            if self._cleanup_timeout is None:
+                self._cleanup_timeout=self._ioloop.add_timeout(now+AdmissionControl.CLEANUP_INTERVAL,self._cleanup)
+        bucket.refill(now)
+        if bucket.tokens<1:
+            return False
+        bucket.tokens-=1
+        return True
+
+    def _now(self):
+        if self._ioloop is None:
+            self._ioloop=tornado.ioloop.IOLoop.current()
+        return self._ioloop.time()
+
+    def _expire(self):
+        self._queue_timeout=None
+        now=self._now()
+        while self._queue and self._queue[0][0]<=now:
+            deadline,stream,address=self._queue.popleft()
+            self._reject(stream)
+        if self._queue:
+            self._queue_timeout=self._ioloop.add_timeout(self._queue[0][0],self._expire)
+
+    def _cleanup(self):
+        self._cleanup_timeout=None
+        now=self._now()
+        for ip,bucket in list(self._clients.items()):
+            bucket.refill(now)
+            if bucket.tokens>=bucket.burst:
+                del self._clients[ip]
+        if self._clients:
+            self._cleanup_timeout=self._ioloop.add_timeout(now+AdmissionControl.CLEANUP_INTERVAL,self._cleanup)
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+import sys
+import asyncio
+import time
+import tornado
+import tornado.ioloop
+import tornado.netutil
+
+
+def is_supported():
+    """
+    Tornado 5+ runs on an asyncio event-loop , so the relay can use the loop's transports directly
+    """
+    return tornado.version_info>=(5,0) and sys.version_info>=(3,6)
+
+
+def use_uvloop():
+    """
+    Run the asyncio event-loops (and Tornado's IOLoops) on uvloop , if it's installed.
+    Must be called before the first IOLoop is created (e.g. before creating the IOManager).
+    Returns True if uvloop is used
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
+class _Side(asyncio.Protocol):
+    """
+    One connection of the relay (the client's or the server's). The data it receives is written to its peer
+    """
+    __slots__=("relay","c2s","transport","peer","shaped","blocked")
+
+    def __init__(self,relay,c2s):
+        self.relay=relay
+        self.c2s=c2s            # True: the client's connection (we read client->server data)
+        self.transport=None
+        self.peer=None
+        self.shaped=False       # we stopped reading because of the rate-limits
+        self.blocked=False      # we stopped reading because the peer's write-buffer is full
+
+    def connection_made(self,transport):
+        self.transport=transport
+        if self.c2s:
+            # (the server is connected already)
+            self.peer=self.relay.server
+            self.peer.peer=self
+            self.relay.client=self
+            self.relay.flush_early_data()
+            if self.peer.transport.is_closing():
+                transport.close()
+        high_watermark=self.relay.proxy.buffer_high_watermark
+        if high_watermark is not None:
+            transport.set_write_buffer_limits(high_watermark,self.relay.proxy.buffer_low_watermark)
+
+    def data_received(self,data):
+        self.relay.received(self,data)
+
+    def eof_received(self):
+        # (close our transport: connection_lost closes the peer once it flushed its data)
+        return False
+
+    def connection_lost(self,exc):
+        self.relay.lost(self)
+
+    def pause_writing(self):
+        # Flow-control: our write-buffer is full , stop reading from the peer
+        self.peer.blocked=True
+        self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        self.peer.blocked=False
+        if not self.peer.shaped:
+            self.peer.transport.resume_reading()
+
+
+class AsyncioRelay(object):
+    """
+    Relay the data of a (plain TCP) session with asyncio Protocols/Transports instead of Tornado's IOStreams:
+    no per-chunk read/write callbacks and no Python-level write queues. The transport's write-buffer is the
+    queue: when it passes the proxy's buffer_high_watermark , the peer stops reading (pause_reading) until it's
+    drained to the buffer_low_watermark.
+    - We connect to the server first , and then start reading from the client (the kernel keeps the client's
+      data meanwhile)
+    - Like the stream engine: when one side closes the connection , the other side is closed once its
+      write-buffer is flushed
+    """
+    def __init__(self,session,client_socket):
+        """
+        Input Parameters:
+            session         : the Session (we call session.on_aio_done() once the relay is done)
+            client_socket   : the client's socket (this relay owns it)
+        """
+        self.session=session
+        self.proxy=session.proxy
+        self.metrics=session.proxy.metrics
+        self.loop=tornado.ioloop.IOLoop.current().asyncio_loop
+        self.client_socket=client_socket
+        self.client=None
+        self.server=None
+        self.task=None          # The server's connect (and then the client's transport) in progress
+        self.early_data=None    # What the server sent before we started the client's transport
+        self.closed=False
+        self._connect_start=time.time()
+        if self.proxy.admission is not None:
+            self.proxy.admission.connect_started()
+            self.proxy._connecting.add(self)
+        server,port=session.target
+        if self.proxy.resolver is None or tornado.netutil.is_valid_ip(server):
+            self._connect((server,port))
+        else:
+            self.proxy.resolver.resolve(server,port,self._on_resolved)
+
+    def _on_resolved(self,address):
+        if self.closed:
+            return
+        if address is None:
+            self._connect_failed()
+            return
+        self._connect(address)
+
+    def _connect(self,address):
+        self.task=self.loop.create_task(self.loop.create_connection(lambda: _Side(self,False),address[0],address[1]))
+        self.task.add_done_callback(self._on_connected)
+
+    def _on_connected(self,task):
+        self.task=None
+        if task.cancelled() or self.closed:
+            # Closed while connecting (e.g. a timeout , that was already counted): not a connect failure
+            if not task.cancelled() and task.exception() is None:
+                task.result()[0].abort()
+            self._connect_aborted()
+            return
+        if task.exception() is not None:
+            self._connect_failed()
+            return
+        transport,self.server=task.result()
+        self._connect_done()
+        if self.session.backend is not None:
+            self.proxy.balancer.connected(self.session.backend,time.time()-self._connect_start)
+        self.session.p2s_state=self.session.State.CONNECTED
+        self.task=self.loop.create_task(self.loop.connect_accepted_socket(lambda: _Side(self,True),self.client_socket))
+        self.task.add_done_callback(self._on_accepted)
+
+    def _on_accepted(self,task):
+        self.task=None
+        if task.cancelled() or task.exception() is not None:
+            self.client_socket.close()
+            self.session.c2p_state=self.session.State.CLOSED
+            self.server.transport.abort()
+            return
+        if self.closed:
+            # (closed while we were waiting for the transport)
+            self.client.transport.abort()
+            self.server.transport.abort()
+
+    def _connect_done(self):
+        if self.proxy.admission is not None:
+            self.proxy._connect_done(self)
+
+    def _connect_failed(self):
+        # (like Session.on_p2s_close in the stream engine)
+        self.metrics.connect_failures+=1
+        if self.session.backend is not None:
+            self.proxy.balancer.connect_failed(self.session.backend)
+        self._connect_aborted()
+
+    def _connect_aborted(self):
+        self._connect_done()
+        self.client_socket.close()
+        self.session.on_aio_done()
+
+    def received(self,side,data):
+        if side.peer is None:
+            # The server spoke first (e.g. a banner) , keep it until the client's transport is ready
+            if self.early_data is None:
+                self.early_data=[]
+                side.transport.pause_reading()
+            self.early_data.append(data)
+            return
+        size=len(data)
+        session=self.session
+        if side.c2s:
+            session.bytes_c2s+=size
+            self.metrics.bytes_c2s+=size
+        else:
+            session.bytes_s2c+=size
+            self.metrics.bytes_s2c+=size
+        side.peer.transport.write(data)
+        shaper=self.proxy.shaper
+        if shaper is not None and shaper.consume(session,"c2s" if side.c2s else "s2c",size):
+            side.shaped=True
+            side.transport.pause_reading()
+
+    def flush_early_data(self):
+        if self.early_data is None:
+            return
+        early_data,self.early_data=self.early_data,None
+        for data in early_data:
+            self.received(self.server,data)
+        if not self.server.shaped and not self.server.blocked:
+            self.server.transport.resume_reading()
+
+    def resume_read(self,direction):
+        """
+        The shaper resumes the reading in a direction ("c2s": from the client , "s2c": from the server)
+        """
+        side=self.client if direction=="c2s" else self.server
+        if side is None:
+            return
+        side.shaped=False
+        if not side.blocked:
+            side.transport.resume_reading()
+
+    def lost(self,side):
+        session=self.session
+        if side.c2s:
+            session.c2p_state=session.State.CLOSED
+        else:
+            session.p2s_state=session.State.CLOSED
+        if side.peer is not None and not side.peer.transport.is_closing():
+            side.peer.transport.close()
+        if session.c2p_state==session.State.CLOSED and session.p2s_state==session.State.CLOSED:
+            session.on_aio_done()
+
+    def close(self):
+        """
+        Close both connections now (the relay calls session.on_aio_done)
+        """
+        if self.closed:
+            return
+        self.closed=True
+        if self.task is not None:
+            self.task.cancel()
+            return
+        if self.client is not None:
+            self.client.transport.abort()
+            self.server.transport.abort()
+        elif self.server is None:
+            # still resolving the server's name (_on_resolved ignores the result)
+            self._connect_aborted()
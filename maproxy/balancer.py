@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+
+import abc
+import socket
+import functools
+import tornado.ioloop
+import tornado.iostream
+import tornado.netutil
+
+
+class Backend(object):
+    """
+    One target server of a ProxyServer, and its statistics.
+    The counters are updated by the ProxyServer from the sessions it tracks
+    """
+    __slots__=("server","port","healthy","active_sessions","total_sessions","connect_failures",
+               "ewma_connect_time","health_failures","health_successes")
+
+    def __init__(self,server,port):
+        self.server=server
+        self.port=port
+        self.healthy=True           # Health-checks status (out of rotation when False)
+        self.active_sessions=0      # Current sessions
+        self.total_sessions=0       # Sessions since startup
+        self.connect_failures=0     # Sessions that failed to connect
+        self.ewma_connect_time=None # (seconds) Exponentially-weighted moving average of the connect time
+        self.health_failures=0      # Consecutive failed health-checks
+        self.health_successes=0     # Consecutive successful health-checks
+
+    @property
+    def address(self):
+        return (self.server,self.port)
+
+    def get_stats(self):
+        return {
+            "server": self.server,
+            "port": self.port,
+            "healthy": self.healthy,
+            "active_sessions": self.active_sessions,
+            "total_sessions": self.total_sessions,
+            "connect_failures": self.connect_failures,
+            "ewma_connect_time": self.ewma_connect_time,
+        }
+
+
+class Balancer(abc.ABC):
+    """
+    Selects a backend for each new session (abstract base class).
+    Subclasses implement "choose" (the selection strategy). The ProxyServer notifies the balancer when a session
+    starts, connects (with its connect-time), fails to connect and ends.
+    """
+    # Weight of the newest sample in the connect-time moving average
+    EWMA_ALPHA=0.3
+    # (seconds) The connect-time sample of a failed connect
+    CONNECT_FAILURE_PENALTY=30.0
+
+    def __init__(self,backends):
+        """
+        Input Parameters:
+            backends : list of Backend objects
+        """
+        assert backends , "At least one backend is required"
+        self.backends=backends
+
+    def select(self):
+        """
+        Select (and count) a backend for a new session.
+        Only healthy backends are candidates. If all the backends are unhealthy, we try all of them
+        (better than rejecting everything when the health-checks are wrong)
+        """
+        if len(self.backends)==1:
+            backend=self.backends[0]
+        else:
+            candidates=[ backend for backend in self.backends if backend.healthy ] or self.backends
+            backend=self.choose(candidates)
+        backend.active_sessions+=1
+        backend.total_sessions+=1
+        return backend
+
+    @abc.abstractmethod
+    def choose(self,candidates):
+        """
+        Return one of the candidates (a non-empty list of Backend objects)
+        """
+
+    def connected(self,backend,connect_time):
+        self._add_sample(backend,connect_time)
+
+    def connect_failed(self,backend):
+        backend.connect_failures+=1
+        # (so a backend that does not connect is not preferred for its "fast" connect-time)
+        self._add_sample(backend,self.CONNECT_FAILURE_PENALTY)
+
+    def _add_sample(self,backend,connect_time):
+        if backend.ewma_connect_time is None:
+            backend.ewma_connect_time=connect_time
+        else:
+            backend.ewma_connect_time+=self.EWMA_ALPHA*(connect_time-backend.ewma_connect_time)
+
+    def session_ended(self,backend):
+        backend.active_sessions-=1
+
+
+class RoundRobinBalancer(Balancer):
+    """
+    Each session goes to the next backend
+    """
+    def __init__(self,backends):
+        super(RoundRobinBalancer,self).__init__(backends)
+        self._next=0
+
+    def choose(self,candidates):
+        backend=candidates[self._next % len(candidates)]
+        self._next=(self._next+1) % len(candidates)
+        return backend
+
+
+class LeastConnectionsBalancer(Balancer):
+    """
+    Each session goes to the backend with the fewest active sessions
+    """
+    def choose(self,candidates):
+        return min(candidates,key=lambda backend: backend.active_sessions)
+
+
+class EWMALatencyBalancer(Balancer):
+    """
+    Each session goes to the backend with the lowest (moving-average) connect-time, weighted by its active sessions.
+    Backends that were never tried are preferred (so we get their latency). A backend whose first connect
+    is still in progress is scored with the average connect-time of the others
+    """
+    def choose(self,candidates):
+        samples=[ backend.ewma_connect_time for backend in candidates if backend.ewma_connect_time is not None ]
+        average=sum(samples)/len(samples) if samples else 1.0
+        def score(backend):
+            if backend.ewma_connect_time is None:
+                if backend.total_sessions==0:
+                    return -1.0
+                return average*(backend.active_sessions+1)
+            return backend.ewma_connect_time*(backend.active_sessions+1)
+        return min(candidates,key=score)
+
+
+# Balancer names (ProxyServer's "balancer" parameter)
+BALANCERS={
+    "round-robin":RoundRobinBalancer,
+    "least-connections":LeastConnectionsBalancer,
+    "ewma-latency":EWMALatencyBalancer,
+}
+
+
+class HealthChecker(object):
+    """
+    Active health-checks: periodically connect (TCP) to each backend.
+    A backend is taken out of rotation after "fall" consecutive failures, and back into rotation
+    after "rise" consecutive successes
+    """
+    def __init__(self,backends,interval=5,timeout=2,rise=2,fall=3,resolver=None):
+        """
+        resolver: maproxy.resolver.CachingResolver to resolve the backends' names (None: let the socket resolve)
+        """
+        self.backends=backends
+        self.resolver=resolver
+        self.interval=interval
+        self.timeout=timeout
+        self.rise=rise
+        self.fall=fall
+        self._ioloop=None
+        self._timeout=None
+        self._checks=set()      # streams of the checks in progress
+
+    def start(self):
+        if self._ioloop is not None:
+            return
+        self._ioloop=tornado.ioloop.IOLoop.current()
+        self._check_all()
+
+    def stop(self):
+        if self._ioloop is None:
+            return
+        if self._timeout is not None:
+            self._ioloop.remove_timeout(self._timeout)
+        self._timeout=None
+        self._ioloop=None
+        checks=list(self._checks)
+        self._checks.clear()
+        for stream in checks:
+            stream.set_close_callback(None)
+            stream.close()
+
+    def _check_all(self):
+        for backend in self.backends:
+            self._check(backend)
+        self._timeout=self._ioloop.add_timeout(self._ioloop.time()+self.interval,self._check_all)
+
+    def _check(self,backend):
+        stream=tornado.iostream.IOStream(socket.socket(socket.AF_INET,socket.SOCK_STREAM,0))
+        self._checks.add(stream)
+        timeout=self._ioloop.add_timeout(self._ioloop.time()+self.timeout,functools.partial(self._done,stream,backend,False))
+        on_connected=functools.partial(self._done,stream,backend,True,timeout)
+        on_failed=functools.partial(self._done,stream,backend,False,timeout)
+        if self.resolver is None or tornado.netutil.is_valid_ip(backend.server):
+            self._connect(stream,backend.address,on_connected,on_failed)
+        else:
+            self.resolver.resolve(backend.server,backend.port,functools.partial(self._on_resolved,stream,on_connected,on_failed))
+
+    def _on_resolved(self,stream,on_connected,on_failed,address):
+        if stream.closed() or stream not in self._checks:
+            return
+        if address is None:
+            on_failed()
+            return
+        self._connect(stream,address,on_connected,on_failed)
+
+    def _connect(self,stream,address,on_connected,on_failed):
+        # (set the close-callback only once we connect: an idle stream with a close-callback polls its socket)
+        stream.connect(address,on_connected)
+        stream.set_close_callback(on_failed)
+
+    def _done(self,stream,backend,success,timeout=None):
+        if stream not in self._checks:
+            # already done (e.g. timeout and then close)
+            return
+        self._checks.discard(stream)
+        if timeout is not None:
+            self._ioloop.remove_timeout(timeout)
+        stream.set_close_callback(None)
+        stream.close()
+        if success:
+            backend.health_failures=0
+            backend.health_successes+=1
+            if not backend.healthy and backend.health_successes>=self.rise:
+                backend.healthy=True
+        else:
+            backend.health_successes=0
+            backend.health_failures+=1
+            if backend.healthy and backend.health_failures>=self.fall:
+                backend.healthy=False
+
+
+def parse_backends(target_server,target_port):
+    """
+    Return a list of Backend objects out of the ProxyServer's target_server/target_port:
+    target_server is a server name/IP , a (server,port) pair , or a list of servers: "server" , "server:port"
+    ("[IPv6]:port") or (server,port). A bare IPv6 address ("::1") is a server without a port
+    (target_port is the port of the servers that don't specify a port)
+    """
+    if not isinstance(target_server,(list,tuple)):
+        return [ _parse_backend(target_server,target_port) ]
+    if len(target_server)==2 and isinstance(target_server[1],int):
+        # A single (server,port)
+        target_server=[target_server]
+    return [ _parse_backend(item,target_port) for item in target_server ]
+
+
+def _parse_backend(item,target_port):
+    if isinstance(item,(list,tuple)):
+        server,port=item
+        return Backend(server,int(port))
+    if item.startswith("["):
+        server,separator,port=item[1:].partition("]")
+        return Backend(server,int(port[1:]) if port.startswith(":") else target_port)
+    if item.count(":")==1:
+        server,separator,port=item.partition(":")
+        return Backend(server,int(port))
+    return Backend(item,target_port)
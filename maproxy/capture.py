@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+
+import os
+import mmap
+import time
+import socket
+import struct
+import logging
+import threading
+import tornado.netutil
+
+
+# Record kinds
+C2S,S2C,OPEN,CLIENT_CLOSED,SERVER_CLOSED=range(5)
+
+# A record (in the ring and in the "records" files): size of the record (header included) , kind , session-id ,
+# timestamp , original size of the data (the data may be truncated , see Capture's snaplen) , followed by the data
+RECORD_HEADER=struct.Struct("<IBQdI")
+RECORDS_MAGIC=b"MPXCAP1\n"
+
+# How often (seconds) the writer thread drains the ring (it's woken earlier when the ring is half full)
+FLUSH_INTERVAL=0.1
+
+
+class RingBuffer(object):
+    """
+    A fixed-size ring of records in an anonymous memory-map: one producer (the IOLoop) and one consumer
+    (the writer thread) , without locks: the producer only advances "head" after the record was written , and
+    the consumer only advances "tail" after the record was copied out (both are running byte counts).
+    A record that doesn't fit in the free space is dropped (the producer never waits for the consumer)
+    """
+    def __init__(self,size):
+        self.size=size
+        self._buffer=mmap.mmap(-1,size)
+        self._head=0
+        self._tail=0
+
+    def get_used(self):
+        return self._head-self._tail
+
+    def put(self,kind,session_id,timestamp,data,original_size):
+        """
+        Add a record. Returns False if there's no room (the record is dropped)
+        """
+        record_size=RECORD_HEADER.size+len(data)
+        pos=self._head%self.size
+        contiguous=self.size-pos
+        # (a record doesn't wrap around: skip the end of the buffer)
+        skip=contiguous if contiguous<record_size else 0
+        if self._head+skip+record_size-self._tail>self.size:
+            return False
+        if skip:
+            if contiguous>=4:
+                struct.pack_into("<I",self._buffer,pos,0)
+            pos=0
+        RECORD_HEADER.pack_into(self._buffer,pos,record_size,kind,session_id,timestamp,original_size)
+        self._buffer[pos+RECORD_HEADER.size:pos+record_size]=data
+        self._head+=skip+record_size
+        return True
+
+    def get(self):
+        """
+        Take all the records: list of (kind , session-id , timestamp , data , original-size)
+        """
+        records=[]
+        head=self._head
+        tail=self._tail
+        while tail<head:
+            pos=tail%self.size
+            contiguous=self.size-pos
+            record_size=struct.unpack_from("<I",self._buffer,pos)[0] if contiguous>=4 else 0
+            if not record_size:
+                # (the rest of the buffer was skipped)
+                tail+=contiguous
+                continue
+            record_size,kind,session_id,timestamp,original_size=RECORD_HEADER.unpack_from(self._buffer,pos)
+            records.append((kind,session_id,timestamp,self._buffer[pos+RECORD_HEADER.size:pos+record_size],original_size))
+            tail+=record_size
+        self._tail=tail
+        return records
+
+    def close(self):
+        self._buffer.close()
+
+
+class RecordsWriter(object):
+    """
+    Length-prefixed files: RECORDS_MAGIC , followed by the records (RECORD_HEADER and the data). See read_records
+    """
+    extension=".rec"
+
+    def start(self,f):
+        f.write(RECORDS_MAGIC)
+
+    def write(self,f,kind,session_id,timestamp,data,original_size):
+        f.write(RECORD_HEADER.pack(RECORD_HEADER.size+len(data),kind,session_id,timestamp,original_size))
+        f.write(data)
+
+
+class PcapngWriter(object):
+    """
+    pcap-ng files (raw IP link-type) that Wireshark can follow: each session is shown as a TCP connection between
+    the client and the server (the IP and TCP headers are made up: a handshake when the session starts ,
+    a FIN when a side closes , and the sequence numbers of the relayed data)
+    """
+    extension=".pcapng"
+    LINKTYPE_RAW=101
+    MAX_SEGMENT=65000
+    SYN,FIN,PSH_ACK,ACK,SYN_ACK=0x02,0x11,0x18,0x10,0x12
+
+    def __init__(self):
+        self._sessions={}       # session-id -> [client-address , server-address , c2s-sequence , s2c-sequence , closed-sides]
+
+    def start(self,f):
+        # Section Header Block , Interface Description Block (microseconds timestamps)
+        f.write(struct.pack("<IIIHHqI",0x0A0D0D0A,28,0x1A2B3C4D,1,0,-1,28))
+        f.write(struct.pack("<IIHHII",1,20,PcapngWriter.LINKTYPE_RAW,0,0,20))
+
+    def write(self,f,kind,session_id,timestamp,data,original_size):
+        state=self._sessions.get(session_id)
+        if kind==OPEN:
+            client,server=bytes(data).decode("ascii").split(" ")
+            state=self._sessions[session_id]=_new_state(client,server,session_id)
+            self._packet(f,timestamp,state,True,PcapngWriter.SYN,b"",0)
+            self._packet(f,timestamp,state,False,PcapngWriter.SYN_ACK,b"",0)
+            state[2]+=1
+            state[3]+=1
+            self._packet(f,timestamp,state,True,PcapngWriter.ACK,b"",0)
+            return
+        if state is None:
+            # (the session started before the capture)
+            state=self._sessions[session_id]=_new_state("","",session_id)
+        if kind==C2S or kind==S2C:
+            c2s=kind==C2S
+            # Segments of (up to) MAX_SEGMENT bytes of the original chunk. The bytes that were not captured (at the
+            # end of the chunk) are "missing" from the last segments , so no IP length overflows
+            size=max(original_size,len(data))
+            for offset in range(0,max(size,1),PcapngWriter.MAX_SEGMENT):
+                segment_size=min(size-offset,PcapngWriter.MAX_SEGMENT)
+                segment=data[offset:offset+segment_size]
+                self._packet(f,timestamp,state,c2s,PcapngWriter.PSH_ACK,segment,segment_size-len(segment))
+            return
+        self._packet(f,timestamp,state,kind==CLIENT_CLOSED,PcapngWriter.FIN,b"",0)
+        state[2 if kind==CLIENT_CLOSED else 3]+=1
+        state[4]+=1
+        if state[4]==2:
+            del self._sessions[session_id]
+
+    def _packet(self,f,timestamp,state,c2s,flags,payload,missing):
+        """
+        Write one made-up TCP segment (Enhanced Packet Block). "missing": bytes of the payload that were not captured
+        """
+        source,destination=(state[0],state[1]) if c2s else (state[1],state[0])
+        sequence,ack=(state[2],state[3]) if c2s else (state[3],state[2])
+        tcp=struct.pack("!HHIIBBHHH",source[2],destination[2],sequence&0xffffffff,ack&0xffffffff if flags!=PcapngWriter.SYN else 0,
+                        0x50,flags,65535,0,0)
+        length=20+len(payload)+missing
+        if source[0]==socket.AF_INET:
+            ip=struct.pack("!BBHHHBBH4s4s",0x45,0,20+length,0,0,64,6,0,source[1],destination[1])
+        else:
+            ip=struct.pack("!IHBB16s16s",0x60000000,length,6,64,source[1],destination[1])
+        packet=ip+tcp+bytes(payload)
+        microseconds=int(timestamp*1000000)
+        padding=b"\x00"*(-len(packet)%4)
+        block_size=32+len(packet)+len(padding)
+        f.write(struct.pack("<IIIIIII",6,block_size,0,microseconds>>32,microseconds&0xffffffff,len(packet),len(packet)+missing))
+        f.write(packet)
+        f.write(padding)
+        f.write(struct.pack("<I",block_size))
+        if c2s:
+            state[2]+=len(payload)+missing
+        else:
+            state[3]+=len(payload)+missing
+
+
+def _parse_address(address,session_id,default_port):
+    """
+    "ip:port" -> (family , packed-ip , port). Unknown addresses get a made-up 10.x.x.x address
+    """
+    ip,colon,port=address.rpartition(":")
+    for family in (socket.AF_INET,socket.AF_INET6):
+        try:
+            return (family,socket.inet_pton(family,ip.strip("[]")),int(port))
+        except (OSError,ValueError):
+            pass
+    return (socket.AF_INET,struct.pack("!BBBB",10,(session_id>>16)&0xff,(session_id>>8)&0xff,session_id&0xff),default_port)
+
+
+def _new_state(client,server,session_id):
+    client=_parse_address(client,session_id,1024+session_id%60000)
+    server=_parse_address(server,session_id,1)
+    if client[0]!=server[0]:
+        # (both must be IPv6: an IPv4 address is mapped)
+        client,server=[ (socket.AF_INET6,b"\x00"*10+b"\xff\xff"+address[1],address[2]) if address[0]==socket.AF_INET else address
+                        for address in (client,server) ]
+    return [client,server,1,1,0]
+
+
+def read_records(path):
+    """
+    Read a "records" capture file. Yields (kind , session-id , timestamp , data , original-size)
+    """
+    with open(path,"rb") as f:
+        if f.read(len(RECORDS_MAGIC))!=RECORDS_MAGIC:
+            raise ValueError("%s is not a maproxy capture file" % path)
+        while True:
+            header=f.read(RECORD_HEADER.size)
+            if len(header)<RECORD_HEADER.size:
+                return
+            record_size,kind,session_id,timestamp,original_size=RECORD_HEADER.unpack(header)
+            data=f.read(record_size-RECORD_HEADER.size)
+            yield kind,session_id,timestamp,data,original_size
+
+
+class Capture(object):
+    """
+    Capture the sessions' data (see attach) without slowing the IOLoop down:
+    - The proxy's "read" hook copies each chunk , with the session-id , the direction and a timestamp ,
+      into a RingBuffer (a memory-map). When the ring is full , the chunk is dropped (and counted) , the
+      sessions never wait for the disk
+    - A writer thread drains the ring to rotating files: pcap-ng (for Wireshark) or length-prefixed records
+      (see read_records)
+    Only the sessions that are traced are captured (see SessionHooks: the sessions that started after attach ,
+    and set_hooks_sample_rate captures only a fraction of them).
+    The writer thread belongs to the process that created the Capture (in worker-mode , create it in each worker)
+    """
+    def __init__(self,path,format="pcapng",ring_size=64*1024*1024,snaplen=None,max_file_size=256*1024*1024,max_files=10):
+        """
+        Input Parameters:
+            path            : files prefix , e.g. "/var/tmp/proxy" -> /var/tmp/proxy-000001.pcapng , ...
+            format          : "pcapng" or "records"
+            ring_size       : (bytes) size of the ring-buffer
+            snaplen         : capture only the first "snaplen" bytes of each chunk (None: everything that fits
+                              in a quarter of the ring)
+            max_file_size   : (bytes) start a new file after this size
+            max_files       : keep only the last "max_files" files (None: keep all)
+        """
+        assert format in ("pcapng","records") , "Unknown format: %s" % format
+        self.path=path
+        self.writer=PcapngWriter() if format=="pcapng" else RecordsWriter()
+        self.ring=RingBuffer(ring_size)
+        self.snaplen=min(snaplen or ring_size,ring_size//4-RECORD_HEADER.size)
+        self.max_file_size=max_file_size
+        self.max_files=max_files
+        self._open_sessions=set()       # (proxy , session-id) that we wrote an OPEN record for
+        self._proxies=[]
+        self._files=[]
+        self._file=None
+        self._file_size=0
+        self._file_index=0
+        self._wakeup=threading.Event()
+        self._stopped=False
+        self._thread=threading.Thread(target=self._run,name="maproxy-capture")
+        self._thread.daemon=True
+        self._thread.start()
+
+        # Some statistics
+        self.captured=0         # Records in the ring
+        self.dropped=0          # Records that did not fit
+        self.dropped_bytes=0
+        self.written=0          # Records written to the files
+        self.failed=0           # Records that the writer failed to write (skipped)
+
+    def attach(self,proxy):
+        """
+        Capture the sessions of a ProxyServer (the sessions that start from now on)
+        """
+        proxy.add_hook("read",self.on_read)
+        proxy.add_hook("close",self.on_close)
+        proxy.add_hook("end",self.on_end)
+        self._proxies.append(proxy)
+
+    def detach(self,proxy):
+        proxy.remove_hook("read",self.on_read)
+        proxy.remove_hook("close",self.on_close)
+        proxy.remove_hook("end",self.on_end)
+        self._proxies.remove(proxy)
+
+    def close(self):
+        """
+        Stop capturing , write what's left in the ring and close the file
+        """
+        for proxy in list(self._proxies):
+            self.detach(proxy)
+        self._stopped=True
+        self._wakeup.set()
+        self._thread.join()
+        self.ring.close()
+
+    def get_stats(self):
+        return { "captured": self.captured, "dropped": self.dropped, "dropped_bytes": self.dropped_bytes,
+                 "written": self.written, "failed": self.failed, "ring_used": self.ring.get_used(), "files": list(self._files) }
+
+    ###########
+    ## Hooks ##
+    ###########
+    def on_read(self,session,direction,data):
+        if (session.proxy,session.session_id) not in self._open_sessions:
+            self._open(session)
+        size=len(data)
+        if size>self.snaplen:
+            data=memoryview(data)[:self.snaplen]
+        self._put(C2S if direction=="c2s" else S2C,session.session_id,data,size)
+
+    def on_close(self,session,side):
+        if (session.proxy,session.session_id) not in self._open_sessions:
+            self._open(session)
+        self._put(CLIENT_CLOSED if side=="client" else SERVER_CLOSED,session.session_id,b"",0)
+
+    def on_end(self,session):
+        self._open_sessions.discard((session.proxy,session.session_id))
+
+    def _open(self,session):
+        self._open_sessions.add((session.proxy,session.session_id))
+        server=None
+        if session.p2s_stream is not None and session.p2s_stream.socket is not None:
+            try:
+                server=session.p2s_stream.socket.getpeername()
+            except OSError:
+                pass
+        if server is None and session.target is not None and tornado.netutil.is_valid_ip(session.target[0]):
+            server=session.target
+        addresses="%s %s" % (_format_address(session.c2p_address),_format_address(server))
+        self._put(OPEN,session.session_id,addresses.encode("ascii"),len(addresses))
+
+    def _put(self,kind,session_id,data,original_size):
+        if self.ring.put(kind,session_id,time.time(),data,original_size):
+            self.captured+=1
+            if self.ring.get_used()>self.ring.size//2:
+                self._wakeup.set()
+        else:
+            self.dropped+=1
+            self.dropped_bytes+=original_size
+
+    ############
+    ## Writer ##
+    ############
+    def _run(self):
+        while True:
+            self._wakeup.wait(FLUSH_INTERVAL)
+            self._wakeup.clear()
+            stopped=self._stopped
+            records=self.ring.get()
+            if records:
+                for record in records:
+                    try:
+                        if self._file is None or self._file_size>=self.max_file_size:
+                            self._rotate()
+                        self.writer.write(self._file,*record)
+                    except Exception:
+                        # (a bad record must not stop the capture)
+                        logging.exception("maproxy: capture: failed to write a record (session %d)" % record[1])
+                        self.failed+=1
+                        continue
+                    self._file_size+=RECORD_HEADER.size+len(record[3])
+                    self.written+=1
+                if self._file is not None:
+                    self._file.flush()
+            if stopped:
+                break
+        if self._file is not None:
+            self._file.close()
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+        self._file_index+=1
+        name="%s-%06d%s" % (self.path,self._file_index,self.writer.extension)
+        self._file=open(name,"wb")
+        self._file_size=0
+        self.writer.start(self._file)
+        self._files.append(name)
+        if self.max_files is not None:
+            while len(self._files)>self.max_files:
+                try:
+                    os.remove(self._files.pop(0))
+                except OSError:
+                    pass
+
+
+def _format_address(address):
+    if address is None:
+        return ""
+    return "%s:%d" % (address[0],address[1])
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+import os
+import json
+import inspect
+import maproxy.proxyserver
+import maproxy.session
+import maproxy.httpsession
+import maproxy.mqtt
+import maproxy.sni
+import maproxy.admission
+
+
+# The config file (JSON) of the IOManager's servers (see IOManager.load_config):
+#   {"servers": {name: options , ...}}
+# The name identifies the server between reloads. The options are the ProxyServer's arguments , and:
+#   listen                  : where to listen: port , "address:port" ("[IPv6]:port") , or a list of them
+#   session_factory         : "tcp" (default) , "http" or "mqtt"
+#   session_factory_options : the session-factory's arguments
+#   admission               : the arguments of maproxy.admission.AdmissionControl
+#   sni_routes              : the routes of a maproxy.sni.SNIRouter (instead of client_ssl_options)
+# File names (certificates , keys , CAs) are relative to the config file's folder.
+
+SESSION_FACTORIES={
+    "tcp":maproxy.session.SessionFactory,
+    "http":maproxy.httpsession.HTTPSessionFactory,
+    "mqtt":maproxy.mqtt.MQTTSessionFactory,
+}
+
+# The options that are not ProxyServer arguments (see create_server)
+SERVER_OPTIONS=("listen","session_factory","session_factory_options","admission","sni_routes","mtimes")
+
+# The options that can change without replacing the server (see reconfigure_server)
+RECONFIGURABLE=maproxy.proxyserver.ProxyServer.RECONFIGURABLE+("sni_routes",)
+
+# The options that refer to certificate files , and the file-name keys in them
+SSL_OPTIONS=("client_ssl_options","server_ssl_options","sni_routes")
+FILE_KEYS=("certfile","keyfile","ca_certs")
+
+
+def load(config_file):
+    """
+    Read a config file. Returns {name: options} , the listen addresses are a list of (address,port) , the file
+    names are absolute , and options["mtimes"] keeps the modification times of the certificate files (see get_changes)
+    """
+    with open(config_file) as f:
+        config=json.load(f)
+    base_dir=os.path.dirname(os.path.abspath(config_file))
+    servers={}
+    for name,options in config.get("servers",{}).items():
+        options=dict(options)
+        for required in ("listen","target_server"):
+            if required not in options:
+                raise ValueError("%s: server %s has no %s" % (config_file,name,required))
+        unknown=set(options)-set(SERVER_OPTIONS)-set(inspect.signature(maproxy.proxyserver.ProxyServer.__init__).parameters)
+        if unknown:
+            raise ValueError("%s: server %s: unknown options %s" % (config_file,name,",".join(sorted(unknown))))
+        options["listen"]=parse_listen(options["listen"])
+        for key in ("client_ssl_options","server_ssl_options"):
+            if isinstance(options.get(key),dict):
+                options[key]=_resolve_files(options[key],base_dir)
+        if options.get("sni_routes") is not None:
+            options["sni_routes"]={ hostname: _resolve_files(route,base_dir) for hostname,route in options["sni_routes"].items() }
+        options["mtimes"]={ path: os.path.getmtime(path) for key in SSL_OPTIONS for path in _get_files(options,key) }
+        servers[name]=options
+    return servers
+
+
+def parse_listen(listen):
+    """
+    port , "port" , "address:port" ("[IPv6]:port") or a list of them -> list of (address,port)
+    """
+    if not isinstance(listen,list):
+        listen=[listen]
+    addresses=[]
+    for item in listen:
+        if isinstance(item,int):
+            addresses.append(("",item))
+            continue
+        address,separator,port=item.rpartition(":")
+        addresses.append((address.strip("[]"),int(port)))
+    return addresses
+
+
+def _resolve_files(options,base_dir):
+    options=dict(options)
+    for key in FILE_KEYS:
+        if options.get(key):
+            options[key]=os.path.join(base_dir,options[key])
+    return options
+
+
+def _get_files(options,key):
+    value=options.get(key)
+    if not isinstance(value,dict):
+        return []
+    ssl_options=list(value.values()) if key=="sni_routes" else [value]
+    return [ item[file_key] for item in ssl_options for file_key in FILE_KEYS if item.get(file_key) ]
+
+
+def get_changes(old,new):
+    """
+    The names of the options that changed between two versions of a server's options. The SSL options also
+    "change" when their certificate files were replaced (modification time)
+    """
+    changes={ key for key in set(old)|set(new) if key!="mtimes" and old.get(key)!=new.get(key) }
+    for key in SSL_OPTIONS:
+        if any( old["mtimes"].get(path)!=new["mtimes"].get(path) for path in _get_files(new,key) ):
+            changes.add(key)
+    return changes
+
+
+def create_server(options):
+    """
+    Create a ProxyServer (not listening yet) from a server's options
+    """
+    kwargs={ key: value for key,value in options.items() if key not in SERVER_OPTIONS }
+    factory=SESSION_FACTORIES[options.get("session_factory","tcp")]
+    kwargs["session_factory"]=factory(**options.get("session_factory_options",{}))
+    if options.get("admission") is not None:
+        kwargs["admission"]=maproxy.admission.AdmissionControl(**options["admission"])
+    if options.get("sni_routes") is not None:
+        kwargs["sni_router"]=maproxy.sni.SNIRouter(options["sni_routes"])
+    return maproxy.proxyserver.ProxyServer(**kwargs)
+
+
+def can_reconfigure(old,new,changes):
+    """
+    True if the changes (see get_changes) can be applied to the running server , False if it must be replaced
+    """
+    if not changes<=set(RECONFIGURABLE):
+        return False
+    # (the SNI routes can change , but not whether there's an SNI router)
+    return (old.get("sni_routes") is None)==(new.get("sni_routes") is None)
+
+
+def reconfigure_server(server,options,changes):
+    """
+    Apply the changed options (see can_reconfigure) to a running server. An option that was removed from the
+    config returns to its default value
+    """
+    parameters=inspect.signature(maproxy.proxyserver.ProxyServer.__init__).parameters
+    settings={}
+    for key in changes:
+        if key!="sni_routes":
+            default=parameters[key].default
+            settings[key]=options.get(key,None if default is inspect.Parameter.empty else default)
+    if "sni_routes" in changes:
+        # (the router reloads only the certificates that changed)
+        server.sni_router.load(options["sni_routes"])
+    server.reconfigure(**settings)
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+import time
+import collections
+import functools
+import tornado.ioloop
+import maproxy.timerwheel
+
+
+class ConnectionPool(object):
+    """
+    Pre-warmed connections to the ProxyServer's target-server.
+    - The pool keeps "size" connections ready (connected , and when the server is SSL - after the handshake),
+      so a new session can take one instead of connecting (saves 1-2 RTTs on each session).
+    - Every time a connection is taken, the pool connects a new one in the background.
+    - An idle connection that was closed by the server is removed from the pool, and idle connections
+      older than "max_idle" seconds are closed and replaced (the server/firewalls may drop them silently).
+    - If we fail to connect, we wait "retry_delay" seconds before trying again (don't hammer a dead server)
+    """
+    def __init__(self,proxy,size,max_idle=30,retry_delay=1):
+        """
+        Input Parameters:
+            proxy       : the ProxyServer (we use it to create and connect the upstream streams)
+            size        : number of ready connections to keep
+            max_idle    : (seconds) close idle connections that are older than this
+            retry_delay : (seconds) wait after a failed connect before trying again
+        """
+        self.proxy=proxy
+        self.size=size
+        self.max_idle=max_idle
+        self.retry_delay=retry_delay
+
+        self._idle=collections.deque()  # (stream,connected-time) , oldest first
+        self._connecting=set()          # streams that are not connected yet
+        self._running=False
+        self._retry_timeout=None
+        self._reap_timeout=None
+        self._ioloop=None
+
+        # Some statistics
+        self.hits=0                     # Sessions that got a ready connection
+        self.misses=0                   # Sessions that had to connect (pool was empty)
+        self.connect_failures=0
+
+    def start(self):
+        if self._running:
+            return
+        self._running=True
+        self._ioloop=tornado.ioloop.IOLoop.current()
+        self._fill()
+        self._reap_timeout=self._ioloop.add_timeout(self._ioloop.time()+self.max_idle/2.0,self._reap)
+
+    def stop(self):
+        """
+        Stop refilling and close all the idle connections (sessions that already took a connection are not affected)
+        """
+        if not self._running:
+            return
+        self._running=False
+        for timeout in (self._retry_timeout,self._reap_timeout):
+            if timeout is not None:
+                self._ioloop.remove_timeout(timeout)
+        self._retry_timeout=self._reap_timeout=None
+        streams=[ stream for stream,connected_time in self._idle ] + list(self._connecting)
+        self._idle.clear()
+        self._connecting.clear()
+        for stream in streams:
+            stream.set_close_callback(None)
+            stream.close()
+
+    def get(self):
+        """
+        Get a ready (connected) stream , or None if the pool is empty.
+        The caller owns the stream (and should set its own close-callback)
+        """
+        while self._idle:
+            stream,connected_time=self._idle.pop()  # the newest connection is the least likely to be stale
+            if stream.closed():
+                continue
+            stream.set_close_callback(None)
+            self.hits+=1
+            self._fill()
+            return stream
+        self.misses+=1
+        return None
+
+    def get_idle_count(self):
+        return len(self._idle)
+
+    def _fill(self):
+        if self._retry_timeout is not None:
+            # we're waiting after a failure
+            return
+        while self._running and len(self._idle)+len(self._connecting) < self.size:
+            self._connect()
+
+    def _connect(self):
+        stream=self.proxy.create_upstream_stream()
+        self._connecting.add(stream)
+        self.proxy.connect_upstream(stream,functools.partial(self._on_connected,stream),functools.partial(self._on_close,stream))
+
+    def _on_connected(self,stream):
+        self._connecting.discard(stream)
+        if not self._running:
+            stream.set_close_callback(None)
+            stream.close()
+            return
+        self._idle.append((stream,self._ioloop.time()))
+
+    def _on_close(self,stream):
+        if stream in self._connecting:
+            # Failed to connect. retry later
+            self._connecting.discard(stream)
+            self.connect_failures+=1
+            if self._running and self._retry_timeout is None:
+                self._retry_timeout=self._ioloop.add_timeout(self._ioloop.time()+self.retry_delay,self._retry)
+            return
+        # An idle connection was closed by the server
+        for item in self._idle:
+            if item[0] is stream:
+                self._idle.remove(item)
+                break
+        self._fill()
+
+    def _retry(self):
+        self._retry_timeout=None
+        self._fill()
+
+    def _reap(self):
+        """
+        Periodically close (and replace) idle connections that are older than max_idle
+        """
+        deadline=self._ioloop.time()-self.max_idle
+        while self._idle and self._idle[0][1] < deadline:
+            stream,connected_time=self._idle.popleft()
+            stream.set_close_callback(None)
+            stream.close()
+        self._fill()
+        self._reap_timeout=self._ioloop.add_timeout(self._ioloop.time()+self.max_idle/2.0,self._reap)
+
+
+class KeepAlivePool(object):
+    """
+    Idle keep-alive connections, per target (server,port) , that were returned by the sessions (e.g. HTTP/1.1
+    connections between requests , see maproxy.httpsession) so the next session to the same target can reuse them.
+    - The newest idle connection is reused first (the least likely to be stale)
+    - An idle connection that was closed by the server is removed from the pool
+    - Idle connections older than "max_idle" seconds are closed (checked on the shared timer-wheel)
+    """
+    def __init__(self,max_per_target=32,max_idle=5):
+        """
+        Input Parameters:
+            max_per_target  : maximum idle connections per target (the extra connections are closed)
+            max_idle        : (seconds) close the connections that are idle for longer than this
+        """
+        self.max_per_target=max_per_target
+        self.max_idle=max_idle
+        self._idle={}               # target -> deque of (stream,idle-since) , oldest first
+        self._count=0
+        self._timer=None
+
+        # Some statistics
+        self.hits=0                 # Reused connections
+        self.misses=0               # No idle connection (the session connected)
+        self.returned=0
+
+    def get(self,target):
+        """
+        An idle stream to the target , or None. The caller owns the stream (and should set its own close-callback)
+        """
+        idle=self._idle.get(target)
+        while idle:
+            stream,since=idle.pop()
+            self._count-=1
+            if stream.closed():
+                continue
+            stream.set_close_callback(None)
+            if not idle:
+                del self._idle[target]
+            self.hits+=1
+            return stream
+        self._idle.pop(target,None)
+        self.misses+=1
+        return None
+
+    def put(self,target,stream):
+        """
+        Return an idle stream (connected , no pending reads/writes) to the pool
+        """
+        idle=self._idle.setdefault(target,collections.deque())
+        if len(idle)>=self.max_per_target:
+            stream.set_close_callback(None)
+            stream.close()
+            return
+        self.returned+=1
+        stream.set_close_callback(functools.partial(self._on_close,target,stream))
+        idle.append((stream,time.time()))
+        self._count+=1
+        if self._timer is None:
+            self._timer=maproxy.timerwheel.get_wheel().add(self.max_idle/2.0,self._reap)
+
+    def get_idle_count(self):
+        return self._count
+
+    def clear(self):
+        """
+        Close all the idle connections
+        """
+        idle,self._idle=self._idle,{}
+        self._count=0
+        for streams in idle.values():
+            for stream,since in streams:
+                stream.set_close_callback(None)
+                stream.close()
+
+    def _on_close(self,target,stream):
+        # An idle connection was closed by the server
+        idle=self._idle.get(target,())
+        for item in idle:
+            if item[0] is stream:
+                idle.remove(item)
+                self._count-=1
+                break
+        if not idle:
+            self._idle.pop(target,None)
+
+    def _reap(self):
+        self._timer=None
+        deadline=time.time()-self.max_idle
+        for target,idle in list(self._idle.items()):
+            while idle and idle[0][1]<deadline:
+                stream,since=idle.popleft()
+                self._count-=1
+                stream.set_close_callback(None)
+                stream.close()
+            if not idle:
+                del self._idle[target]
+        if self._count:
+            self._timer=maproxy.timerwheel.get_wheel().add(self.max_idle/2.0,self._reap)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+import os
+import array
+import socket
+import logging
+import tornado.iostream
+import tornado.netutil
+
+
+# Listening-sockets handoff (zero-downtime upgrade) between an old and a new process , over a Unix socket:
+# 1. The old process listens on the handoff path (HandoffServer , see IOManager.enable_handoff).
+# 2. The new process connects (HandoffClient , see IOManager.takeover) and receives a copy of all the old process's
+#    listening sockets (SCM_RIGHTS). It accepts on them instead of binding new sockets. Both processes accept from
+#    the same sockets (the same kernel queue) , so no connection is refused.
+# 3. Once the new process is running it sends READY: the old process stops accepting and drains its sessions.
+#    If the new process disconnects before READY , the old process keeps going.
+
+MAGIC=b"MPXHANDOFF1\n"
+READY=b"READY\n"
+
+# The maximum number of sockets in a handoff (Linux's SCM_MAX_FD)
+MAX_SOCKETS=253
+
+
+def send_sockets(connection,sockets):
+    """
+    Send (a copy of) the sockets over a connected Unix socket
+    """
+    assert len(sockets)<=MAX_SOCKETS , "Too many sockets"
+    fds=array.array("i",[ sock.fileno() for sock in sockets ])
+    connection.sendmsg([MAGIC],[(socket.SOL_SOCKET,socket.SCM_RIGHTS,fds)] if sockets else [])
+
+
+def receive_sockets(connection):
+    """
+    Receive the sockets that were sent by send_sockets. Returns a list of (non-blocking) sockets
+    """
+    fds=array.array("i")
+    message,ancdata,flags,address=connection.recvmsg(len(MAGIC),socket.CMSG_SPACE(MAX_SOCKETS*fds.itemsize))
+    for level,kind,data in ancdata:
+        if level==socket.SOL_SOCKET and kind==socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data)-len(data)%fds.itemsize])
+    if message!=MAGIC or flags&socket.MSG_CTRUNC:
+        for fd in fds:
+            os.close(fd)
+        raise IOError("Invalid handoff message")
+    sockets=[]
+    for fd in fds:
+        sock=socket.socket(fileno=fd)
+        sock.setblocking(False)
+        sockets.append(sock)
+    return sockets
+
+
+def _get_addresses(address,port):
+    """
+    The IP addresses that a listener on (address,port) is bound to ("" is any address)
+    """
+    if not address:
+        return ("0.0.0.0","::")
+    return set( info[4][0] for info in socket.getaddrinfo(address,port,0,socket.SOCK_STREAM,0,socket.AI_PASSIVE) )
+
+
+class HandoffServer(object):
+    """
+    The old process's side: hand the listening sockets over to the process that connects to "path" , and call
+    callback() when that process is ready (then it's up to the caller to stop accepting)
+    """
+    def __init__(self,path,get_sockets,callback):
+        """
+        Input Parameters:
+            path        : the Unix socket's path
+            get_sockets : get_sockets() returns the listening sockets to hand over
+            callback    : called (once) when the new process is ready
+        """
+        self.path=path
+        self._get_sockets=get_sockets
+        self._callback=callback
+        self._streams=set()
+        self._socket=tornado.netutil.bind_unix_socket(path)
+        self._inode=os.stat(path).st_ino
+        self._remove_handler=tornado.netutil.add_accept_handler(self._socket,self._on_accept)
+
+    def close(self):
+        """
+        Stop listening on the path (and forget the new processes that are not ready yet)
+        """
+        if self._socket is None:
+            return
+        self._remove_handler()
+        self._socket.close()
+        self._socket=None
+        for stream in list(self._streams):
+            stream.close()
+        # (the next process may already listen on the same path)
+        try:
+            if os.stat(self.path).st_ino==self._inode:
+                os.unlink(self.path)
+        except OSError:
+            pass
+
+    def _on_accept(self,connection,address):
+        try:
+            send_sockets(connection,self._get_sockets())
+        except (IOError,OSError):
+            logging.exception("maproxy: listening-sockets handoff failed")
+            connection.close()
+            return
+        stream=tornado.iostream.IOStream(connection)
+        self._streams.add(stream)
+        stream.set_close_callback(lambda: self._streams.discard(stream))
+        stream.read_bytes(len(READY),lambda data: self._on_ready(stream,data))
+
+    def _on_ready(self,stream,data):
+        if data!=READY:
+            stream.close()
+            return
+        self._streams.discard(stream)
+        stream.set_close_callback(None)
+        stream.close()
+        self.close()
+        self._callback()
+
+
+class HandoffClient(object):
+    """
+    The new process's side: receive the listening sockets of the old process (see take) , and tell it when we're
+    ready (ready)
+    """
+    def __init__(self,path,timeout=10):
+        """
+        Input Parameters:
+            path    : the Unix socket's path
+            timeout : (seconds) connect/receive timeout
+        Raises IOError/OSError if there's no old process on the path
+        """
+        self._connection=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        try:
+            self._connection.settimeout(timeout)
+            self._connection.connect(path)
+            self.sockets=receive_sockets(self._connection)
+        except Exception:
+            self._connection.close()
+            raise
+
+    def take(self,port,address=""):
+        """
+        Remove (and return) the received sockets that listen on (address,port)
+        """
+        addresses=_get_addresses(address,port)
+        taken=[]
+        for sock in list(self.sockets):
+            sock_address,sock_port=sock.getsockname()[:2]
+            if sock_port==port and sock_address in addresses:
+                self.sockets.remove(sock)
+                taken.append(sock)
+        return taken
+
+    def ready(self):
+        """
+        We're accepting on the sockets that we took: close the others , and let the old process stop accepting
+        """
+        for sock in self.sockets:
+            sock.close()
+        self.sockets=[]
+        try:
+            self._connection.sendall(READY)
+        finally:
+            self._connection.close()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+import random
+import logging
+
+
+class SessionHooks(object):
+    """
+    Session events (for monitoring, tracing, debugging...) without subclassing the Session.
+    Register a callback for an event, and every traced session calls it:
+        new            : callback(session,address)          a client connected (before the session starts)
+        connect        : callback(session)                  the session is connected to the server
+        connect_failed : callback(session)                  failed to connect to the server
+        read           : callback(session,direction,data)   got data. direction is "c2s" (from the client) or "s2c"
+        write          : callback(session,direction,data)   start writing data ("c2s": to the server)
+        close          : callback(session,side)             "client" or "server" closed the connection
+        end            : callback(session)                  the session is removed
+    Tracing costs nothing when no callback is registered: the sessions are plain Session objects.
+    A traced session's class is switched to a subclass that calls the callbacks (see attach).
+    Only the sessions that start after a callback was registered are traced , and "sample_rate" lets you
+    trace only a fraction of them (so callbacks can be registered at runtime on a busy server)
+    """
+    EVENTS=("new","connect","connect_failed","read","write","close","end")
+
+    def __init__(self,sample_rate=1.0):
+        """
+        Input Parameters:
+            sample_rate : fraction (0..1) of the new sessions to trace
+        """
+        self.sample_rate=sample_rate
+        self._callbacks={}          # event -> tuple of callbacks
+
+    def add(self,event,callback):
+        assert event in SessionHooks.EVENTS , "Unknown event: %s" % event
+        self._callbacks[event]=self._callbacks.get(event,())+(callback,)
+
+    def remove(self,event,callback):
+        callbacks=tuple( c for c in self._callbacks.get(event,()) if c!=callback )
+        if callbacks:
+            self._callbacks[event]=callbacks
+        else:
+            self._callbacks.pop(event,None)
+
+    def clear(self):
+        self._callbacks={}
+
+    def is_active(self):
+        return bool(self._callbacks)
+
+    def attach(self,session):
+        """
+        Called for every new session (before it starts). Trace the session if there are callbacks and it was sampled.
+        Returns True if the session is traced
+        """
+        if not self._callbacks:
+            return False
+        if self.sample_rate<1.0 and random.random()>=self.sample_rate:
+            return False
+        session.__class__=traced_class(session.__class__)
+        return True
+
+    def emit(self,event,*args):
+        for callback in self._callbacks.get(event,()):
+            try:
+                callback(*args)
+            except Exception:
+                # A broken callback must not break the session
+                logging.exception("maproxy: %s hook failed" % event)
+
+
+_traced_classes={}      # session class -> traced class
+
+def traced_class(cls):
+    """
+    Return the traced version of a Session class: a subclass that overrides the Session's event functions,
+    calls the base function and emits the event to the proxy's hooks.
+    The subclass adds nothing to the object's layout (so a session's class can be switched) , which is why the
+    overrides call the base class directly (instead of being a mixin)
+    """
+    if getattr(cls,"traced",False):
+        return cls
+    traced=_traced_classes.get(cls)
+    if traced is not None:
+        return traced
+
+    def new_connection(self,stream,address,proxy):
+        proxy.hooks.emit("new",self,address)
+        cls.new_connection(self,stream,address,proxy)
+
+    def on_p2s_done_connect(self):
+        cls.on_p2s_done_connect(self)
+        self.proxy.hooks.emit("connect",self)
+
+    def on_c2p_done_read(self,data):
+        # Relay first (don't delay the data) , then report
+        cls.on_c2p_done_read(self,data)
+        self.proxy.hooks.emit("read",self,"c2s",data)
+
+    def on_p2s_done_read(self,data):
+        cls.on_p2s_done_read(self,data)
+        self.proxy.hooks.emit("read",self,"s2c",data)
+
+    def _p2s_io_write(self,data):
+        if data is not None:
+            self.proxy.hooks.emit("write",self,"c2s",data)
+        cls._p2s_io_write(self,data)
+
+    def _c2p_io_write(self,data):
+        if data is not None:
+            self.proxy.hooks.emit("write",self,"s2c",data)
+        cls._c2p_io_write(self,data)
+
+    def on_c2p_close(self):
+        self.proxy.hooks.emit("close",self,"client")
+        cls.on_c2p_close(self)
+
+    def on_p2s_close(self):
+        if self.p2s_state==self.State.CONNECTING:
+            self.proxy.hooks.emit("connect_failed",self)
+        else:
+            self.proxy.hooks.emit("close",self,"server")
+        cls.on_p2s_close(self)
+
+    def remove_session(self):
+        self.proxy.hooks.emit("end",self)
+        cls.remove_session(self)
+
+    traced=type("Traced"+cls.__name__,(cls,),{
+        "__slots__":(),
+        "traced":True,
+        "inspects_data":True,
+        "new_connection":new_connection,
+        "on_p2s_done_connect":on_p2s_done_connect,
+        "on_c2p_done_read":on_c2p_done_read,
+        "on_p2s_done_read":on_p2s_done_read,
+        "_p2s_io_write":_p2s_io_write,
+        "_c2p_io_write":_c2p_io_write,
+        "on_c2p_close":on_c2p_close,
+        "on_p2s_close":on_p2s_close,
+        "remove_session":remove_session,
+    })
+    _traced_classes[cls]=traced
+    return traced
+
+
+def add_logging_hooks(hooks,logger=None,level=logging.DEBUG,events=SessionHooks.EVENTS):
+    """
+    Log the sessions' events (using the "logging" module). Data is logged by size only.
+    Returns the list of (event,callback) that were added (so you can remove them)
+    """
+    logger=logger or logging.getLogger("maproxy.session")
+    def log_event(event):
+        def callback(session,*args):
+            if event in ("read","write"):
+                args=(args[0],"%d bytes" % len(args[1]))
+            logger.log(level,"%x: %s %s" % (id(session),event," ".join(str(arg) for arg in args)))
+        return callback
+    added=[]
+    for event in events:
+        callback=log_event(event)
+        hooks.add(event,callback)
+        added.append((event,callback))
+    return added
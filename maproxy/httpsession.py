@@ -0,0 +1,449 @@
+#!/usr/bin/env python
+
+import time
+import tornado.iostream
+import maproxy.proxyserver     # (imports maproxy.session)
+import maproxy.session
+import maproxy.connectionpool
+
+
+# The framing states of a message (see _Framer)
+HEAD,BODY,CHUNK_SIZE,CHUNK_DATA,TRAILER,RAW,DONE=range(7)
+
+
+class HTTPError(Exception):
+    pass
+
+
+def parse_head(data):
+    """
+    Split a message head (the start-line and the headers , up to the empty line) into
+    (list of the start-line's parts , list of (name , value) ). Raises HTTPError
+    """
+    lines=bytes(data).lstrip(b"\r\n").split(b"\r\n")
+    start_line=lines[0].split(b" ",2)
+    if len(start_line)<2:
+        raise HTTPError("Malformed start-line")
+    headers=[]
+    for line in lines[1:]:
+        if not line:
+            continue
+        if line[:1] in (b" ",b"\t"):
+            # (obsolete line folding)
+            raise HTTPError("Folded header")
+        name,colon,value=line.partition(b":")
+        if not colon or not name or name!=name.strip():
+            raise HTTPError("Malformed header")
+        headers.append((name,value.strip()))
+    return start_line,headers
+
+
+def build_head(start_line,headers):
+    return b" ".join(start_line)+b"\r\n"+b"".join( name+b": "+value+b"\r\n" for name,value in headers )+b"\r\n"
+
+
+def get_tokens(headers,name):
+    """
+    The (lowercase) comma-separated tokens of all the "name" headers (e.g. Connection , Transfer-Encoding)
+    """
+    tokens=[]
+    for header,value in headers:
+        if header.lower()==name:
+            tokens.extend( token.strip().lower() for token in value.split(b",") if token.strip() )
+    return tokens
+
+
+def get_content_length(headers):
+    """
+    The Content-Length (None if there's no such header). Raises HTTPError if it's invalid
+    """
+    lengths=set( value for name,value in headers if name.lower()==b"content-length" )
+    if not lengths:
+        return None
+    if len(lengths)>1:
+        raise HTTPError("Conflicting Content-Length")
+    value=lengths.pop()
+    if not value.isdigit():
+        raise HTTPError("Invalid Content-Length")
+    return int(value)
+
+
+def remove_hop_headers(headers,connection_tokens,keep=()):
+    """
+    Drop the hop-by-hop headers: Connection , Keep-Alive and the headers that the Connection header lists
+    """
+    hop=set(connection_tokens)
+    hop.update((b"connection",b"keep-alive"))
+    hop.difference_update(keep)
+    return [ (name,value) for name,value in headers if name.lower() not in hop ]
+
+
+class _Framer(object):
+    """
+    Where we are in the current message of one direction , and which read gets exactly the next part of it:
+    the head (up to the empty line) , a chunk-size line , the (rest of the) body or chunk.
+    The reads never go beyond the end of the message , so the connection holds nothing of the next message
+    once this one is DONE (and the server's connection can be reused)
+    """
+    __slots__=("state","remaining")
+
+    def __init__(self):
+        self.state=HEAD
+        self.remaining=0
+
+    def start_read(self,stream,callback,max_header_size):
+        state=self.state
+        if state==HEAD:
+            stream.read_until(b"\r\n\r\n",callback,max_bytes=max_header_size)
+        elif state==CHUNK_SIZE or state==TRAILER:
+            stream.read_until(b"\r\n",callback,max_bytes=max_header_size)
+        elif state==RAW:
+            stream.read_bytes(stream.read_chunk_size,callback,partial=True)
+        else:
+            stream.read_bytes(min(self.remaining,stream.read_chunk_size),callback,partial=True)
+
+    def start_body(self,chunked,length):
+        """
+        The head was read , the body is chunked , or "length" bytes , or None: until the connection is closed
+        """
+        if chunked:
+            self.state=CHUNK_SIZE
+        elif length is None:
+            self.state=RAW
+        elif length:
+            self.state=BODY
+            self.remaining=length
+        else:
+            self.state=DONE
+
+    def body_read(self,data):
+        """
+        The read (see start_read) of the message's body completed
+        """
+        state=self.state
+        if state==BODY:
+            self.remaining-=len(data)
+            if not self.remaining:
+                self.state=DONE
+        elif state==CHUNK_DATA:
+            # (the chunk's data and its CRLF)
+            self.remaining-=len(data)
+            if not self.remaining:
+                self.state=CHUNK_SIZE
+        elif state==CHUNK_SIZE:
+            try:
+                size=int(bytes(data).split(b";",1)[0].strip(),16)
+            except ValueError:
+                raise HTTPError("Invalid chunk size")
+            if size<0:
+                raise HTTPError("Invalid chunk size")
+            if size:
+                self.state=CHUNK_DATA
+                self.remaining=size+2
+            else:
+                self.state=TRAILER
+        elif state==TRAILER:
+            if data==b"\r\n":
+                self.state=DONE
+
+
+class HTTPSession(maproxy.session.Session):
+    """
+    A Session that follows HTTP/1.x requests and responses (the heads , Content-Length and chunked bodies) and
+    returns the server's connection to a per-target keep-alive pool (see HTTPSessionFactory) between requests:
+    - We connect to the server when the client's first request-head arrives , and take an idle connection to the
+      session's target from the pool if there is one
+    - Once a response is complete (and the server did not ask to close) the server's connection goes back to the
+      pool , and we read the client's next request. While we wait for a response , we don't read from the client
+      (pipelined requests wait in the client's stream)
+    - The Connection headers are rewritten: the server's connection is always keep-alive , the client's follows
+      the client (and is closed after a response that ends when the server closes)
+    - A request without a body that was sent on a reused connection , which the server closed before
+      responding (it timed-out the idle connection meanwhile) , is sent again on a new connection
+    - If the server fails (or closes) before it responds , the client gets a "502 Bad Gateway"
+    - Upgrades ("101 Switching Protocols" , e.g. WebSocket) turn the session into a plain relay
+    """
+    inspects_data=True
+    connect_on_accept=False
+
+    __slots__=("http_request","http_response","http_keepalive","http_version10","http_head_method",
+               "http_response_started","http_reusable","http_retry_head","http_requests")
+
+    def new_connection(self,stream,address,proxy):
+        self.http_request=_Framer()         # Client->Server message
+        self.http_response=_Framer()        # Server->Client message
+        self.http_keepalive=True            # Keep the client's connection after the current response
+        self.http_version10=False           # The current request is HTTP/1.0
+        self.http_head_method=False         # The current request is HEAD (the response has no body)
+        self.http_response_started=False    # We forwarded the (final) head of the current response
+        self.http_reusable=False            # The server's connection can be reused after the current response
+        self.http_retry_head=None           # The current request , if we may send it again (see on_p2s_close)
+        self.http_requests=0
+        maproxy.session.Session.new_connection(self,stream,address,proxy)
+
+    def c2p_start_read(self):
+        assert( not self.c2p_reading)
+        if self.http_request.state==DONE:
+            # (the next request is read once the response is complete)
+            return
+        self.c2p_reading=True
+        try:
+            self.http_request.start_read(self.c2p_stream,self.on_c2p_done_read,self.proxy.session_factory.max_header_size)
+        except tornado.iostream.StreamClosedError:
+            self.c2p_reading=False
+
+    def p2s_start_read(self):
+        assert( not self.p2s_reading)
+        if self.http_response.state==DONE:
+            return
+        self.p2s_reading=True
+        try:
+            self.http_response.start_read(self.p2s_stream,self.on_p2s_done_read,self.proxy.session_factory.max_header_size)
+        except tornado.iostream.StreamClosedError:
+            self.p2s_reading=False
+
+    def _filter_c2s(self,data):
+        try:
+            if self.http_request.state==HEAD:
+                return self._http_request_head(data)
+            self.http_request.body_read(data)
+        except HTTPError:
+            self.proxy.session_factory.protocol_errors+=1
+            self._http_error(b"400 Bad Request")
+            return None
+        return data
+
+    def _filter_s2c(self,data):
+        response=self.http_response
+        try:
+            if response.state==HEAD:
+                return self._http_response_head(data)
+            response.body_read(data)
+        except HTTPError:
+            self.proxy.session_factory.protocol_errors+=1
+            if self.http_response_started:
+                self.close(gracefully=False)
+            else:
+                self._http_error(b"502 Bad Gateway")
+            return None
+        return data
+
+    def on_p2s_done_read(self,data):
+        # (p2s_start_read does nothing once the response is complete)
+        maproxy.session.Session.on_p2s_done_read(self,data)
+        if self.http_response.state==DONE:
+            self._http_response_done()
+
+    def _http_request_head(self,data):
+        """
+        Parse the request's head , connect to the server (or take a pooled connection). Returns the head to send
+        """
+        start_line,headers=parse_head(data)
+        if len(start_line)!=3 or start_line[2] not in (b"HTTP/1.1",b"HTTP/1.0"):
+            raise HTTPError("Unsupported request-line")
+        connection=get_tokens(headers,b"connection")
+        self.http_version10=start_line[2]==b"HTTP/1.0"
+        self.http_keepalive=b"keep-alive" in connection if self.http_version10 else b"close" not in connection
+        self.http_head_method=start_line[0]==b"HEAD"
+        upgrade=b"upgrade" in connection
+        transfer_encoding=get_tokens(headers,b"transfer-encoding")
+        length=get_content_length(headers)
+        if transfer_encoding and transfer_encoding[-1]!=b"chunked":
+            raise HTTPError("Unsupported Transfer-Encoding")
+        modified=False
+        if transfer_encoding and length is not None:
+            # (both: the chunks win , the Content-Length must not reach the server)
+            headers=[ (name,value) for name,value in headers if name.lower()!=b"content-length" ]
+            modified=True
+        self.http_request.start_body(bool(transfer_encoding),length or 0)
+        if connection or self.http_version10:
+            # The server's connection is always keep-alive (the client's is ours to close)
+            headers=remove_hop_headers(headers,connection,keep=(b"upgrade",) if upgrade else ())
+            if upgrade:
+                headers.append((b"Connection",b"upgrade"))
+            elif self.http_version10:
+                headers.append((b"Connection",b"keep-alive"))
+            modified=True
+        head=build_head(start_line,headers) if modified else data
+
+        # A new response , and a connection to the server
+        self.http_response.state=HEAD
+        self.http_response_started=False
+        self.http_reusable=False
+        stream=self.proxy.session_factory.pool.get(self.target)
+        if stream is not None:
+            self.http_retry_head=head if self.http_request.state==DONE else None
+            self.p2s_stream=stream
+            self.p2s_stream.set_close_callback(self.on_p2s_close)
+            self.p2s_state=self.State.CONNECTING
+            self.on_p2s_done_connect()
+        else:
+            self.http_retry_head=None
+            self._http_connect()
+        return head
+
+    def _http_response_head(self,data):
+        """
+        Parse the response's head. Returns the head to send to the client
+        """
+        start_line,headers=parse_head(data)
+        if start_line[0] not in (b"HTTP/1.1",b"HTTP/1.0") or len(start_line[1])!=3 or not start_line[1].isdigit():
+            raise HTTPError("Malformed status-line")
+        status=int(start_line[1])
+        self.http_retry_head=None
+        if status==101:
+            # Switching protocols: relay both directions until one side closes
+            self.http_response_started=True
+            self.http_keepalive=False
+            self.http_response.state=RAW
+            self.http_request.state=RAW
+            if not self.c2p_reading and not self.c2p_read_paused and not self.c2p_shaped:
+                self.c2p_start_read()
+            return data
+        if status<200:
+            # (an interim response , e.g. "100 Continue" , the final head follows)
+            return data
+        self.http_response_started=True
+        connection=get_tokens(headers,b"connection")
+        if start_line[0]==b"HTTP/1.0":
+            self.http_reusable=b"keep-alive" in connection
+        else:
+            self.http_reusable=b"close" not in connection
+        response=self.http_response
+        if self.http_head_method or status==204 or status==304:
+            response.state=DONE
+        else:
+            transfer_encoding=get_tokens(headers,b"transfer-encoding")
+            if transfer_encoding and transfer_encoding[-1]==b"chunked":
+                response.start_body(True,None)
+            elif transfer_encoding:
+                response.start_body(False,None)
+            else:
+                response.start_body(False,get_content_length(headers))
+        if response.state==RAW:
+            # The body ends when the server closes the connection , so does the client's connection
+            self.http_reusable=False
+            self.http_keepalive=False
+        if connection or not self.http_keepalive or self.http_version10:
+            headers=remove_hop_headers(headers,connection)
+            if not self.http_keepalive:
+                headers.append((b"Connection",b"close"))
+            elif self.http_version10:
+                headers.append((b"Connection",b"keep-alive"))
+            return build_head(start_line,headers)
+        return data
+
+    def _http_response_done(self):
+        """
+        The response is complete: return the server's connection to the pool (or close it) , and read the
+        client's next request (or close the client's connection)
+        """
+        self.http_requests+=1
+        self.proxy.session_factory.requests+=1
+        request=self.http_request
+        self._http_release_upstream(self.http_reusable and request.state==DONE and not self.p2s_writing and not self.c2s_queued_data)
+        if self.c2p_state==self.State.CLOSED:
+            self.remove_session()
+        elif self.http_keepalive and request.state==DONE:
+            request.state=HEAD
+            self.http_response.state=HEAD
+            if not self.c2p_reading and not self.c2p_read_paused and not self.c2p_shaped:
+                self.c2p_start_read()
+        else:
+            self.c2p_start_close(gracefully=True)
+
+    def _http_connect(self):
+        self.connect_start=time.time()
+        self.p2s_connect()
+        if self.proxy.timeouts_enabled and self.proxy.connect_timeout is not None:
+            # (the session's timer is set to the new connect deadline)
+            if self.timer is not None:
+                self.proxy.get_timer_wheel().cancel(self.timer)
+            self.check_timeouts()
+
+    def _http_release_upstream(self,reuse):
+        """
+        Detach the server's connection from the session , and put it in the pool (reuse=True) or close it
+        """
+        stream=self.p2s_stream
+        self.p2s_stream=None
+        self.p2s_state=self.State.CLOSED
+        self.p2s_reading=False
+        self.p2s_writing=False
+        self.c2s_queued_data=None
+        self.c2p_read_paused=False
+        if stream is None:
+            return
+        stream.set_close_callback(None)
+        if self.proxy.admission is not None:
+            self.proxy._connect_done(stream)
+        if reuse:
+            self.proxy.session_factory.pool.put(self.target,stream)
+        else:
+            stream.close()
+
+    def _http_error(self,status):
+        """
+        Respond with an error (e.g. b"400 Bad Request") , and close the session
+        """
+        if self.c2p_state==self.State.CLOSED:
+            self.close(gracefully=False)
+            return
+        self._http_release_upstream(False)
+        self.http_keepalive=False
+        self.c2p_start_write(b"HTTP/1.1 "+status+b"\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        self.c2p_start_close(gracefully=True)
+
+    def on_p2s_close(self):
+        if self.c2p_state==self.State.CONNECTED and not self.http_response_started:
+            if self.http_retry_head is not None:
+                # A reused connection that the server closed meanwhile: send the request on a new connection
+                head=self.http_retry_head
+                self.http_retry_head=None
+                self.proxy.session_factory.retries+=1
+                self._http_release_upstream(False)
+                self._http_connect()
+                self.p2s_start_write(head)
+                return
+            self.http_keepalive=False
+            self.c2p_start_write(b"HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        elif self.http_response.state==RAW:
+            # (the response ended when the server closed the connection)
+            self.http_requests+=1
+            self.proxy.session_factory.requests+=1
+        maproxy.session.Session.on_p2s_close(self)
+
+    def get_info(self):
+        info=maproxy.session.Session.get_info(self)
+        info["requests"]=self.http_requests
+        return info
+
+
+class HTTPSessionFactory(maproxy.session.SessionFactory):
+    """
+    Creates HTTPSessions , and keeps the idle keep-alive connections to the servers
+    (maproxy.connectionpool.KeepAlivePool , shared by all the sessions of the proxy)
+    """
+    def __init__(self,max_idle_per_target=32,idle_timeout=5,max_header_size=64*1024):
+        """
+        Input Parameters:
+            max_idle_per_target : maximum idle connections per target server
+            idle_timeout        : (seconds) close the connections that are idle for longer than this. Keep it shorter
+                                  than the servers' own keep-alive timeouts
+            max_header_size     : (bytes) Close the connections that send bigger heads (or chunk-size lines)
+        """
+        super(HTTPSessionFactory,self).__init__()
+        self.pool=maproxy.connectionpool.KeepAlivePool(max_idle_per_target,idle_timeout)
+        self.max_header_size=max_header_size
+        # Some statistics
+        self.requests=0             # Completed responses
+        self.retries=0              # Requests that were sent again (the reused connection was closed)
+        self.protocol_errors=0
+
+    def new(self,*args,**kwargs):
+        return HTTPSession(*args,**kwargs)
+
+    def get_stats(self):
+        return { "requests": self.requests, "upstream_reused": self.pool.hits, "upstream_connects": self.pool.misses,
+                 "idle_upstreams": self.pool.get_idle_count(), "retries": self.retries,
+                 "protocol_errors": self.protocol_errors }
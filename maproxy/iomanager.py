@@ -2,9 +2,15 @@
 
 import tornado.tcpserver
 import threading
+import logging
+import signal
 import time
 import os
-import functools
+import maproxy.config
+import maproxy.handoff
+import maproxy.workers
+import maproxy.metrics
+import maproxy.timerwheel
 
 
     
@@ -21,6 +27,20 @@ class IOManager(object):
     def __init__(self):
         self._ioloop_thread=None
         self._servers={}     # id->server
+        self._workers=None   # maproxy.workers.WorkerPool (worker-mode only)
+        self._metrics_address=None  # (address,port) of the metrics endpoint (see enable_metrics)
+        self._metrics_server=None
+        self._metrics_labels={}     # id->server label
+        self._config_file=None      # see load_config
+        self._config={}             # name->options of the servers that were created from the config file
+        self._config_servers={}     # name->server
+        self._retired_count=0
+        self._handoff_server=None   # maproxy.handoff.HandoffServer (see enable_handoff)
+        self._handoff_drain=True
+        self._handoff_client=None   # maproxy.handoff.HandoffClient (see takeover)
+        self._workers_signals=False         # Worker-mode: we get SIGCHLD when a worker exits
+        self._previous_sigchld=None         # Worker-mode: the SIGCHLD handler that ours replaced (see stop)
+        self._workers_drained_callback=None # Worker-mode: called when all the workers exited (see stop)
         self._ioloop=tornado.ioloop.IOLoop.instance();
         
         # Some "status flags" - so external entities will be able to be notified...
@@ -38,6 +58,9 @@ class IOManager(object):
         return len(self._servers)
 
     def get_connections_count(self):
+        if self._workers:
+            # Worker-mode: the connections live in the workers
+            return self._workers.get_connections_count()
         n=0
         for id,server in self._servers.items():
             assert isinstance(server , tornado.tcpserver.TCPServer)
@@ -50,6 +73,42 @@ class IOManager(object):
     def ioloop(self):
         return self._ioloop
 
+    def enable_metrics(self,port,address="127.0.0.1"):
+        """
+        Serve the metrics of all the servers (Prometheus text format) on http://address:port/metrics .
+        Must be called before start(). The endpoint runs on the IOManager's IOLoop (in worker-mode: in the
+        parent process, and it reports the totals of all the workers)
+        """
+        self._metrics_address=(address,port)
+
+    def _restore_sigchld(self):
+        """
+        Worker-mode: put back the SIGCHLD handler that ours replaced. Only the main thread can , otherwise our
+        handler stays and just passes the signal on (and the next stop from the main thread restores it)
+        """
+        self._workers_signals=False
+        if self._previous_sigchld is not None and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGCHLD,self._previous_sigchld)
+            self._previous_sigchld=None
+
+    def _on_worker_exit(self):
+        if self._workers is None:
+            return
+        self._workers.supervise()
+        if self._workers_drained_callback is not None and not self._workers.get_workers_count():
+            self._workers_drained_callback()
+
+    def get_metrics_values(self):
+        """
+        List of (server-label , metrics values) , see maproxy.metrics
+        """
+        servers=list(self._servers.items())
+        if self._workers:
+            values=self._workers.get_metrics_values()
+        else:
+            values=[ server.get_metrics_values() for id,server in servers ]
+        return [ (self._metrics_labels.get(id,str(id)),server_values) for (id,server),server_values in zip(servers,values) ]
+
     #def add(self,server :   tornado.tcpserver.TCPServer ):
     def add(self,server ):
         """
@@ -63,17 +122,224 @@ class IOManager(object):
     def remove(self,server):
         server.stop()
         del self._servers[id(server)]
-        
+        self._metrics_labels.pop(id(server),None)
+
+    def listen(self,server,port,address=""):
+        """
+        server.listen(port,address) , or accept on the listening socket(s) that we took over from the old process
+        (see takeover)
+        """
+        sockets=self._handoff_client.take(port,address) if self._handoff_client is not None else []
+        if sockets:
+            server.add_sockets(sockets)
+        else:
+            server.listen(port,address)
+
+    ##########################
+    ## Zero-downtime upgrade ##
+    ##########################
+    def enable_handoff(self,path,drain_timeout=True):
+        """
+        Hand our listening sockets over to a new process that connects to the Unix socket "path" (see
+        maproxy.handoff and takeover). Once the new process is running, we stop accepting and stop gracefully
+        (drain_timeout , see stop) , so the clients never see a refused connection.
+        Call it before start() , after takeover() (on the same path). Not available in worker-mode
+        """
+        assert self._handoff_server is None , "Already enabled"
+        self._handoff_drain=drain_timeout
+        self._handoff_server=maproxy.handoff.HandoffServer(path,self._get_listening_sockets,self._on_handed_off)
+
+    def takeover(self,path,timeout=10):
+        """
+        Receive the listening sockets of the old process (that called enable_handoff on this path). Call it before
+        the servers listen: listen() and load_config accept on the received sockets (same address and port) instead
+        of binding new ones. Once this IOManager is started, the old process stops accepting and drains its
+        sessions , the received sockets that were not used are closed.
+        Returns the number of received sockets (0: no old process on this path). Not available in worker-mode
+        """
+        try:
+            self._handoff_client=maproxy.handoff.HandoffClient(path,timeout)
+        except (IOError,OSError):
+            return 0
+        return len(self._handoff_client.sockets)
+
+    def _get_listening_sockets(self):
+        return [ sock for server in self._servers.values() for sock in server.get_listening_sockets() ]
+
+    def _on_handed_off(self):
+        # The new process is accepting on the same sockets: stop accepting , and drain
+        self._handoff_server=None
+        for server in self._servers.values():
+            for sock in server.detach_sockets():
+                sock.close()
+        self.stop(gracefully=self._handoff_drain)
+
+    def _handoff_ready(self):
+        self._handoff_client.ready()
+        self._handoff_client=None
+
+    ###################
+    ## Configuration ##
+    ###################
+    def load_config(self,config_file,reload_signal=None):
+        """
+        Create the servers of a config file (see maproxy.config). Call it before start() , or from the IOLoop.
+        reload_signal (e.g. signal.SIGHUP): reload the config file (see reload_config) when this process gets
+        the signal (call load_config from the main thread). Not available in worker-mode
+        """
+        self._config_file=config_file
+        self.apply_config(maproxy.config.load(config_file))
+        if reload_signal is not None:
+            signal.signal(reload_signal,self._on_reload_signal)
+
+    def reload_config(self):
+        """
+        Re-read the config file and apply the changes (see apply_config)
+        """
+        if self._ioloop_thread and self._ioloop_thread.ident != threading.get_ident():
+            self._ioloop.add_callback(self.reload_config)
+            return
+        self.apply_config(maproxy.config.load(self._config_file))
+
+    def _on_reload_signal(self,signum,frame):
+        self._ioloop.add_callback_from_signal(self._reload_config_safely)
+
+    def _reload_config_safely(self):
+        try:
+            self.reload_config()
+        except Exception:
+            # (a broken config file must not stop the running servers)
+            logging.exception("maproxy: failed to reload %s" % self._config_file)
+
+    def apply_config(self,config):
+        """
+        Apply a configuration ({name: options} , see maproxy.config) , compared to the previous one:
+        - New servers are created , and start listening.
+        - The servers that were removed stop listening. Their current sessions continue until they end.
+        - Changes of the targets , the SSL options and the timeouts are applied to the running server
+          (see ProxyServer.reconfigure).
+        - Other changes replace the server. If the listen addresses didn't change, the new server takes over the
+          listening sockets (no connection is refused) , and the old one keeps its current sessions.
+        The new sessions use the new configuration , the current sessions finish with the old one.
+        All the new servers are created before anything changes , so a server with invalid options
+        doesn't leave the configuration half-applied
+        """
+        assert not self._workers , "The configuration cannot be changed in worker-mode"
+        created={}
+        changed={}
+        for name,options in config.items():
+            old=self._config.get(name)
+            if old is None:
+                created[name]=maproxy.config.create_server(options)
+                continue
+            changes=maproxy.config.get_changes(old,options)
+            if not changes:
+                continue
+            if maproxy.config.can_reconfigure(old,options,changes):
+                changed[name]=changes
+            else:
+                created[name]=maproxy.config.create_server(options)
+
+        for name,changes in changed.items():
+            maproxy.config.reconfigure_server(self._config_servers[name],config[name],changes)
+            self._config[name]=config[name]
+
+        for name,server in created.items():
+            options=config[name]
+            old_server=self._config_servers.get(name)
+            sockets=[]
+            if old_server is not None:
+                if self._config[name]["listen"]==options["listen"]:
+                    sockets=old_server.detach_sockets()
+                self._retire(name,old_server)
+            self.add(server)
+            self._metrics_labels[id(server)]=name
+            if sockets:
+                server.add_sockets(sockets)
+            else:
+                for address,port in options["listen"]:
+                    self.listen(server,port,address)
+            self._config_servers[name]=server
+            self._config[name]=options
+
+        for name in set(self._config)-set(config):
+            self._retire(name,self._config_servers.pop(name))
+            del self._config[name]
+
+    def _retire(self,name,server):
+        """
+        Stop listening , and remove the server once its current sessions end
+        """
+        server.stop()
+        if server.get_connections_count()==0:
+            self.remove(server)
+            return
+        self._retired_count+=1
+        self._metrics_labels[id(server)]="%s (retired #%d)" % (name,self._retired_count)
+
+        def drained():
+            if id(server) in self._servers and not self._stopping.is_set():
+                self.remove(server)
+        server.set_drained_callback(drained)
+
         
     
-    #def start(self,thread:bool=True ):
-    def start(self,thread=True ):
+    #def start(self,thread:bool=True,workers:int=1 ):
+    def start(self,thread=True,workers=1 ):
         """
         Start to listen on all servers, and start the IOLoop
+            thread  : True - run the IOLoop in a new thread. False - run the IOLoop in this thread (blocking call)
+            workers : number of worker processes.
+                      1 (default) : run everything in this process
+                      N           : fork N worker processes. 0/None means one worker per CPU core.
+                                    Each worker has its own IOLoop and its own SO_REUSEPORT listener for every
+                                    registered server (so all servers must be ProxyServers).
+                                    This process stops accepting connections. It supervises the workers and
+                                    restarts any worker that dies. (not available on Windows)
         """
         for id,server in self._servers.items():
             assert isinstance(server , tornado.tcpserver.TCPServer)
             server .start()
+            # Label the server's metrics with its listening address(es)
+            addresses=server.get_listen_addresses()
+            if addresses and id not in self._metrics_labels:
+                self._metrics_labels[id]=",".join( "%s:%d" % address for address in addresses )
+
+        if workers!=1:
+            assert os.name!="nt" , "Worker-mode is not supported on Windows"
+            assert self._handoff_server is None and self._handoff_client is None , "The listening-sockets handoff is not available in worker-mode"
+            self._workers=maproxy.workers.WorkerPool(list(self._servers.values()),workers)
+            self._workers.start()
+
+            # Reap (and restart) the workers as soon as they exit (SIGCHLD , only from the main thread)
+            # The previous handler still gets the signal (other children are not ours) , and stop restores it
+            if threading.current_thread() is threading.main_thread():
+                def on_sigchld(signum,frame):
+                    if self._workers_signals:
+                        self._ioloop.add_callback_from_signal(self._on_worker_exit)
+                    if callable(self._previous_sigchld):
+                        self._previous_sigchld(signum,frame)
+                if self._previous_sigchld is None:
+                    previous=signal.signal(signal.SIGCHLD,on_sigchld)
+                    self._previous_sigchld=signal.SIG_DFL if previous is None else previous
+                self._workers_signals=True
+
+            # Check (every second) for dead workers
+            def supervise():
+                if self._workers is None:
+                    return
+                self._workers.supervise()
+                self._ioloop.add_timeout( time.time()+1 , supervise)
+            self._ioloop.add_timeout( time.time()+1 , supervise)
+
+        # Listen after forking the workers (they don't need this socket)
+        if self._metrics_address:
+            address,port=self._metrics_address
+            self._metrics_server=maproxy.metrics.create_metrics_server(self.get_metrics_values,port,address)
+
+        if self._handoff_client is not None:
+            # Once we're accepting , the old process can stop
+            self._ioloop.add_callback(self._handoff_ready)
         
         if os.name=="nt":
             # On Windows, add a simple callback (freq:1sec) to display current number of connections
@@ -129,50 +395,78 @@ class IOManager(object):
         """
         if self._ioloop_thread and self._ioloop_thread.ident != threading.get_ident():
             # If called from another thread - run this procedure from the ioloop...
-            self._ioloop.add_callback ( g_IOManager.stop , gracefully=gracefully)
+            self._ioloop.add_callback ( self.stop , gracefully=gracefully)
             if wait:
                 self._ioloop_thread.join()
+                self._restore_sigchld()
             return
         assert wait is False , "You cannot run stop(wait=True) while not starting with start(thread=True)"
 
         
         self._stopping.set()
 
+        wheel=maproxy.timerwheel.get_wheel(self._ioloop)
+        timers={}       # "deadline" , "poll" (the workers' connections) -> Timer
+
         def stop_procedure():
+            if not self._stopping.is_set():
+                return  # already stopped (e.g. drained just before the deadline)
+            for timer in timers.values():
+                wheel.cancel(timer)
+            for server in self._servers.values():
+                if hasattr(server,"set_drained_callback"):
+                    server.set_drained_callback(None)
+            self._workers_drained_callback=None
+            if self._workers:
+                self._workers.terminate()
+                self._workers=None
+            self._restore_sigchld()
+            if self._handoff_server:
+                self._handoff_server.close()
+                self._handoff_server=None
+            if self._metrics_server:
+                self._metrics_server.stop()
+                self._metrics_server=None
             self._ioloop.stop()
             self._running.clear()
             self._stopping.clear()
             self._stopped.set()
 
-        def stop_if_no_connections(deadline):
-            current_time=time.time()
-            if self.get_connections_count() == 0 or (deadline and deadline-current_time<=0):
-                # No more connections , or deadline has been reached/exceeded
+        def stop_if_no_connections():
+            if self.get_connections_count() == 0:
                 stop_procedure()
-                return
-            
-            # We either need to wait 1-second (untless next-check), or less
-            wait_time=current_time+1 if deadline is None else min( current_time+1,deadline)
-            self._ioloop.add_timeout( wait_time , functools.partial(stop_if_no_connections ,deadline) )
-            
 
+        def poll_connections():
+            # The workers report their connections-count periodically , so we check it periodically
+            stop_if_no_connections()
+            if self._stopping.is_set():
+                timers["poll"]=wheel.add(1,poll_connections)
 
 
         # First, stop listening...
         for id,server in self._servers.items():
             assert isinstance(server , tornado.tcpserver.TCPServer)
             server.stop()
+        if self._workers:
+            self._workers.stop_listening()
         if not gracefully or self.get_connections_count()==0:
             stop_procedure()
             return
         
-        if gracefully is True:
-            gracefully_timeout=None # Wait forever...
-        else:
+        if gracefully is not True:
+            # (True: wait forever)
             assert( isinstance(gracefully,int) or isinstance(gracefully,float)  )
-            gracefully_timeout=time.time()+gracefully
+            timers["deadline"]=wheel.add(gracefully,stop_procedure)
 
-        self._ioloop.add_callback(stop_if_no_connections , gracefully_timeout)
+        # Stop once the last session is removed
+        if self._workers and self._workers_signals:
+            # Each worker exits once it has no more connections (see _on_worker_exit)
+            self._workers_drained_callback=stop_procedure
+        elif self._workers or not all( hasattr(server,"set_drained_callback") for server in self._servers.values() ):
+            timers["poll"]=wheel.add(1,poll_connections)
+        else:
+            for server in self._servers.values():
+                server.set_drained_callback(stop_if_no_connections)
                 
 
 
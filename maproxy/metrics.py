@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+import bisect
+import functools
+import tornado.iostream
+import tornado.tcpserver
+
+
+class ProxyMetrics(object):
+    """
+    Counters of one ProxyServer.
+    The sessions update the counters directly (a plain attribute increment on the read path), everything
+    else (gauges, the histogram's cumulative buckets , the text format) is computed when the metrics are read.
+    """
+    __slots__=("accepted_sessions","bytes_c2s","bytes_s2c","connect_failures","rejected_sessions","rejected_rate",
+               "connect_timeouts","idle_timeouts","lifetime_timeouts",
+               "duration_buckets","duration_sum","duration_count")
+
+    # Upper bounds (seconds) of the session-duration histogram buckets (+Inf is implied)
+    DURATION_BUCKETS=(0.01,0.1,1,10,60,300,1800,3600)
+
+    def __init__(self):
+        self.accepted_sessions=0        # Sessions since startup
+        self.bytes_c2s=0                # Bytes read from the clients (sent to the servers)
+        self.bytes_s2c=0                # Bytes read from the servers (sent to the clients)
+        self.connect_failures=0         # Sessions that failed to connect to the server
+        self.rejected_sessions=0        # Connections rejected by the admission control: the server was full
+        self.rejected_rate=0            # Connections rejected by the admission control: client's connection-rate
+        self.connect_timeouts=0         # Sessions closed by the timeouts (see ProxyServer's *_timeout)
+        self.idle_timeouts=0
+        self.lifetime_timeouts=0
+        self.duration_buckets=[0]*(len(ProxyMetrics.DURATION_BUCKETS)+1)   # per-bucket (not cumulative) counts
+        self.duration_sum=0.0
+        self.duration_count=0
+
+    def session_ended(self,duration):
+        self.duration_buckets[bisect.bisect_left(ProxyMetrics.DURATION_BUCKETS,duration)]+=1
+        self.duration_sum+=duration
+        self.duration_count+=1
+
+
+# The metrics of a server as a flat list of numbers (see ProxyServer.get_metrics_values) , so the values of a few
+# workers can be summed up. The histogram buckets follow these fields
+FIELDS=("active_sessions","queued_bytes_c2s","queued_bytes_s2c","accepted_sessions","bytes_c2s","bytes_s2c",
+        "connect_failures","rejected_sessions","rejected_rate",
+        "connect_timeouts","idle_timeouts","lifetime_timeouts","duration_sum","duration_count")
+VALUES_COUNT=len(FIELDS)+len(ProxyMetrics.DURATION_BUCKETS)+1
+GAUGES_COUNT=3      # The first fields are gauges (current state) , the rest are counters
+
+# name , type , help , value-fields (field,label) . one line per field
+METRICS=(
+    ("maproxy_active_sessions","gauge","Current sessions",
+        (("active_sessions",None),)),
+    ("maproxy_accepted_sessions_total","counter","Accepted sessions",
+        (("accepted_sessions",None),)),
+    ("maproxy_bytes_total","counter","Bytes relayed",
+        (("bytes_c2s",'direction="c2s"'),("bytes_s2c",'direction="s2c"'))),
+    ("maproxy_connect_failures_total","counter","Sessions that failed to connect to the server",
+        (("connect_failures",None),)),
+    ("maproxy_rejected_connections_total","counter","Connections rejected by the admission control",
+        (("rejected_sessions",'reason="full"'),("rejected_rate",'reason="client_rate"'))),
+    ("maproxy_timeouts_total","counter","Sessions closed by a timeout",
+        (("connect_timeouts",'timeout="connect"'),("idle_timeouts",'timeout="idle"'),("lifetime_timeouts",'timeout="lifetime"'))),
+    ("maproxy_queued_bytes","gauge","Bytes queued (waiting to be written)",
+        (("queued_bytes_c2s",'direction="c2s"'),("queued_bytes_s2c",'direction="s2c"'))),
+)
+
+
+def add_values(total,values):
+    """
+    Add a values list to another (in place)
+    """
+    for i,value in enumerate(values):
+        total[i]+=value
+    return total
+
+
+def _format_value(value):
+    if isinstance(value,float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+def _escape_label(value):
+    """
+    A label value in the text format: backslash , double-quote and line feed are escaped
+    """
+    return str(value).replace("\\","\\\\").replace('"','\\"').replace("\n","\\n")
+
+
+def render(servers):
+    """
+    Prometheus text format (version 0.0.4) of a list of (server-label , values-list)
+    """
+    servers=[ (_escape_label(label),values) for label,values in servers ]
+    lines=[]
+    for name,metric_type,help_text,fields in METRICS:
+        lines.append("# HELP %s %s" % (name,help_text))
+        lines.append("# TYPE %s %s" % (name,metric_type))
+        for label,values in servers:
+            for field,extra_label in fields:
+                labels='server="%s"' % label
+                if extra_label:
+                    labels+=","+extra_label
+                lines.append("%s{%s} %s" % (name,labels,_format_value(values[FIELDS.index(field)])))
+
+    name="maproxy_session_duration_seconds"
+    lines.append("# HELP %s Session duration" % name)
+    lines.append("# TYPE %s histogram" % name)
+    for label,values in servers:
+        cumulative=0
+        buckets=values[len(FIELDS):]
+        for bound,count in zip(ProxyMetrics.DURATION_BUCKETS+("+Inf",),buckets):
+            cumulative+=count
+            lines.append('%s_bucket{server="%s",le="%s"} %s' % (name,label,bound,_format_value(cumulative)))
+        lines.append('%s_sum{server="%s"} %s' % (name,label,_format_value(values[FIELDS.index("duration_sum")])))
+        lines.append('%s_count{server="%s"} %s' % (name,label,_format_value(values[FIELDS.index("duration_count")])))
+    return "\n".join(lines)+"\n"
+
+
+class MetricsServer(tornado.tcpserver.TCPServer):
+    """
+    A minimal HTTP/1.0 server: "GET /metrics" returns the metrics (one request per connection).
+        collect : function that returns a list of (server-label , values-list)
+    """
+    def __init__(self,collect,*args,**kwargs):
+        self.collect=collect
+        super(MetricsServer,self).__init__(*args,**kwargs)
+
+    def handle_stream(self,stream,address):
+        try:
+            stream.read_until(b"\r\n\r\n",functools.partial(self._on_request,stream),max_bytes=65536)
+        except tornado.iostream.StreamClosedError:
+            pass
+
+    def _on_request(self,stream,request):
+        request_line=request.split(b"\r\n",1)[0].split()
+        if len(request_line)>=2 and request_line[0] in (b"GET",b"HEAD") and request_line[1].split(b"?")[0]==b"/metrics":
+            status="200 OK"
+            body=render(self.collect()).encode()
+        else:
+            status="404 Not Found"
+            body=b"Not Found\n"
+        headers="HTTP/1.0 %s\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" % (status,len(body))
+        if request_line[:1]==[b"HEAD"]:
+            body=b""
+        try:
+            stream.write(headers.encode()+body,callback=stream.close)
+        except tornado.iostream.StreamClosedError:
+            pass
+
+
+def create_metrics_server(collect,port,address="127.0.0.1"):
+    """
+    Create a (listening) HTTP server that serves the metrics on /metrics
+        collect : function that returns a list of (server-label , values-list)
+    """
+    server=MetricsServer(collect)
+    server.listen(port,address)
+    return server
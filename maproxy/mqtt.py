@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+
+import time
+import maproxy.proxyserver     # (imports maproxy.session)
+import maproxy.session
+
+
+# Control packet types (the high nibble of the fixed header's first byte)
+CONNECT,PUBLISH,PINGREQ,PINGRESP=1,3,12,13
+PINGREQ_FRAME=b"\xc0\x00"
+PINGRESP_FRAME=b"\xd0\x00"
+
+
+class MQTTError(Exception):
+    pass
+
+
+def parse_remaining_length(buffer,pos):
+    """
+    Decode the fixed header's "remaining length" (1-4 bytes , 7 bits each) at buffer[pos].
+    Returns (length , number of bytes) , or None if the buffer ends before the length does
+    """
+    length=0
+    for i in range(4):
+        if pos+i>=len(buffer):
+            return None
+        byte=buffer[pos+i]
+        length|=(byte&0x7f)<<(7*i)
+        if not byte&0x80:
+            return length,i+1
+    raise MQTTError("Malformed remaining length")
+
+
+def parse_connect(frame,header_size):
+    """
+    Returns (client-id , keepalive , offset of the keepalive in the frame) of a CONNECT frame (MQTT 3.1 , 3.1.1 , 5)
+    """
+    try:
+        pos=header_size
+        pos+=2+int.from_bytes(frame[pos:pos+2],"big")      # protocol name
+        level=frame[pos]
+        keepalive_offset=pos+2                              # (after the level and the connect-flags)
+        keepalive=int.from_bytes(frame[keepalive_offset:keepalive_offset+2],"big")
+        pos=keepalive_offset+2
+        if level==5:
+            length,size=parse_remaining_length(frame,pos)  # properties (same encoding)
+            pos+=size+length
+        client_id_length=int.from_bytes(frame[pos:pos+2],"big")
+        client_id=bytes(frame[pos+2:pos+2+client_id_length]).decode("utf-8","replace")
+    except (IndexError,TypeError):
+        raise MQTTError("Malformed CONNECT")
+    return client_id,keepalive,keepalive_offset
+
+
+class MQTTClientStats(object):
+    """
+    Message counters of one MQTT client-id (while it's connected)
+    """
+    __slots__=("sessions","messages","publishes","bytes","since")
+
+    def __init__(self,now):
+        self.sessions=0
+        self.messages=0         # Control packets from the client (PINGREQs included)
+        self.publishes=0
+        self.bytes=0
+        self.since=now
+
+    def get_stats(self,now):
+        elapsed=max(now-self.since,1e-6)
+        return { "messages": self.messages, "publishes": self.publishes, "bytes": self.bytes,
+                 "messages_per_sec": self.messages/elapsed, "publishes_per_sec": self.publishes/elapsed }
+
+
+class MQTTSession(maproxy.session.Session):
+    """
+    A Session that understands MQTT framing (the fixed headers) as the data streams through:
+    - PINGREQs from the client are answered locally (PINGRESP) and are not forwarded
+    - The upstream connection is kept alive by the proxy: if nothing was forwarded to the broker for a while
+      (see MQTTSessionFactory's upstream_keepalive) we send our own PINGREQ , and drop the broker's PINGRESP
+    - The client's keepalive is enforced locally: no packet for 1.5 times the keepalive closes the session
+      (like the broker would)
+    - Only whole frames are forwarded to the broker , all the frames of a read in one write
+    - The messages of each client-id are counted (see MQTTSessionFactory.get_client_stats)
+    Data from the broker is only scanned for frame boundaries (to find the PINGRESPs of our PINGREQs)
+    """
+    inspects_data=True
+
+    __slots__=("mqtt_buffer","mqtt_s2c_skip","mqtt_s2c_header","mqtt_client_id","mqtt_keepalive",
+               "mqtt_upstream_keepalive","mqtt_pings_pending","mqtt_pingresps_pending","mqtt_last_c2s",
+               "mqtt_last_upstream","mqtt_timer","mqtt_stats")
+
+    def new_connection(self,stream,address,proxy):
+        self.mqtt_buffer=None           # Partial frame from the client
+        self.mqtt_s2c_skip=0            # Bytes left of the broker's current frame
+        self.mqtt_s2c_header=None       # Partial fixed-header from the broker
+        self.mqtt_client_id=None
+        self.mqtt_keepalive=0
+        self.mqtt_upstream_keepalive=0
+        self.mqtt_pings_pending=0       # Our PINGREQs that the broker did not answer yet
+        self.mqtt_pingresps_pending=0   # Local PINGRESPs waiting for the end of the broker's current frame
+        self.mqtt_last_c2s=self.mqtt_last_upstream=time.time()
+        self.mqtt_timer=None
+        self.mqtt_stats=None
+        maproxy.session.Session.new_connection(self,stream,address,proxy)
+
+    def _filter_c2s(self,data):
+        try:
+            frames=self._mqtt_c2s(data)
+        except MQTTError:
+            self.proxy.session_factory.protocol_errors+=1
+            self.close(gracefully=False)
+            return None
+        if frames:
+            self.mqtt_last_upstream=self.mqtt_last_c2s
+        return frames
+
+    def _filter_s2c(self,data):
+        try:
+            return self._mqtt_s2c(data)
+        except MQTTError:
+            self.proxy.session_factory.protocol_errors+=1
+            self.close(gracefully=False)
+            return None
+
+    def _mqtt_c2s(self,data):
+        """
+        Split the client's data into frames. Returns the (whole) frames to forward to the broker
+        """
+        factory=self.proxy.session_factory
+        if self.mqtt_buffer is None:
+            buffer=data
+        else:
+            buffer=self.mqtt_buffer
+            buffer+=data
+        self.mqtt_last_c2s=time.time()
+        forward=None
+        modified=False  # (False: forward the buffer's whole frames as they are)
+        pos=0
+        while pos<len(buffer):
+            remaining=parse_remaining_length(buffer,pos+1)
+            if remaining is None:
+                break
+            length,size=remaining
+            if length>factory.max_frame_size:
+                raise MQTTError("Frame too large (%d bytes)" % length)
+            end=pos+1+size+length
+            if end>len(buffer):
+                break
+            packet_type=buffer[pos]>>4
+            if self.mqtt_stats is not None:
+                self.mqtt_stats.messages+=1
+                self.mqtt_stats.bytes+=end-pos
+            if packet_type==PINGREQ:
+                factory.pings_answered+=1
+                if self.mqtt_s2c_skip==0 and self.mqtt_s2c_header is None:
+                    self.c2p_start_write(PINGRESP_FRAME)
+                else:
+                    # A broker frame is partly forwarded: answer once it ends (see _mqtt_s2c)
+                    self.mqtt_pingresps_pending+=1
+                if not modified:
+                    forward=bytearray(buffer[:pos])
+                    modified=True
+            elif packet_type==CONNECT and self.mqtt_client_id is None:
+                if not modified:
+                    forward=bytearray(buffer[:pos])
+                    modified=True
+                forward+=self._on_connect(bytearray(buffer[pos:end]),1+size)
+            else:
+                if packet_type==PUBLISH and self.mqtt_stats is not None:
+                    self.mqtt_stats.publishes+=1
+                if modified:
+                    forward+=buffer[pos:end]
+            pos=end
+        if not modified:
+            forward=buffer[:pos] if pos<len(buffer) else buffer
+        # Keep the partial frame for the next read
+        self.mqtt_buffer=bytearray(buffer[pos:]) if pos<len(buffer) else None
+        return forward
+
+    def _on_connect(self,frame,header_size):
+        factory=self.proxy.session_factory
+        client_id,keepalive,keepalive_offset=parse_connect(frame,header_size)
+        self.mqtt_client_id=client_id or "%s:%d" % self.c2p_address[:2]
+        self.mqtt_keepalive=keepalive
+        self.mqtt_stats=factory.client_connected(self.mqtt_client_id)
+        self.mqtt_stats.messages+=1
+        self.mqtt_stats.bytes+=len(frame)
+        # The broker's keepalive (the proxy pings the broker , not the client)
+        upstream_keepalive=factory.upstream_keepalive
+        if upstream_keepalive is None:
+            upstream_keepalive=keepalive
+        self.mqtt_upstream_keepalive=upstream_keepalive
+        frame[keepalive_offset:keepalive_offset+2]=upstream_keepalive.to_bytes(2,"big")
+        self._mqtt_set_timer()
+        return frame
+
+    def _mqtt_s2c(self,data):
+        """
+        Follow the broker's frames (skip the payloads). Returns the data to forward to the client:
+        everything but the PINGRESPs of our own PINGREQs , plus the local PINGRESPs that waited for
+        a frame boundary
+        """
+        if self.mqtt_s2c_header is not None:
+            data=self.mqtt_s2c_header+data
+            self.mqtt_s2c_header=None
+        skip=self.mqtt_s2c_skip
+        if skip>=len(data):
+            self.mqtt_s2c_skip=skip-len(data)
+            if skip==len(data) and self.mqtt_pingresps_pending:
+                data=bytearray(data)
+                data+=PINGRESP_FRAME*self.mqtt_pingresps_pending
+                self.mqtt_pingresps_pending=0
+            return data
+        output=None     # (None: forward all the data)
+        pos=skip
+        if self.mqtt_pingresps_pending:
+            # The first frame boundary: the local PINGRESPs go here
+            output=bytearray(data[:pos])
+            output+=PINGRESP_FRAME*self.mqtt_pingresps_pending
+            self.mqtt_pingresps_pending=0
+        while pos<len(data):
+            remaining=parse_remaining_length(data,pos+1)
+            if remaining is None:
+                # Keep the partial header for the next read
+                self.mqtt_s2c_header=bytearray(data[pos:])
+                self.mqtt_s2c_skip=0
+                return data[:pos] if output is None else output
+            length,size=remaining
+            end=pos+1+size+length
+            if data[pos]>>4==PINGRESP and self.mqtt_pings_pending:
+                # Our PINGRESP: cut it out
+                self.mqtt_pings_pending-=1
+                if output is None:
+                    output=bytearray(data[:pos])
+            elif output is not None:
+                output+=data[pos:end]
+            pos=end
+        self.mqtt_s2c_skip=pos-len(data)
+        return data if output is None else output
+
+    def _mqtt_set_timer(self):
+        intervals=[ keepalive for keepalive in (self.mqtt_keepalive,self.mqtt_upstream_keepalive) if keepalive ]
+        if intervals:
+            self.mqtt_timer=self.proxy.get_timer_wheel().add(min(intervals)/4.0,self._mqtt_keepalive_check)
+
+    def _mqtt_keepalive_check(self):
+        self.mqtt_timer=None
+        factory=self.proxy.session_factory
+        now=time.time()
+        if self.mqtt_keepalive and now-self.mqtt_last_c2s>1.5*self.mqtt_keepalive:
+            # The client is gone (no packet , not even a PINGREQ)
+            factory.keepalive_timeouts+=1
+            self.close(gracefully=False)
+            return
+        if (self.mqtt_upstream_keepalive and self.p2s_state==self.State.CONNECTED and
+                now-self.mqtt_last_upstream>=0.75*self.mqtt_upstream_keepalive):
+            factory.pings_sent+=1
+            self.mqtt_pings_pending+=1
+            self.mqtt_last_upstream=now
+            self.p2s_start_write(PINGREQ_FRAME)
+        self._mqtt_set_timer()
+
+    def remove_session(self):
+        if self.mqtt_timer is not None:
+            self.proxy.get_timer_wheel().cancel(self.mqtt_timer)
+            self.mqtt_timer=None
+        if self.mqtt_client_id is not None:
+            self.proxy.session_factory.client_disconnected(self.mqtt_client_id)
+        self.mqtt_stats=None
+        maproxy.session.Session.remove_session(self)
+
+
+class MQTTSessionFactory(maproxy.session.SessionFactory):
+    """
+    Creates MQTTSessions , and keeps the per-client-id counters and the keepalive statistics
+    """
+    def __init__(self,upstream_keepalive=None,max_frame_size=1024*1024):
+        """
+        Input Parameters:
+            upstream_keepalive  : (seconds) The keepalive that the proxy asks from the broker (the CONNECT is
+                                  rewritten) , the proxy pings the broker when the link is idle.
+                                  None: the client's keepalive. A longer keepalive means fewer PINGREQs upstream ,
+                                  the clients' keepalive is enforced by the proxy anyway. 0 disables the broker's keepalive
+            max_frame_size      : (bytes) Close the clients that send bigger frames (we buffer partial frames)
+        """
+        super(MQTTSessionFactory,self).__init__()
+        self.upstream_keepalive=upstream_keepalive
+        self.max_frame_size=max_frame_size
+        self._clients={}            # client-id -> MQTTClientStats
+        # Some statistics
+        self.pings_answered=0       # Client PINGREQs that we answered
+        self.pings_sent=0           # Our PINGREQs to the brokers
+        self.keepalive_timeouts=0   # Clients that did not send anything within 1.5*keepalive
+        self.protocol_errors=0
+
+    def new(self,*args,**kwargs):
+        return MQTTSession(*args,**kwargs)
+
+    def client_connected(self,client_id):
+        stats=self._clients.get(client_id)
+        if stats is None:
+            stats=self._clients[client_id]=MQTTClientStats(time.time())
+        stats.sessions+=1
+        return stats
+
+    def client_disconnected(self,client_id):
+        stats=self._clients.get(client_id)
+        if stats is not None:
+            stats.sessions-=1
+            if stats.sessions<=0:
+                del self._clients[client_id]
+
+    def get_client_stats(self,client_id=None):
+        """
+        Message counters and rates (messages/sec since the client connected) of a client-id ,
+        or of all the connected clients (dictionary: client-id -> stats)
+        """
+        now=time.time()
+        if client_id is not None:
+            stats=self._clients.get(client_id)
+            return stats.get_stats(now) if stats is not None else None
+        return { client_id:stats.get_stats(now) for client_id,stats in self._clients.items() }
+
+    def get_stats(self):
+        return { "clients": len(self._clients), "pings_answered": self.pings_answered, "pings_sent": self.pings_sent,
+                 "keepalive_timeouts": self.keepalive_timeouts, "protocol_errors": self.protocol_errors }
@@ -1,7 +1,28 @@
 #!/usr/bin/env python
 import tornado
 import tornado.tcpserver
+import tornado.ioloop
+import tornado.iostream
+import tornado.netutil
+import socket
+import ssl
+import functools
+import time
 import maproxy.session
+import maproxy.connectionpool
+import maproxy.tls
+import maproxy.sni
+import maproxy.balancer
+import maproxy.resolver
+import maproxy.metrics
+import maproxy.hooks
+import maproxy.splice
+import maproxy.aioengine
+import maproxy.tlsoffload
+import maproxy.registry
+import maproxy.shaping
+import maproxy.admission
+import maproxy.timerwheel
 
 
 
@@ -15,12 +36,26 @@ class ProxyServer(tornado.tcpserver.TCPServer):
                  target_server,target_port,
                  client_ssl_options=None,server_ssl_options=None,
                  session_factory=maproxy.session.SessionFactory(),
+                 buffer_high_watermark=1024*1024,buffer_low_watermark=None,
+                 max_write_batch=256*1024,
+                 connection_pool_size=0,connection_pool_max_idle=30,
+                 sni_router=None,
+                 balancer="round-robin",health_check_interval=None,
+                 resolver=None,
+                 hooks=None,
+                 engine="stream",
+                 rate_limits=None,
+                 admission=None,
+                 connect_timeout=None,idle_timeout=None,lifetime_timeout=None,
+                 tls_offload=None,
                  *args,**kwargs):
         """
         ProxyServer initializer function (constructor) .
         Input Parameters:
-            target_server           : the proxied-server IP
-            target_port             : the proxied-server port
+            target_server           : the proxied-server IP , a (server,port) pair , or a list of proxied-servers
+                                      (backends) to balance between: "server" , "server:port" ("[IPv6]:port")
+                                      or (server,port)
+            target_port             : the proxied-server port (of the servers that don't specify a port)
             client_ssl_options      : Configure this proxy as SSL terminator  (decrypt all data).
                                       Standard Tornado's SSL options dictionary
                                       (e.g.: keyfile and certfile to specify Server-Certificate)
@@ -29,22 +64,103 @@ class ProxyServer(tornado.tcpserver.TCPServer):
                                       2. False/None: disalbe SSL
                                       3. Standard Tornado's SSL options dictionary
                                          (e.g.: keyfile and certfile to specify Client-Certificate)
+                                      4. ssl.SSLContext
+                                      The proxy builds one SSL context at startup (shared by all the sessions), and
+                                      caches the TLS-sessions so new connections can resume them (abbreviated handshake)
+            buffer_high_watermark   : Flow-control (per session, per direction): when more than this number of bytes
+                                      are queued towards one side, stop reading from the other side.
+                                      None means unlimited buffering (no flow-control)
+            buffer_low_watermark    : Resume reading once the queue is drained to this number of bytes
+                                      (default: half of the buffer_high_watermark)
+            max_write_batch         : While a write is in progress, newer data is queued. When the write completes
+                                      all the queued data is sent with a single write of up to this number of bytes.
+                                      None means no limit
+            connection_pool_size    : Keep this number of ready (connected, after SSL handshake) connections to the
+                                      target server, so new sessions don't have to wait for the connection.
+                                      0 (default) disables the pool
+            connection_pool_max_idle: (seconds) Pooled connections that were not used for this time are replaced
+            sni_router              : maproxy.sni.SNIRouter . SSL listener that selects the certificate and the target
+                                      server according to the hostname that the client requested (SNI).
+                                      (instead of client_ssl_options). target_server/target_port are used for
+                                      routes that don't specify a target
+            balancer                : How to select a backend for each session (when target_server is a list):
+                                      "round-robin" , "least-connections" , "ewma-latency" (connect-time moving
+                                      average) , or a maproxy.balancer.Balancer subclass
+            health_check_interval   : (seconds) Periodically connect to each backend, and take the failing
+                                      backends out of rotation. None (default) disables the health-checks
+            resolver                : How to resolve target-server names (without blocking the IOLoop):
+                                      None (default): maproxy.resolver.CachingResolver with the default settings
+                                      maproxy.resolver.CachingResolver instance (can be shared by a few servers)
+                                      False: let the socket resolve (blocking) on every connection
+            hooks                   : maproxy.hooks.SessionHooks , session-events callbacks (can be shared by a few
+                                      servers). By default the server has its own (empty) hooks , see add_hook
+            engine                  : How the sessions relay the data:
+                                      "stream" (default): Tornado's IOStreams
+                                      "splice": plain TCP->TCP only (Linux , Python 3.10+). Once connected, the data
+                                      moves between the sockets inside the kernel (os.splice) , see maproxy.splice.
+                                      "asyncio": plain TCP->TCP only (Tornado 5+). The sessions relay the data with
+                                      asyncio Protocols/Transports (on uvloop , see maproxy.aioengine.use_uvloop) .
+                                      Traced sessions (hooks) use the streams
+            rate_limits             : Bandwidth shaping (token-buckets) per session , per client IP and per server ,
+                                      for each direction. e.g. {"session":{"c2s":100*1024} , "server":{"s2c":10*1024*1024}}
+                                      (bytes/sec) , see maproxy.shaping.Shaper. None (default): no limits.
+                                      In worker-mode the server's and the client's limits are per worker
+            admission               : maproxy.admission.AdmissionControl , overload protection at accept-time:
+                                      maximum sessions , maximum server-connections in progress , new connections/sec
+                                      per client IP (the connections over the limits are queued briefly or rejected).
+                                      None (default): no limits. In worker-mode the limits are per worker
+            connect_timeout         : (seconds) Close the sessions that are not connected to the server after this time
+            idle_timeout            : (seconds) Close the sessions that did not relay any data for this time.
+                                      (checked lazily: an idle session is closed after 1-2 times the idle_timeout)
+            lifetime_timeout        : (seconds) Close the sessions that are older than this.
+                                      The timeouts are checked on a shared maproxy.timerwheel.TimerWheel ,
+                                      None (default) means no timeout
+            tls_offload             : Run the SSL handshakes (of both sides) on a thread-pool instead of the IOLoop
+                                      (see maproxy.tlsoffload): the number of threads , or a
+                                      concurrent.futures.Executor (can be shared by a few servers).
+                                      None (default): the handshakes run on the IOLoop
             args,kwargs             : will be passed directly to the Tornado engine
         """
         assert(session_factory , issubclass(session_factory.__class__,maproxy.session.SessionFactory))
         self.session_factory=session_factory
 
+        # The settings that can be changed later (see reconfigure)
+        self._settings=dict(target_server=target_server,target_port=target_port,
+                            balancer=balancer,health_check_interval=health_check_interval,
+                            client_ssl_options=client_ssl_options,server_ssl_options=server_ssl_options,
+                            connect_timeout=connect_timeout,idle_timeout=idle_timeout,lifetime_timeout=lifetime_timeout)
+
         
         # First, get the server's address and port . 
-        # This is the proxied server that we'll connect to
-        self.target_server=target_server
-        self.target_port=target_port
+        # This is the proxied server that we'll connect to.
+        # If there are a few servers (backends), the target is the first one and the balancer selects
+        # a backend for each session
+        self.backends=maproxy.balancer.parse_backends(target_server,target_port)
+        self.target_server,self.target_port=self.backends[0].address
+        if not isinstance(balancer,type):
+            balancer=maproxy.balancer.BALANCERS[balancer]
+        self.balancer=balancer(self.backends)
+
+        # Non-blocking (and cached) DNS resolution of the target-server(s)
+        if resolver is None:
+            resolver=maproxy.resolver.CachingResolver()
+        self.resolver=resolver or None
+
+        self.health_checker=None
+        if health_check_interval:
+            self.health_checker=maproxy.balancer.HealthChecker(self.backends,health_check_interval,resolver=self.resolver)
         
         # Now, remember the SSL potions
         # client_ssl_options : use it if you want an SSL listener (if you want that the proxy will have an SSL listener)
         # server_ssl_options:  use it if you want an SSL connection to the proxy server (if your target server is SSL)
         self.client_ssl_options=client_ssl_options
         self.server_ssl_options=server_ssl_options
+
+        # SNI-Router: the listening SSL context is the router's context
+        self.sni_router=sni_router
+        if sni_router is not None:
+            assert not client_ssl_options , "Use either client_ssl_options or sni_router"
+            self.client_ssl_options=sni_router.context
         
         # Nromalize SSL options:
         # If the server is SSL, the tornado expects a dictionary, so let's change the True to {}
@@ -56,8 +172,73 @@ class ProxyServer(tornado.tcpserver.TCPServer):
         if self.client_ssl_options is False:
             self.client_ssl_options=None
 
-        # Session-List
-        self.SessionsList=[]
+        # Build the SSL context of the Proxy->Server connections once (instead of once per connection)
+        self.server_ssl_context=self._create_server_ssl_context(self.server_ssl_options)
+
+        # Flow-control watermarks (bytes queued per direction)
+        if buffer_low_watermark is None and buffer_high_watermark is not None:
+            buffer_low_watermark=buffer_high_watermark//2
+        assert buffer_high_watermark is None or buffer_low_watermark <= buffer_high_watermark
+        self.buffer_high_watermark=buffer_high_watermark
+        self.buffer_low_watermark=buffer_low_watermark
+        self.max_write_batch=max_write_batch
+
+        # Relay engine
+        assert engine in ("stream","splice","asyncio") , "Unknown engine: %s" % engine
+        if engine=="splice":
+            assert maproxy.splice.is_supported() , "The splice engine requires Linux and Python 3.10+"
+            assert self.client_ssl_options is None and self.server_ssl_context is None , "The splice engine is TCP->TCP only"
+            assert not connection_pool_size , "The splice engine does not support the connection-pool"
+            assert not rate_limits , "The splice engine does not support rate-limits"
+        if engine=="asyncio":
+            assert maproxy.aioengine.is_supported() , "The asyncio engine requires Tornado 5+ and Python 3.6+"
+            assert self.client_ssl_options is None and self.server_ssl_context is None , "The asyncio engine is TCP->TCP only"
+            assert not connection_pool_size , "The asyncio engine does not support the connection-pool"
+        self.engine=engine
+
+        # SSL handshakes thread-pool (optional)
+        if isinstance(tls_offload,int):
+            tls_offload=maproxy.tlsoffload.create_executor(tls_offload)
+        if tls_offload is not None:
+            assert engine=="stream" , "tls_offload requires the stream engine"
+            assert maproxy.tlsoffload.is_supported() , "tls_offload requires Tornado 5.x"
+            if self.server_ssl_context is not None:
+                maproxy.tlsoffload.prepare_context(self.server_ssl_context,
+                                                   owned=not isinstance(self.server_ssl_options,ssl.SSLContext))
+        self.tls_executor=tls_offload
+        self._listener_ssl_context=None    # (options , context) , see _get_listener_ssl_context
+
+        # Bandwidth shaping (optional)
+        self.shaper=maproxy.shaping.Shaper(rate_limits) if rate_limits else None
+
+        # Admission control (optional)
+        self.admission=admission
+        if admission is not None:
+            admission.bind(self)
+
+        # Timeouts (see Session.check_timeouts)
+        self.connect_timeout=connect_timeout
+        self.idle_timeout=idle_timeout
+        self.lifetime_timeout=lifetime_timeout
+        self.timeouts_enabled=any( timeout is not None for timeout in (connect_timeout,idle_timeout,lifetime_timeout) )
+        self._connecting=set()      # Server-connections in progress (counted by the admission control)
+        self.drained_callback=None  # Called when the last session is removed (see set_drained_callback)
+        self._listening=False       # Accepting connections (see add_sockets , stop , detach_sockets)
+
+        # Pre-warmed connections to the target-server (optional)
+        self.connection_pool=None
+        if connection_pool_size:
+            assert len(self.backends)==1 , "The connection-pool requires a single target server"
+            self.connection_pool=maproxy.connectionpool.ConnectionPool(self,connection_pool_size,connection_pool_max_idle)
+
+        # The sessions (see maproxy.registry)
+        self.sessions=maproxy.registry.SessionRegistry()
+
+        # Counters (see maproxy.metrics)
+        self.metrics=maproxy.metrics.ProxyMetrics()
+
+        # Session-events callbacks
+        self.hooks=hooks if hooks is not None else maproxy.hooks.SessionHooks()
         
         # call Tornado's Engine . pass args/kwargs directly
         super(ProxyServer,self).__init__(ssl_options=self.client_ssl_options,*args,**kwargs)
@@ -65,23 +246,486 @@ class ProxyServer(tornado.tcpserver.TCPServer):
     
         
         
+    def add_sockets(self,sockets):
+        """
+        Start accepting connections on the given sockets (listen/start call this function).
+        This is also when we start filling the connection-pool (in worker-mode, each worker has its own pool)
+        """
+        super(ProxyServer,self).add_sockets(sockets)
+        self._listening=True
+        if self.connection_pool:
+            self.connection_pool.start()
+        if self.health_checker:
+            self.health_checker.start()
+
+    def stop(self):
+        """
+        Stop listening (current sessions are not affected) , and close the pooled connections
+        """
+        super(ProxyServer,self).stop()
+        self._listening=False
+        if self.connection_pool:
+            self.connection_pool.stop()
+        if self.health_checker:
+            self.health_checker.stop()
+
+    @staticmethod
+    def _create_server_ssl_context(server_ssl_options):
+        if server_ssl_options is None or isinstance(server_ssl_options,ssl.SSLContext):
+            return server_ssl_options
+        return maproxy.tls.create_client_context(server_ssl_options)
+
+    # The settings that reconfigure() can change while the server is running
+    RECONFIGURABLE=("target_server","target_port","balancer","health_check_interval",
+                    "client_ssl_options","server_ssl_options",
+                    "connect_timeout","idle_timeout","lifetime_timeout")
+
+    def reconfigure(self,**settings):
+        """
+        Change some of the settings (see RECONFIGURABLE , same values as the constructor) of a running server , the
+        settings that are not specified don't change. Everything is validated before anything changes.
+        The new sessions use the new settings. The current sessions finish with their target and their server
+        connection (and its SSL context) , the new timeouts apply to them from their next check.
+        Specifying server_ssl_options rebuilds the Proxy->Server SSL context (e.g. the certificate files were replaced)
+        """
+        unknown=set(settings)-set(self.RECONFIGURABLE)
+        assert not unknown , "Cannot reconfigure: %s" % ",".join(sorted(unknown))
+        new_settings=dict(self._settings,**settings)
+
+        backends=maproxy.balancer.parse_backends(new_settings["target_server"],new_settings["target_port"])
+        balancer=new_settings["balancer"]
+        if not isinstance(balancer,type):
+            balancer=maproxy.balancer.BALANCERS[balancer]
+        client_ssl_options=new_settings["client_ssl_options"] or None
+        server_ssl_options=new_settings["server_ssl_options"]
+        if server_ssl_options is True:
+            server_ssl_options={}
+        if server_ssl_options is False:
+            server_ssl_options=None
+        if self.sni_router is not None:
+            assert client_ssl_options is None , "Use either client_ssl_options or sni_router"
+            client_ssl_options=self.sni_router.context
+        if self.engine!="stream":
+            assert client_ssl_options is None and server_ssl_options is None , "The %s engine is TCP->TCP only" % self.engine
+        if self.connection_pool is not None:
+            assert len(backends)==1 , "The connection-pool requires a single target server"
+        if isinstance(client_ssl_options,dict):
+            # (raises if the certificate files are missing or invalid)
+            tornado.netutil.ssl_options_to_context(client_ssl_options)
+        server_ssl_context=self.server_ssl_context
+        if "server_ssl_options" in settings:
+            server_ssl_context=self._create_server_ssl_context(server_ssl_options)
+            if self.tls_executor is not None and server_ssl_context is not None:
+                maproxy.tlsoffload.prepare_context(server_ssl_context,
+                                                   owned=not isinstance(server_ssl_options,ssl.SSLContext))
+
+        # Keep the backends (their statistics and health) that are still targets.
+        # The current sessions keep their Backend objects , so the old ones are still counted when they end
+        listening=self._listening
+        current={ backend.address: backend for backend in self.backends }
+        backends=[ current.pop(backend.address,backend) for backend in backends ]
+        targets_changed=[ backend.address for backend in backends ]!=[ backend.address for backend in self.backends ]
+        self.backends=backends
+        self.target_server,self.target_port=backends[0].address
+        if targets_changed or balancer is not type(self.balancer):
+            self.balancer=balancer(backends)
+        if self.health_checker:
+            self.health_checker.stop()
+            self.health_checker=None
+        if new_settings["health_check_interval"]:
+            self.health_checker=maproxy.balancer.HealthChecker(backends,new_settings["health_check_interval"],resolver=self.resolver)
+            if listening:
+                self.health_checker.start()
+
+        # The listener's SSL options are used for the next accepted connections (Tornado's ssl_options)
+        self.client_ssl_options=self.ssl_options=client_ssl_options
+        self.server_ssl_options=server_ssl_options
+        if targets_changed or server_ssl_context is not self.server_ssl_context:
+            self.server_ssl_context=server_ssl_context
+            if self.connection_pool is not None:
+                # The pooled connections belong to the old target (or SSL context)
+                self.connection_pool.stop()
+                if listening:
+                    self.connection_pool.start()
+
+        self.connect_timeout=new_settings["connect_timeout"]
+        self.idle_timeout=new_settings["idle_timeout"]
+        self.lifetime_timeout=new_settings["lifetime_timeout"]
+        self.timeouts_enabled=any( timeout is not None for timeout in (self.connect_timeout,self.idle_timeout,self.lifetime_timeout) )
+        self._settings=new_settings
+
+    def detach_sockets(self):
+        """
+        Stop accepting connections without closing the listening sockets , and return them (e.g. so another server
+        will accept on them , see add_sockets). The current sessions are not affected
+        """
+        self._listening=False
+        return self._forget_sockets()
+
+    def _forget_sockets(self):
+        """
+        Stop accepting on the listening sockets , and forget them (without closing them). Returns the sockets.
+        (the only place that changes the TCPServer's private listeners state , see detach_sockets and
+        listen_reuse_port)
+        """
+        sockets=list(self._sockets.values())
+        # (stop already removed the handlers of the sockets that it closed)
+        for remove_handler in self._handlers.values():
+            remove_handler()
+        self._sockets={}
+        self._handlers={}
+        # (so stop works again , on the next sockets)
+        self._stopped=False
+        return sockets
+
+    def create_upstream_stream(self):
+        """
+        Create a new (not connected yet) stream to the target server.
+        If the "server_ssl_options" where specified, it means that when we connect, we need to wrap with SSL
+        so we need to use the SSLIOStream stream
+        """
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+        if self.tls_executor is not None and self.server_ssl_context is not None:
+            stream = maproxy.tlsoffload.OffloadSSLIOStream(s,self.tls_executor,ssl_options=self.server_ssl_context)
+        elif isinstance(self.server_ssl_context,maproxy.tls.ClientSSLContext):
+            stream = maproxy.tls.ClientSSLIOStream(s,ssl_options=self.server_ssl_context)
+        elif self.server_ssl_context is not None:
+            stream = tornado.iostream.SSLIOStream(s,ssl_options=self.server_ssl_context)
+        else:
+            # use the standard IOStream stream
+            stream = tornado.iostream.IOStream(s)
+        # send data immediately to the server... (Disable Nagle TCP algorithm)
+        stream.set_nodelay(True)
+        return stream
+
+    def connect_upstream(self,stream,callback,close_callback,target=None,backend=None):
+        """
+        Connect a stream (see create_upstream_stream) to the target server (or to another target: (server,port) ).
+        callback() is called once the stream is connected (for SSL: after the handshake)
+        close_callback is set as the stream's close-callback once we start connecting (an idle stream with a
+        close-callback polls its socket, which is not connected yet while the server's name is being resolved).
+        It's called if we fail to resolve or to connect.
+        backend: the selected maproxy.balancer.Backend (if any), we measure its connect-time for the balancer
+        """
+        if self.admission is not None:
+            self.admission.connect_started()
+            self._connecting.add(stream)
+            callback=functools.partial(self._on_connect_done,stream,callback)
+            close_callback=functools.partial(self._on_connect_done,stream,close_callback)
+        if backend is not None:
+            callback=functools.partial(self._on_backend_connected,backend,time.time(),callback)
+        if isinstance(self.server_ssl_context,maproxy.tls.ClientSSLContext):
+            callback=functools.partial(self._on_upstream_handshake,stream,callback)
+        server,port=target or (self.target_server,self.target_port)
+        if self.resolver is None or tornado.netutil.is_valid_ip(server):
+            stream.connect((server,port),callback)
+            stream.set_close_callback(close_callback)
+        else:
+            self.resolver.resolve(server,port,functools.partial(self._on_upstream_resolved,stream,callback,close_callback,server))
+
+    def _on_connect_done(self,stream,callback):
+        self._connect_done(stream)
+        callback()
+
+    def _connect_done(self,stream):
+        """
+        The connection is not "in progress" anymore (connected , failed , or closed by us while connecting)
+        """
+        if stream in self._connecting:
+            self._connecting.discard(stream)
+            self.admission.connect_done()
+
+    def _on_upstream_resolved(self,stream,callback,close_callback,server,address):
+        if stream.closed():
+            # Closed by us while resolving
+            if self.admission is not None:
+                self._connect_done(stream)
+            return
+        if address is None:
+            # Failed to resolve. closing the stream is just like a failed connect (the close-callback is called)
+            stream.set_close_callback(close_callback)
+            stream.close()
+            return
+        # (For SSL: send the server's name, SNI)
+        stream.connect(address,callback,server_hostname=server)
+        stream.set_close_callback(close_callback)
+
+    def _on_backend_connected(self,backend,start_time,callback):
+        self.balancer.connected(backend,time.time()-start_time)
+        callback()
+
+    def _on_upstream_handshake(self,stream,callback):
+        target=self.server_ssl_context.handshake_done(maproxy.tlsoffload.get_ssl_object(stream),stream.socket.getpeername())
+        if target is not None:
+            # TLS 1.3: the session-ticket arrives after the handshake. Try again once we've read from the socket
+            self._store_tls_session(stream,target,0.05)
+        callback()
+
+    def _store_tls_session(self,stream,target,delay):
+        """
+        Try to cache the TLS-session in "delay" seconds. If it's still not available, try again later (up to ~1 second)
+        """
+        def store():
+            if stream.closed() or self.server_ssl_context.store_session(target,maproxy.tlsoffload.get_ssl_object(stream)):
+                return
+            if delay < 1:
+                self._store_tls_session(stream,target,delay*4)
+        ioloop=tornado.ioloop.IOLoop.current()
+        ioloop.add_timeout(ioloop.time()+delay,store)
+
+    def get_tls_stats(self):
+        """
+        Proxy->Server SSL statistics: handshakes counts and session-resumption hit-rate (or None if not SSL)
+        """
+        if not isinstance(self.server_ssl_context,maproxy.tls.ClientSSLContext):
+            return None
+        return self.server_ssl_context.get_stats()
+
+    def _handle_connection(self,connection,address):
+        """
+        (Tornado's TCPServer) With tls_offload , the SSL listener's streams do their handshake on the thread-pool
+        """
+        if self.tls_executor is None or self.ssl_options is None:
+            return super(ProxyServer,self)._handle_connection(connection,address)
+        stream=maproxy.tlsoffload.OffloadSSLIOStream(connection,self.tls_executor,server_side=True,
+                                                     ssl_options=self._get_listener_ssl_context(),
+                                                     max_buffer_size=self.max_buffer_size,
+                                                     read_chunk_size=self.read_chunk_size)
+        self.handle_stream(stream,address)
+
+    def _get_listener_ssl_context(self):
+        # Build the listener's context once (Tornado builds one per connection out of an options dictionary)
+        options=self.ssl_options
+        if isinstance(options,ssl.SSLContext):
+            return options
+        if self._listener_ssl_context is None or self._listener_ssl_context[0] is not options:
+            self._listener_ssl_context=(options,tornado.netutil.ssl_options_to_context(options))
+        return self._listener_ssl_context[1]
+
     def handle_stream(self, stream, address):
         """
         The proxy will call this function for every new connection as a callback
         This is the Session starting point: we initiate a new session and add it to the sessions-list
         """
         assert isinstance(stream,tornado.iostream.IOStream)
+        if self.admission is not None and not self.admission.admit(stream,address):
+            return
+        self._accept(stream,address)
+
+    def _accept(self,stream,address):
+        if self.sni_router is not None:
+            # We need the SNI hostname in order to select the target, so we wait for the handshake
+            # (if the handshake fails, the stream is closed and we'll never get the callback)
+            timer=None
+            if self.admission is not None:
+                # (the connection takes a session's slot during the handshake , up to the handshake_timeout)
+                self.admission.handshake_started()
+                if self.admission.handshake_timeout is not None:
+                    timer=self.get_timer_wheel().add(self.admission.handshake_timeout,
+                                                     functools.partial(self._on_handshake_timeout,stream))
+                stream.set_close_callback(functools.partial(self._on_handshake_failed,timer))
+            stream.wait_for_handshake(functools.partial(self._on_handshake,stream,address,timer))
+            return
+        self.start_session(stream,address)
+
+    def _on_handshake(self,stream,address,timer):
+        if self.admission is not None:
+            if stream.closed():
+                # (the close-callback frees the slot)
+                return
+            stream.set_close_callback(None)
+            if timer is not None:
+                self.get_timer_wheel().cancel(timer)
+            self.admission.handshake_done()
+        self.start_session(stream,address)
+
+    def _on_handshake_timeout(self,stream):
+        # (the close-callback frees the slot)
+        self.admission.handshake_timeouts+=1
+        stream.close()
+
+    def _on_handshake_failed(self,timer):
+        if timer is not None:
+            self.get_timer_wheel().cancel(timer)
+        self.admission.handshake_done()
+        self.admission.release()
+
+    def start_session(self,stream,address):
+        """
+        Create a new session for the (accepted) stream , and add it to the sessions-list
+        """
         #session=maproxy.session.Session(stream,address,self)
         session=self.session_factory.new()   # Use the factory to create new session
+        self.metrics.accepted_sessions+=1
+        self.hooks.attach(session)
         session.new_connection(stream,address,self)
-        self.SessionsList.append(session)
+        self.sessions.add(session)
+        if self.shaper is not None:
+            self.shaper.session_started(session)
+        if self.timeouts_enabled:
+            session.check_timeouts()
+
+    def add_hook(self,event,callback):
+        """
+        Call "callback" on a session event (see maproxy.hooks.SessionHooks). Affects the sessions that start from now on
+        """
+        self.hooks.add(event,callback)
+
+    def remove_hook(self,event,callback):
+        self.hooks.remove(event,callback)
+
+    def set_hooks_sample_rate(self,sample_rate):
+        """
+        Trace only a fraction (0..1) of the new sessions
+        """
+        self.hooks.sample_rate=sample_rate
+
+    def get_target(self,session):
+        """
+        Select the target server (server,port) of a new session:
+        The SNI route of the client's stream (if it specifies a target), otherwise the balancer selects
+        one of the backends. The selected maproxy.balancer.Backend (or None) is kept as session.backend
+        """
+        if self.sni_router is not None:
+            route=maproxy.sni.get_route(maproxy.tlsoffload.get_ssl_object(session.c2p_stream))
+            if route is not None and route.target_server is not None:
+                return (route.target_server,route.target_port or self.target_port)
+        session.backend=self.balancer.select()
+        return session.backend.address
+
+    def get_backends_stats(self):
+        """
+        Per-backend statistics (list of dictionaries)
+        """
+        return [ backend.get_stats() for backend in self.backends ]
 
     def remove_session(self,session):
         assert (  isinstance(session, maproxy.session.Session) )
         assert ( session.p2s_state==maproxy.session.Session.State.CLOSED )
         assert ( session.c2p_state ==maproxy.session.Session.State.CLOSED )
-        self.SessionsList.remove(session)
+        self.sessions.remove(session)
+        if session.timer is not None:
+            self.get_timer_wheel().cancel(session.timer)
+            session.timer=None
+        if self.shaper is not None:
+            self.shaper.session_ended(session)
+        self.metrics.session_ended(time.time()-session.start_time)
+        if session.backend is not None:
+            self.balancer.session_ended(session.backend)
+        if self.admission is not None:
+            self._connect_done(session.p2s_stream)
         self.session_factory.delete(session)
+        if self.admission is not None:
+            self.admission.release()
+        if self.drained_callback is not None and not self.sessions:
+            self.drained_callback()
 
     def get_connections_count(self):
-        return len(self.SessionsList)
+        return len(self.sessions)
+
+    def get_timer_wheel(self):
+        """
+        The TimerWheel of the sessions' timeouts (shared by all the servers of this IOLoop)
+        """
+        return maproxy.timerwheel.get_wheel()
+
+    def set_drained_callback(self,callback):
+        """
+        Call callback() when the last session is removed (e.g. a graceful stop). None cancels
+        """
+        self.drained_callback=callback
+
+    def get_admission_stats(self):
+        """
+        Admission control statistics: admitted/queued/rejected connections (or None if there are no limits)
+        """
+        if self.admission is None:
+            return None
+        return self.admission.get_stats()
+
+    @property
+    def SessionsList(self):
+        """
+        (backward compatibility) list of the current sessions , see "sessions"
+        """
+        return list(self.sessions)
+
+    ################
+    ## Management ##
+    ################
+    def get_sessions_info(self,client_ip=None,target=None):
+        """
+        Details of the current sessions (list of dictionaries , see Session.get_info) ,
+        all the sessions or only the sessions of a client IP / to a target ( (server,port) or a Backend )
+        """
+        return [ session.get_info() for session in self._find_sessions(client_ip,target) ]
+
+    def close_session(self,session_id,gracefully=False):
+        """
+        Close one session. Returns False if there's no such session
+        """
+        session=self.sessions.get(session_id)
+        if session is None:
+            return False
+        session.close(gracefully)
+        return True
+
+    def close_sessions(self,client_ip=None,target=None,gracefully=False):
+        """
+        Close all the sessions (or only the sessions of a client IP / to a target). Returns the number of sessions
+        """
+        sessions=self._find_sessions(client_ip,target)
+        for session in sessions:
+            session.close(gracefully)
+        return len(sessions)
+
+    def _find_sessions(self,client_ip=None,target=None):
+        if client_ip is not None:
+            sessions=self.sessions.find_by_client(client_ip)
+            if target is not None:
+                target_sessions=set(self.sessions.find_by_target(target))
+                sessions=[ session for session in sessions if session in target_sessions ]
+            return sessions
+        if target is not None:
+            return self.sessions.find_by_target(target)
+        return list(self.sessions)
+
+    def get_metrics_values(self):
+        """
+        The server's metrics as a list of numbers (the order of maproxy.metrics.FIELDS , followed by the
+        session-duration histogram buckets)
+        """
+        metrics=self.metrics
+        queued_c2s=queued_s2c=0
+        for session in self.sessions:
+            if session.c2s_queued_data is not None:
+                queued_c2s+=len(session.c2s_queued_data)
+            if session.s2c_queued_data is not None:
+                queued_s2c+=len(session.s2c_queued_data)
+        return [ len(self.sessions),queued_c2s,queued_s2c,metrics.accepted_sessions,metrics.bytes_c2s,
+                 metrics.bytes_s2c,metrics.connect_failures,metrics.rejected_sessions,metrics.rejected_rate,
+                 metrics.connect_timeouts,metrics.idle_timeouts,metrics.lifetime_timeouts,
+                 metrics.duration_sum,metrics.duration_count
+               ] + metrics.duration_buckets
+
+    def get_listen_addresses(self):
+        """
+        Return the (address,port) of each listening socket
+        """
+        return [ sock.getsockname()[:2] for sock in self._sockets.values() ]
+
+    def get_listening_sockets(self):
+        """
+        The listening sockets (see detach_sockets , maproxy.handoff)
+        """
+        return list(self._sockets.values())
+
+    def listen_reuse_port(self,addresses):
+        """
+        Worker-mode (see maproxy.workers): listen on the given (address,port) list using SO_REUSEPORT sockets
+        that belong to this process. The listeners that were inherited from the parent process were
+        already closed (stop) by the parent, so we simply forget them.
+        """
+        self._forget_sockets()
+        for address,port in addresses:
+            self.add_sockets(tornado.netutil.bind_sockets(port,address,reuse_port=True))
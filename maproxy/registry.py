@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+
+class SessionRegistry(object):
+    """
+    The sessions of a ProxyServer , indexed by:
+        session-id          : a running number , assigned when the session is added (session.session_id)
+        client IP           : the IP of session.c2p_address
+        target              : session.target , (server,port) of the backend the session is connected to
+    Adding and removing a session is O(1) (the old sessions-list made a mass disconnect quadratic)
+    """
+    def __init__(self):
+        self._sessions={}       # session-id -> session (oldest first)
+        self._by_client={}      # client IP -> set of sessions
+        self._by_target={}      # (server,port) -> set of sessions
+        self._next_id=1
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __iter__(self):
+        return iter(self._sessions.values())
+
+    def __contains__(self,session):
+        return self._sessions.get(getattr(session,"session_id",None)) is session
+
+    def add(self,session):
+        """
+        Register a session , and assign its session_id
+        """
+        session.session_id=self._next_id
+        self._next_id+=1
+        self._sessions[session.session_id]=session
+        self._by_client.setdefault(session.c2p_address[0],set()).add(session)
+        self._by_target.setdefault(session.target,set()).add(session)
+        return session.session_id
+
+    def remove(self,session):
+        del self._sessions[session.session_id]
+        _discard(self._by_client,session.c2p_address[0],session)
+        _discard(self._by_target,session.target,session)
+
+    def get(self,session_id):
+        """
+        The session with this id (None if there's no such session)
+        """
+        return self._sessions.get(session_id)
+
+    def find_by_client(self,ip,port=None):
+        """
+        The sessions of a client IP (and port , if specified)
+        """
+        sessions=self._by_client.get(ip,())
+        if port is None:
+            return list(sessions)
+        return [ session for session in sessions if session.c2p_address[1]==port ]
+
+    def find_by_target(self,target):
+        """
+        The sessions to a target: (server,port) , or a maproxy.balancer.Backend
+        """
+        if hasattr(target,"address"):
+            target=target.address
+        return list(self._by_target.get(tuple(target),()))
+
+
+def _discard(index,key,session):
+    sessions=index.get(key)
+    if sessions is not None:
+        sessions.discard(session)
+        if not sessions:
+            del index[key]
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+import socket
+import logging
+import functools
+import tornado.ioloop
+import tornado.netutil
+
+
+class CachingResolver(object):
+    """
+    Resolve the target-server names without blocking the IOLoop (connecting to a hostname makes the socket
+    call getaddrinfo, which blocks all the sessions while DNS is slow).
+    - The resolution itself is done by a Tornado resolver: by default in a thread-pool, but any
+      tornado.netutil.Resolver can be used (e.g. tornado.platform.caresresolver.CaresResolver for async DNS)
+    - The answers are cached for "ttl" seconds
+    - Concurrent lookups of the same name share one resolution
+    - If the resolution fails, we serve the last good answer (if we have one) for up to "max_stale" seconds
+    """
+    def __init__(self,resolver=None,ttl=60,max_stale=3600,family=socket.AF_INET):
+        """
+        Input Parameters:
+            resolver  : tornado.netutil.Resolver instance (default: resolve in a thread-pool)
+            ttl       : (seconds) how long to cache an answer
+            max_stale : (seconds) how long (after the ttl) we may serve an answer when the resolver fails
+            family    : address family (the proxy connects with AF_INET sockets)
+        """
+        self._resolver=resolver
+        self.ttl=ttl
+        self.max_stale=max_stale
+        self.family=family
+        self._cache={}          # (host,port) -> (address,expiration-time)
+        self._pending={}        # (host,port) -> list of callbacks waiting for this resolution
+
+        # Statistics
+        self.hits=0             # Answered from the cache
+        self.misses=0           # Had to resolve (or wait for a resolution in progress)
+        self.stale_hits=0       # Resolution failed, answered with a stale answer
+        self.failures=0         # Resolution failed (no answer)
+
+    def get_resolver(self):
+        # Created on first use (so in worker-mode each worker creates its own thread-pool)
+        if self._resolver is None:
+            if hasattr(tornado.netutil,"DefaultExecutorResolver"):
+                self._resolver=tornado.netutil.DefaultExecutorResolver()
+            else:
+                self._resolver=tornado.netutil.ThreadedResolver()
+        return self._resolver
+
+    def resolve(self,host,port,callback):
+        """
+        Resolve host:port. callback(address) is called with an (ip,port) address , or None on failure.
+        If the answer is cached, the callback is called immediately
+        """
+        key=(host,port)
+        ioloop=tornado.ioloop.IOLoop.current()
+        entry=self._cache.get(key)
+        if entry is not None and entry[1] > ioloop.time():
+            self.hits+=1
+            callback(entry[0])
+            return
+        self.misses+=1
+        waiting=self._pending.get(key)
+        if waiting is not None:
+            # A resolution is in progress, wait for it
+            waiting.append(callback)
+            return
+        self._pending[key]=[callback]
+        future=self.get_resolver().resolve(host,port,self.family)
+        ioloop.add_future(future,functools.partial(self._on_resolved,key))
+
+    def _on_resolved(self,key,future):
+        now=tornado.ioloop.IOLoop.current().time()
+        address=None
+        try:
+            addresses=future.result()
+            if addresses:
+                address=addresses[0][1]
+        except Exception:
+            pass
+        if address is not None:
+            self._cache[key]=(address,now+self.ttl)
+        else:
+            entry=self._cache.get(key)
+            if entry is not None and entry[1]+self.max_stale > now:
+                self.stale_hits+=1
+                address=entry[0]
+            else:
+                self.failures+=1
+                self._cache.pop(key,None)
+        for callback in self._pending.pop(key):
+            # (one failing waiter must not leave the others waiting)
+            try:
+                callback(address)
+            except Exception:
+                logging.exception("maproxy: resolver callback failed (%s:%s)" % key[:2])
+
+    def get_stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale_hits": self.stale_hits,
+            "failures": self.failures,
+            "cached_names": len(self._cache),
+        }
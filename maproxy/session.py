@@ -1,11 +1,66 @@
 #!/usr/bin/env python
 
+import time
 import tornado
-import socket
 import maproxy.proxyserver
+import maproxy.splice
+import maproxy.aioengine
 
 
 
+class WriteQueue(object):
+    """
+    The data that is waiting to be written to one side of the session.
+    Instead of a list of chunks (one IOStream.write and one callback round-trip per chunk), the queued chunks
+    are joined into a single bytearray. When the current write completes, everything that is pending is sent
+    with a single write (capped by the proxy's "max_write_batch").
+    A "close request" (None) is not data, it is kept as a flag and is handled after all the data was written.
+    """
+    __slots__=("buffer","close_pending")
+
+    def __init__(self):
+        self.buffer=bytearray()
+        self.close_pending=False
+
+    def __len__(self):
+        # Number of queued bytes
+        return len(self.buffer)
+
+    def __bool__(self):
+        return self.close_pending or len(self.buffer)>0
+
+    def append(self,data):
+        """
+        Queue data (bytes) or a close-request (None)
+        """
+        if data is None:
+            self.close_pending=True
+        elif not self.close_pending:
+            self.buffer+=data
+
+    def pop(self,max_bytes=None):
+        """
+        Get (and remove) the next batch of data: all the queued data, but no more than max_bytes.
+        Returns None if there's no more data and a close was requested
+        """
+        buffer=self.buffer
+        if not buffer:
+            self.close_pending=False
+            return None
+        if max_bytes is None or len(buffer) <= max_bytes:
+            # Hand the entire buffer to the caller (no copy) and start a new one.
+            # (a bytearray: Tornado 5.x's IOStream.write accepts it , see the "tornado >= 5.0" requirement)
+            self.buffer=bytearray()
+            return buffer
+        data=bytes(memoryview(buffer)[:max_bytes])
+        del buffer[:max_bytes]
+        return data
+
+    def clear(self):
+        self.buffer=bytearray()
+        self.close_pending=False
+
+
 class Session(object):
     """
     The Session class if the heart of the system.
@@ -28,51 +83,88 @@ class Session(object):
         - on_XXX_close:
           When one side closes the connection, we either initiate a "start_close" on the other side, or (if already closed) - remove the session
     - I/O routings:
-        - XXX_start_read: simply start read from the socket (we assume and validate that only one read goes at a time)
+        - XXX_start_read: start read (one chunk) from the socket (we assume and validate that only one read goes at a time).
+                          When the read completes we start the next read, unless reading was paused (see below)
         - XXX_start_write: if currently writing , add data to queue. if not writing - perform io_write...
+    - Flow-Control (backpressure):
+        Each direction has its own queue (c2s_queued_data, s2c_queued_data). When a queue grows beyond the
+        proxy's "buffer_high_watermark" we pause reading from the source of this data, and when the peer
+        drains the queue below the "buffer_low_watermark" we resume reading.
+        This way a fast sender (or a server that is still CONNECTING) cannot make us buffer the entire stream.
+    - Shaping (the proxy's rate_limits , see maproxy.shaping):
+        After each read we take the read's size from the session's token-buckets. If a bucket is in debt we stop
+        reading from this side (c2p_shaped / p2s_shaped) until the shaper resumes us (resume_read)
+    - Splice engine (ProxyServer's engine="splice"):
+        We don't read from the client while connecting. Once the server is connected, the sockets are handed
+        to a maproxy.splice.SpliceRelay that moves the data inside the kernel. Traced sessions (see below)
+        need the data , so they use the streams
+    - Asyncio engine (ProxyServer's engine="asyncio"):
+        The client's socket is taken from the stream right away , and a maproxy.aioengine.AsyncioRelay
+        connects to the server and relays the data with asyncio Protocols. (traced sessions use the streams)
+    - Events (monitoring):
+        Register callbacks on the proxy's hooks (maproxy.hooks.SessionHooks) instead of overriding the
+        completion routines. Sessions that are not traced do not pay for it
+    - Timeouts (the proxy's connect/idle/lifetime timeouts):
+        Each session has one timer on the shared timer-wheel , set to its nearest deadline (see check_timeouts).
+        The read path doesn't touch the timer: idleness is detected by comparing the bytes counters
+    - Memory:
+        The attributes are slots (no per-session __dict__), and the write-queues exist only while there's
+        queued data (most sessions are idle most of the time). See also PoolingSessionFactory
         
     
 
 
     """
-    class LoggerOptions:
-        """
-        Logging options - which messages/notifications we would like to log...
-        The logging is for development&maintenance. In production set all to False
-        """
-        # Log charactaristics
-        LOG_SESSION_ID=True         # for each log, add the session-id
-        # Log different operations
-        LOG_NEW_SESSION_OP=False
-        LOG_READ_OP=False
-        LOG_WRITE_OP=False
-        LOG_CLOSE_OP=False
-        LOG_CONNECT_OP=False
-        LOG_REMOVE_SESSION=False
-        
     class State:
         """
         Each socket has a state.
         We will use the state to identify whether the connection is open or closed
         """
         CLOSED,CONNECTING,CONNECTED=range(3)
+
+    # Sessions that must see the data (traced sessions , protocol-aware subclasses) relay it with the streams
+    # even if the proxy uses the splice/asyncio engine
+    inspects_data=False
+    # Connect to the server when the client connects. Protocol-aware subclasses may connect later (p2s_connect)
+    connect_on_accept=True
+
+    # (subclasses that don't declare __slots__ get a __dict__ , as usual)
+    __slots__=("proxy","session_id","start_time","bytes_c2s","bytes_s2c","backend","target","splice","splice_relay","aio_relay",
+               "c2p_stream","c2p_address","c2p_state","c2p_reading","c2p_writing","c2p_read_paused","c2p_shaped",
+               "p2s_stream","p2s_state","p2s_reading","p2s_writing","p2s_read_paused","p2s_shaped","rate_buckets",
+               "c2s_queued_data","s2c_queued_data","timer","idle_bytes","idle_since","connect_start")
     
     def __init__(self):
         pass
+
+    def reset(self):
+        """
+        Drop the references of a removed session (streams , proxy ...) so the object can be reused (see PoolingSessionFactory)
+        """
+        self.proxy=None
+        self.backend=None
+        self.target=None
+        self.splice_relay=None
+        self.aio_relay=None
+        self.c2p_stream=None
+        self.c2p_address=None
+        self.p2s_stream=None
+        self.c2s_queued_data=None
+        self.s2c_queued_data=None
+        self.rate_buckets=None
+        self.timer=None
     #def new_connection(self,stream : tornado.iostream.IOStream ,address,proxy):
     def new_connection(self,stream ,address,proxy):
             # First,validation
             assert isinstance(proxy,maproxy.proxyserver.ProxyServer) 
             assert isinstance(stream,tornado.iostream.IOStream)
             
-            # Logging
-            self.logger_nesting_level=0         # logger_nesting_level is the current "nesting level"
-            if Session.LoggerOptions.LOG_NEW_SESSION_OP:
-                self.log("New Session")
-
-            
             # Remember our "parent" ProxyServer 
             self.proxy=proxy
+            self.session_id=None    # assigned by the proxy's registry
+            self.start_time=time.time()
+            self.bytes_c2s=0        # bytes read from the client
+            self.bytes_s2c=0        # bytes read from the server
 
             # R/W flags for each socket
             # Using the flags, we can tell if we're waiting for I/O completion
@@ -88,100 +180,104 @@ class Session(object):
             # Init the Client->Proxy stream
             self.c2p_stream=stream
             self.c2p_address=address
+            # The target server (server,port) of this session (and the selected backend , if any)
+            self.backend=None
+            self.target=self.proxy.get_target(self)
             # Client->Proxy  is connected
             self.c2p_state=Session.State.CONNECTED
+            # Relay with splice (the sockets are taken from the streams once the server is connected)
+            self.splice=proxy.engine=="splice" and not self.inspects_data
             
             # Here we will put incoming data while we're still waiting for the target-server's connection
-            self.c2s_queued_data=[] # Data that was read from the Client, and needs to be sent to the  Server
-            self.s2c_queued_data=[] # Data that was read from the Server , and needs to be sent to the  client
+            # (WriteQueue objects , created when needed. None means "empty")
+            self.c2s_queued_data=None # Data that was read from the Client, and needs to be sent to the  Server
+            self.s2c_queued_data=None # Data that was read from the Server , and needs to be sent to the  client
+            self.splice_relay=None
+            self.aio_relay=None
+
+            # Flow-control: when a queue passes the high-watermark we pause reading from its source
+            self.c2p_read_paused=False  # we stopped reading from the client (c2s queue is full)
+            self.p2s_read_paused=False  # we stopped reading from the server (s2c queue is full)
+            # Shaping: we stopped reading because of the rate-limits
+            self.c2p_shaped=False
+            self.p2s_shaped=False
+            self.rate_buckets=None      # the session's own token-buckets (see maproxy.shaping)
+            # Timeouts: the session's timer on the proxy's timer-wheel (see check_timeouts)
+            self.timer=None
+            self.idle_bytes=0           # bytes_c2s+bytes_s2c when we last saw the session relaying data
+            self.idle_since=self.start_time
+            self.connect_start=self.start_time  # when we started connecting to the server (see the connect timeout)
 
             # send data immediately to the client ... (Disable Nagle TCP algorithm)
             self.c2p_stream.set_nodelay(True)
+
+            if proxy.engine=="asyncio" and not self.inspects_data:
+                # The relay owns the client's socket (the stream closes its own , duplicated, descriptor)
+                self.p2s_stream=None
+                self.p2s_state=Session.State.CONNECTING
+                client=self.c2p_stream.socket.dup()
+                self.c2p_stream.close()
+                self.aio_relay=maproxy.aioengine.AsyncioRelay(self,client)
+                return
             # Let us now when the client disconnects (callback on_c2p_close)
-            self.c2p_stream.set_close_callback( self.on_c2p_close)
+            # (splice: a stream with a close-callback reads from its socket, and the relay must get all the data)
+            if not self.splice:
+                self.c2p_stream.set_close_callback( self.on_c2p_close)
 
-            # Create the Proxy->Server socket and stream
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
-            
-            if self.proxy.server_ssl_options is not None:
-                # if the "server_ssl_options" where specified, it means that when we connect, we need to wrap with SSL
-                # so we need to use the SSLIOStream stream
-                self.p2s_stream = tornado.iostream.SSLIOStream(s,ssl_options=self.proxy.server_ssl_options)
+            if self.connect_on_accept:
+                self.p2s_connect()
             else:
-                # use the standard IOStream stream
-                self.p2s_stream = tornado.iostream.IOStream(s)
-            # send data immediately to the server... (Disable Nagle TCP algorithm)
-            self.p2s_stream.set_nodelay(True)
-            
-            # Let us now when the server disconnects (callback on_p2s_close)
-            self.p2s_stream.set_close_callback(  self.on_p2s_close )
-            # P->S state is "connecting"
-            self.p2s_state=self.p2s_state=Session.State.CONNECTING
-            self.p2s_stream.connect(( proxy.target_server, proxy.target_port),  self.on_p2s_done_connect )
-            
+                self.p2s_stream=None
+                self.p2s_state=Session.State.CLOSED
 
             # We can actually start reading immediatelly from the C->P socket
-            self.c2p_start_read()
-    
-    # Each member-function can call this method to log data (currently to screen)
-    def log(self,msg):
-        prefix=str(id(self))+":" if Session.LoggerOptions.LOG_SESSION_ID else ""
-        prefix+=self.logger_nesting_level*" "*4
-        logging.debug(prefix + msg)
-        
-        
+            if not self.splice:
+                self.c2p_start_read()
 
-    #  Logging decorator (enter/exit)
-    def logger(enabled=True):
+    def p2s_connect(self):
         """
-        We use this decorator to wrap functions and log the input/ouput of each function
-        Since this decorator accepts a parameter, it must return an "inner" decorator....(Python stuff)
+        Create the Proxy->Server stream.
+        If the proxy has a connection-pool (of the proxy's target server), take a ready (already connected) stream
         """
-        def inner_decorator(func):
-            
-        
-            def log_wrapper(self,*args,**kwargs):
-
-                msg="%s (%s,%s)" % (func.__name__,args,kwargs)
-
-            
-                self.log(msg)
-                self.logger_nesting_level+=1
-                r=func(self,*args,**kwargs)
-                self.logger_nesting_level-=1
-                self.log("%s -> %s" % (msg,str(r)) )
-                return r
-            return log_wrapper if enabled else func
-            
-
-        return inner_decorator
+        pooled_stream=None
+        if self.proxy.connection_pool and self.target==(self.proxy.target_server,self.proxy.target_port):
+            pooled_stream=self.proxy.connection_pool.get()
+        if pooled_stream is not None:
+            self.p2s_stream=pooled_stream
+            self.p2s_stream.set_close_callback(  self.on_p2s_close )
+            self.p2s_state=Session.State.CONNECTING
+            self.on_p2s_done_connect()
+        else:
+            # SSL or standard stream (according to the proxy's server_ssl_options) , with Nagle disabled
+            self.p2s_stream = self.proxy.create_upstream_stream()
 
-        
-        
+            # P->S state is "connecting"
+            self.p2s_state=Session.State.CONNECTING
+            # Let us now when the server disconnects (callback on_p2s_close)
+            self.proxy.connect_upstream(self.p2s_stream,  self.on_p2s_done_connect , self.on_p2s_close , self.target , self.backend)
+    
     ################
     ## Start Read ##
     ################
-    @logger(LoggerOptions.LOG_READ_OP)
     def c2p_start_read(self):
         """
-        Start read from client
+        Start read (one chunk) from client
         """
         assert( not self.c2p_reading)
         self.c2p_reading=True
         try:
-            self.c2p_stream.read_until_close(lambda x: None,self.on_c2p_done_read)
+            self.c2p_stream.read_bytes(self.c2p_stream.read_chunk_size,self.on_c2p_done_read,partial=True)
         except tornado.iostream.StreamClosedError:
             self.c2p_reading=False
 
-    @logger(LoggerOptions.LOG_READ_OP)
     def p2s_start_read(self):
         """
-        Start read from server
+        Start read (one chunk) from server
         """
         assert( not self.p2s_reading)
         self.p2s_reading=True
         try:
-            self.p2s_stream.read_until_close(lambda x:None,self.on_p2s_done_read)
+            self.p2s_stream.read_bytes(self.p2s_stream.read_chunk_size,self.on_p2s_done_read,partial=True)
         except tornado.iostream.StreamClosedError:    
             self.p2s_reading=False
     
@@ -189,26 +285,131 @@ class Session(object):
     ##############################
     ## Read Completion Routines ##
     ##############################
-    @logger(LoggerOptions.LOG_READ_OP)
     def on_c2p_done_read(self,data):
         # # We got data from the client (C->P ) . Send data to the server
         assert(self.c2p_reading)
         assert(data)
-        self.p2s_start_write(data)
+        self.c2p_reading=False
+        size=len(data)
+        self.bytes_c2s+=size
+        self.proxy.metrics.bytes_c2s+=size
+        data=self._filter_c2s(data)
+        if data is None:
+            return
+        if data:
+            self.p2s_start_write(data)
+        shaper=self.proxy.shaper
+        if shaper is not None and shaper.consume(self,"c2s",size):
+            self.c2p_shaped=True
+        # Read the next chunk (unless the write or the shaper paused the reading)
+        if not self.c2p_read_paused and not self.c2p_shaped:
+            self.c2p_start_read()
         
         
-    @logger(LoggerOptions.LOG_READ_OP)
     def on_p2s_done_read(self,data):
         # got data from Server to Proxy . if the client is still connected - send the data to the client
         assert( self.p2s_reading)
         assert(data)
-        self.c2p_start_write(data)
+        self.p2s_reading=False
+        size=len(data)
+        self.bytes_s2c+=size
+        self.proxy.metrics.bytes_s2c+=size
+        data=self._filter_s2c(data)
+        if data is None:
+            return
+        if data:
+            self.c2p_start_write(data)
+        shaper=self.proxy.shaper
+        if shaper is not None and shaper.consume(self,"s2c",size):
+            self.p2s_shaped=True
+        # Read the next chunk (unless the write or the shaper paused the reading)
+        if not self.p2s_read_paused and not self.p2s_shaped:
+            self.p2s_start_read()
+
+    def _filter_c2s(self,data):
+        """
+        Protocol-aware subclasses override the filters: return the data to forward (possibly modified or empty) ,
+        or None once the session was closed (e.g. a protocol error). The counters , the shaping and the next read
+        stay in on_c2p_done_read/on_p2s_done_read
+        """
+        return data
+
+    def _filter_s2c(self,data):
+        return data
+
+
+    ##################
+    ## Flow-Control ##
+    ##################
+    def _c2s_queue_append(self,data):
+        """
+        Queue data to the server. if the queue is full (above the high-watermark) stop reading from the client
+        """
+        if self.c2s_queued_data is None:
+            self.c2s_queued_data=WriteQueue()
+        self.c2s_queued_data.append(data)
+        high_watermark=self.proxy.buffer_high_watermark
+        if high_watermark is not None and len(self.c2s_queued_data) > high_watermark:
+            self.c2p_read_paused=True
+
+    def _s2c_queue_append(self,data):
+        """
+        Queue data to the client. if the queue is full (above the high-watermark) stop reading from the server
+        """
+        if self.s2c_queued_data is None:
+            self.s2c_queued_data=WriteQueue()
+        self.s2c_queued_data.append(data)
+        high_watermark=self.proxy.buffer_high_watermark
+        if high_watermark is not None and len(self.s2c_queued_data) > high_watermark:
+            self.p2s_read_paused=True
+
+    def _c2s_queue_pop(self):
+        """
+        Get the next batch from the C->S queue. if we've drained below the low-watermark, resume reading from the client
+        """
+        data=self.c2s_queued_data.pop(self.proxy.max_write_batch)
+        if not self.c2s_queued_data:
+            self.c2s_queued_data=None
+        if self.c2p_read_paused and (self.c2s_queued_data is None or len(self.c2s_queued_data) <= self.proxy.buffer_low_watermark):
+            self.c2p_read_paused=False
+            if not self.c2p_reading and not self.c2p_shaped and self.c2p_state==Session.State.CONNECTED:
+                self.c2p_start_read()
+        return data
+
+    def _s2c_queue_pop(self):
+        """
+        Get the next batch from the S->C queue. if we've drained below the low-watermark, resume reading from the server
+        """
+        data=self.s2c_queued_data.pop(self.proxy.max_write_batch)
+        if not self.s2c_queued_data:
+            self.s2c_queued_data=None
+        if self.p2s_read_paused and (self.s2c_queued_data is None or len(self.s2c_queued_data) <= self.proxy.buffer_low_watermark):
+            self.p2s_read_paused=False
+            if not self.p2s_reading and not self.p2s_shaped and self.p2s_state==Session.State.CONNECTED:
+                self.p2s_start_read()
+        return data
+
+
+    def resume_read(self,direction):
+        """
+        The shaper resumes the reading in a direction ("c2s": from the client , "s2c": from the server)
+        """
+        if self.aio_relay is not None:
+            self.aio_relay.resume_read(direction)
+            return
+        if direction=="c2s":
+            self.c2p_shaped=False
+            if not self.c2p_read_paused and not self.c2p_reading and self.c2p_state==Session.State.CONNECTED:
+                self.c2p_start_read()
+        else:
+            self.p2s_shaped=False
+            if not self.p2s_read_paused and not self.p2s_reading and self.p2s_state==Session.State.CONNECTED:
+                self.p2s_start_read()
 
 
     #####################
     ## Write to stream ##
     #####################
-    @logger(LoggerOptions.LOG_WRITE_OP)
     def _c2p_io_write(self,data):
         if data is None:
             # None means (gracefully) close-socket  (a "close request" that was queued...)
@@ -224,7 +425,6 @@ class Session(object):
             except tornado.iostream.StreamClosedError:
                 # Cancel the write, we will get on_close instead...
                 self.c2p_writing=False
-    @logger(LoggerOptions.LOG_WRITE_OP)
     def _p2s_io_write(self,data):
         if data is None:
             # None means (gracefully) close-socket  (a "close request" that was queued...)
@@ -246,7 +446,6 @@ class Session(object):
     #################
     ## Start Write ##
     #################
-    @logger(LoggerOptions.LOG_WRITE_OP)
     def c2p_start_write(self,data):
         """
         Write to client.if there's a pending write-operation, add it to the S->C (s2c) queue
@@ -262,9 +461,8 @@ class Session(object):
             self._c2p_io_write(data)
         else:
             # Just add to the queue
-            self.s2c_queued_data.append(data)
+            self._s2c_queue_append(data)
     
-    @logger(LoggerOptions.LOG_WRITE_OP)
     def p2s_start_write(self,data):
         """
         Write to the server.
@@ -274,7 +472,7 @@ class Session(object):
         
         # If still connecting to the server - queue the data...
         if self.p2s_state == Session.State.CONNECTING:  
-            self.c2s_queued_data.append(data)   # TODO: is it better here to append (to list) or concatenate data (to buffer) ?
+            self._c2s_queue_append(data)
             return
         # If not connected - do nothing
         if self.p2s_state == Session.State.CLOSED:  
@@ -286,13 +484,12 @@ class Session(object):
             self._p2s_io_write(data)
         else:
             # Just add to the queue
-            self.c2s_queued_data.append(data)
+            self._c2s_queue_append(data)
 
     
     ##############################
     ## Write Competion Routines ##
     ##############################
-    @logger(LoggerOptions.LOG_WRITE_OP)
     def on_c2p_done_write(self):
         """
         A start_write C->P  (write to client) is done .
@@ -300,14 +497,13 @@ class Session(object):
         """
         assert(self.c2p_writing)
         if self.s2c_queued_data:
-            # more data in the queue, write next item as well..
-            self._c2p_io_write( self.s2c_queued_data.pop(0))
+            # more data in the queue, write all of it (one batch) as well..
+            self._c2p_io_write( self._s2c_queue_pop())
             return
         self.c2p_writing=False
         
     
         
-    @logger(LoggerOptions.LOG_WRITE_OP)
     def on_p2s_done_write(self):
         """
         A start_write P->S  (write to server) is done .
@@ -315,8 +511,8 @@ class Session(object):
         """
         assert(self.p2s_writing)
         if self.c2s_queued_data:
-            # more data in the queue, write next item as well..
-            self._p2s_io_write( self.c2s_queued_data.pop(0))
+            # more data in the queue, write all of it (one batch) as well..
+            self._p2s_io_write( self._c2s_queue_pop())
             return
         self.p2s_writing=False
         
@@ -325,7 +521,6 @@ class Session(object):
     ######################
     ## Close Connection ##
     ######################
-    @logger(LoggerOptions.LOG_CLOSE_OP)
     def c2p_start_close(self,gracefully=True):
         """
         Close c->p connection
@@ -343,13 +538,12 @@ class Session(object):
             return
 
         self.c2p_state = Session.State.CLOSED
-        self.s2c_queued_data=[]
+        self.s2c_queued_data=None
         self.c2p_stream.close()
         if self.p2s_state == Session.State.CLOSED:
             self.remove_session()
             
             
-    @logger(LoggerOptions.LOG_CLOSE_OP)
     def p2s_start_close(self,gracefully=True):
         """
         Close p->s connection
@@ -367,13 +561,12 @@ class Session(object):
             return
 
         self.p2s_state = Session.State.CLOSED
-        self.c2s_queued_data=[]
+        self.c2s_queued_data=None
         self.p2s_stream.close()
         if self.c2p_state == Session.State.CLOSED:
             self.remove_session()
         
 
-    @logger(LoggerOptions.LOG_CLOSE_OP)
     def on_c2p_close(self):
         """
         Client closed the connection.
@@ -389,40 +582,171 @@ class Session(object):
             self.p2s_start_close(gracefully=True)
             
 
-    @logger(LoggerOptions.LOG_CLOSE_OP)
     def on_p2s_close(self):
         """
         Server closed the connection.
         We need to update the satte, and if the client closed as well - delete the session
         """
+        if self.p2s_state==Session.State.CONNECTING:
+            # We failed to connect
+            self.proxy.metrics.connect_failures+=1
+            if self.backend is not None:
+                self.proxy.balancer.connect_failed(self.backend)
         self.p2s_state=Session.State.CLOSED
         if self.c2p_state == Session.State.CLOSED:
             self.remove_session()
+        elif self.splice:
+            # (we never read from the client , so there's nothing to flush)
+            self.c2p_start_close(gracefully=False)
         else:
             self.c2p_start_close(gracefully=True)
         
+    def close(self,gracefully=False):
+        """
+        Close the session (e.g. by an administrator).
+        gracefully=True: flush the queued data and close both connections (just like when the client closes:
+                         once the client's connection is closed , on_c2p_close closes the server's connection)
+        gracefully=False: close both connections now
+        """
+        if self.splice_relay is not None:
+            self.splice_relay.close()
+            return
+        if self.aio_relay is not None:
+            self.aio_relay.close()
+            return
+        if gracefully:
+            if self.c2p_state != Session.State.CLOSED:
+                self.c2p_start_close(gracefully=True)
+            else:
+                self.p2s_start_close(gracefully=True)
+            return
+        # We remove the session ourselves , the close-callbacks must not do it again
+        self.c2p_stream.set_close_callback(None)
+        if self.p2s_stream is not None:
+            self.p2s_stream.set_close_callback(None)
+        self.c2p_start_close(gracefully=False)
+        self.p2s_start_close(gracefully=False)
+
+    def get_info(self):
+        """
+        Session's details (dictionary) for management/monitoring
+        """
+        state_names={ Session.State.CLOSED:"closed", Session.State.CONNECTING:"connecting", Session.State.CONNECTED:"connected" }
+        return {
+            "id": self.session_id,
+            "client": self.c2p_address,
+            "target": self.target,
+            "age": time.time()-self.start_time,
+            "bytes_c2s": self.bytes_c2s,
+            "bytes_s2c": self.bytes_s2c,
+            "queued_c2s": len(self.c2s_queued_data) if self.c2s_queued_data is not None else 0,
+            "queued_s2c": len(self.s2c_queued_data) if self.s2c_queued_data is not None else 0,
+            "client_state": state_names[self.c2p_state],
+            "server_state": state_names[self.p2s_state],
+            "splice": self.splice_relay is not None,
+            "asyncio": self.aio_relay is not None,
+        }
+
+    ##############
+    ## Timeouts ##
+    ##############
+    def check_timeouts(self):
+        """
+        Close the session if one of the proxy's timeouts expired , otherwise set the timer to the nearest deadline
+        """
+        self.timer=None
+        proxy=self.proxy
+        now=time.time()
+        deadlines=[]
+        if proxy.connect_timeout is not None and self.p2s_state==Session.State.CONNECTING:
+            deadline=self.connect_start+proxy.connect_timeout
+            if now>=deadline:
+                self._timed_out("connect")
+                return
+            deadlines.append(deadline)
+        if proxy.lifetime_timeout is not None:
+            deadline=self.start_time+proxy.lifetime_timeout
+            if now>=deadline:
+                self._timed_out("lifetime")
+                return
+            deadlines.append(deadline)
+        if proxy.idle_timeout is not None:
+            relayed=self.bytes_c2s+self.bytes_s2c
+            if relayed!=self.idle_bytes:
+                # Some data was relayed since the last check
+                self.idle_bytes=relayed
+                self.idle_since=now
+            deadline=self.idle_since+proxy.idle_timeout
+            if now>=deadline:
+                self._timed_out("idle")
+                return
+            deadlines.append(deadline)
+        if deadlines:
+            self.timer=proxy.get_timer_wheel().add(min(deadlines)-now,self.check_timeouts)
+
+    def _timed_out(self,timeout):
+        metrics=self.proxy.metrics
+        if timeout=="connect":
+            metrics.connect_timeouts+=1
+            metrics.connect_failures+=1
+            if self.backend is not None:
+                self.proxy.balancer.connect_failed(self.backend)
+        elif timeout=="idle":
+            metrics.idle_timeouts+=1
+        else:
+            metrics.lifetime_timeouts+=1
+        self.close(gracefully=False)
+
     ########################
     ## Connect-Completion ##
     ########################
-    @logger(LoggerOptions.LOG_CONNECT_OP)
     def on_p2s_done_connect(self):
         assert(self.p2s_state==Session.State.CONNECTING)
         self.p2s_state=Session.State.CONNECTED
+        if self.splice:
+            self._start_splice()
+            return
         # Start reading from the socket
         self.p2s_start_read()
         assert(not self.p2s_writing)    # As expect no current write-operation ...
         
         # If we have pending-data to write, start writing...
         if self.c2s_queued_data:
-            # TRICKY: get thte frst item , and write it...
+            # TRICKY: get the first batch (everything that was queued while connecting) , and write it...
             # this is tricky since the "start-write" will 
-            # write this item even if there are queued-items... (since self.p2s_writing=False)
-            self.p2s_start_write( self.c2s_queued_data.pop(0)  )
+            # write this batch even if there are queued-items... (since self.p2s_writing=False)
+            self.p2s_start_write( self._c2s_queue_pop()  )
     
+    ############
+    ## Splice ##
+    ############
+    def _start_splice(self):
+        """
+        Take the sockets from the streams and start the kernel relay.
+        The streams close their own (duplicated) descriptors , the connections stay open
+        """
+        client=self.c2p_stream.socket.dup()
+        server=self.p2s_stream.socket.dup()
+        self.p2s_stream.set_close_callback(None)
+        self.p2s_stream.close()
+        self.c2p_stream.close()
+        self.splice_relay=maproxy.splice.SpliceRelay(self,client,server,self.proxy.max_write_batch)
+
+    def on_splice_done(self):
+        self.c2p_state=Session.State.CLOSED
+        self.p2s_state=Session.State.CLOSED
+        self.splice_relay=None
+        self.remove_session()
+
+    def on_aio_done(self):
+        self.c2p_state=Session.State.CLOSED
+        self.p2s_state=Session.State.CLOSED
+        self.aio_relay=None
+        self.remove_session()
+
     ###########
     ## UTILS ##
     ###########
-    @logger(LoggerOptions.LOG_REMOVE_SESSION)
     def remove_session(self):
         self.proxy.remove_session(self)
 
@@ -446,4 +770,44 @@ class SessionFactory(object):
         """
         assert( isinstance(session,Session))
         del session
+
+
+class PoolingSessionFactory(SessionFactory):
+    """
+    A session-factory that reuses the objects of removed sessions (instead of allocating a new Session for
+    every connection). Removed sessions are reset (see Session.reset) and kept in a free-list of up to "max_size" objects.
+    NOTE: don't keep references to sessions after they were removed (e.g. in the hooks' "end" event) , the
+          object will be reused by a new session
+    """
+    def __init__(self,max_size=1024,session_class=Session):
+        """
+        Input Parameters:
+            max_size      : maximum number of free objects to keep
+            session_class : Session (or a subclass) . its constructor is called without arguments
+        """
+        super(PoolingSessionFactory,self).__init__()
+        self.max_size=max_size
+        self.session_class=session_class
+        self._free=[]
+        # Some statistics
+        self.reused=0
+        self.created=0
+
+    def new(self,*args,**kwargs):
+        if self._free and not args and not kwargs:
+            self.reused+=1
+            return self._free.pop()
+        self.created+=1
+        return self.session_class(*args,**kwargs)
+
+    def delete(self,session):
+        assert( isinstance(session,Session))
+        # (traced sessions have another class , see maproxy.hooks)
+        if type(session) is not self.session_class or len(self._free) >= self.max_size:
+            return
+        session.reset()
+        self._free.append(session)
+
+    def get_free_count(self):
+        return len(self._free)
         
\ No newline at end of file
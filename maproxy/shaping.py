@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+import tornado.ioloop
+
+
+class TokenBucket(object):
+    """
+    "rate" bytes/sec , up to "burst" bytes at once.
+    The tokens are refilled lazily (when the bucket is used) , and may go negative: a read that was bigger
+    than the available tokens is a debt that must be repaid before the next read
+    """
+    __slots__=("rate","burst","tokens","last")
+
+    def __init__(self,rate,burst=None,now=0):
+        self.rate=float(rate)
+        self.burst=float(burst if burst is not None else rate)
+        self.tokens=self.burst
+        self.last=now
+
+    def refill(self,now):
+        self.tokens=min(self.burst,self.tokens+(now-self.last)*self.rate)
+        self.last=now
+
+    def consume(self,size,now):
+        """
+        Take "size" tokens. Returns False if the bucket is in debt (stop reading until it's ready)
+        """
+        self.refill(now)
+        self.tokens-=size
+        return self.tokens>=0
+
+    def ready(self,now):
+        self.refill(now)
+        return self.tokens>=0
+
+
+def _parse_limit(limit,now):
+    """
+    A limit is bytes/sec , or (bytes/sec , burst) , or None (unlimited)
+    """
+    if limit is None:
+        return None
+    if isinstance(limit,(list,tuple)):
+        return TokenBucket(limit[0],limit[1],now)
+    return TokenBucket(limit,None,now)
+
+
+class Shaper(object):
+    """
+    Bandwidth shaping (token buckets) for a ProxyServer , per direction ("c2s": data from the clients ,
+    "s2c": data from the servers) at three levels: each session , each client IP , the entire server.
+    After every read, the session takes the read's size from its buckets. If one of them is in debt, we stop
+    reading from that side (the data is not buffered , the sender is slowed down by TCP) until all the buckets
+    are ready again.
+    The throttled sessions are checked by one shared timer (every TICK seconds , only while sessions are
+    throttled) , so sessions that are not throttled cost nothing but the buckets' arithmetic.
+    """
+    # How often (seconds) we check the throttled sessions
+    TICK=0.02
+    DIRECTIONS=("c2s","s2c")
+
+    def __init__(self,limits):
+        """
+        Input Parameters:
+            limits: dictionary: level -> { direction -> limit }
+                    level    : "session" , "client" (each client IP) , "server"
+                    direction: "c2s" , "s2c"
+                    limit    : bytes/sec , or (bytes/sec , burst-bytes). The default burst is one second
+                    e.g. {"session":{"c2s":100*1024,"s2c":1024*1024} , "server":{"s2c":(50*1024*1024,1024*1024)}}
+        """
+        for level,directions in limits.items():
+            assert level in ("session","client","server") , "Unknown level: %s" % level
+            for direction in directions:
+                assert direction in Shaper.DIRECTIONS , "Unknown direction: %s" % direction
+        self.session_limits=limits.get("session",{})
+        self.client_limits=limits.get("client",{})
+        self.server_buckets={ direction:_parse_limit(limit,0) for direction,limit in limits.get("server",{}).items() }
+        self._clients={}        # client IP -> [sessions-count , { direction -> TokenBucket } ]
+        self._throttled=set()   # (session,direction)
+        self._ioloop=None
+        self._timeout=None
+
+        # Some statistics
+        self.throttles=0        # How many times we stopped reading
+
+    def session_started(self,session):
+        now=self._now()
+        session.rate_buckets=None
+        if self.session_limits:
+            session.rate_buckets={ direction:_parse_limit(limit,now) for direction,limit in self.session_limits.items() }
+        if self.client_limits:
+            client=self._clients.get(session.c2p_address[0])
+            if client is None:
+                client=self._clients[session.c2p_address[0]]=[0,{ direction:_parse_limit(limit,now) for direction,limit in self.client_limits.items() }]
+            client[0]+=1
+
+    def session_ended(self,session):
+        for direction in Shaper.DIRECTIONS:
+            self._throttled.discard((session,direction))
+        if self.client_limits:
+            client=self._clients.get(session.c2p_address[0])
+            if client is not None:
+                client[0]-=1
+                if client[0]<=0:
+                    del self._clients[session.c2p_address[0]]
+        session.rate_buckets=None
+
+    def _buckets(self,session,direction):
+        buckets=[]
+        if session.rate_buckets is not None:
+            buckets.append(session.rate_buckets.get(direction))
+        if self.client_limits:
+            client=self._clients.get(session.c2p_address[0])
+            if client is not None:
+                buckets.append(client[1].get(direction))
+        buckets.append(self.server_buckets.get(direction))
+        return [ bucket for bucket in buckets if bucket is not None ]
+
+    def consume(self,session,direction,size):
+        """
+        The session read "size" bytes. Returns True if the session must stop reading (in this direction)
+        until we resume it (session.resume_read)
+        """
+        now=self._now()
+        ready=True
+        for bucket in self._buckets(session,direction):
+            if not bucket.consume(size,now):
+                ready=False
+        if ready:
+            return False
+        self.throttles+=1
+        self._throttled.add((session,direction))
+        if self._timeout is None:
+            self._timeout=self._ioloop.add_timeout(now+Shaper.TICK,self._tick)
+        return True
+
+    def get_throttled_count(self):
+        return len(self._throttled)
+
+    def _now(self):
+        if self._ioloop is None:
+            self._ioloop=tornado.ioloop.IOLoop.current()
+        return self._ioloop.time()
+
+    def _tick(self):
+        self._timeout=None
+        now=self._now()
+        for session,direction in list(self._throttled):
+            if all( bucket.ready(now) for bucket in self._buckets(session,direction) ):
+                self._throttled.discard((session,direction))
+                session.resume_read(direction)
+        if self._throttled:
+            self._timeout=self._ioloop.add_timeout(now+Shaper.TICK,self._tick)
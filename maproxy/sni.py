@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+import os
+import ssl
+import json
+
+
+class SNIRoute(object):
+    """
+    One entry of the SNIRouter's table: the SSL context (certificate) to use for a hostname,
+    and the target server (None means "use the ProxyServer's target")
+    """
+    __slots__=("hostname","context","target_server","target_port")
+
+    def __init__(self,hostname,context,target_server=None,target_port=None):
+        self.hostname=hostname
+        self.context=context
+        self.target_server=target_server
+        self.target_port=target_port
+
+
+class SNIRouter(object):
+    """
+    SSL listener that serves many hostnames (certificates) on one port.
+    During the handshake we read the hostname that the client asked for (SNI), and pick the certificate
+    and the target server from a table of routes. All the SSL contexts are built when the table is loaded
+    (not per connection), and a context is shared by all the routes that use the same certificate.
+
+    The routes are a dictionary: hostname -> options , where the options are:
+        certfile , keyfile      : the server certificate (and private key) for this hostname
+        ciphers                 : (optional)
+        target_server           : (optional) the target server for this hostname
+        target_port             : (optional)
+    The hostname can be an exact name ("www.example.com"), a wildcard ("*.example.com") or "*" (default route:
+    clients without SNI or with an unknown hostname. Without a default route, unknown hostnames are rejected)
+
+    The table can be reloaded (load/reload) without restarting: new handshakes use the new table, contexts of
+    certificates that didn't change (same files, same modification time) are reused.
+    """
+    def __init__(self,routes=None,config_file=None):
+        """
+        Input Parameters:
+            routes      : dictionary of routes (see above)
+            config_file : JSON file that contains the routes dictionary (relative file names are relative
+                          to the config-file's folder). use reload() to re-read the file
+        """
+        self.config_file=config_file
+        self._routes={}         # hostname -> SNIRoute
+        self._contexts={}       # (certfile,keyfile,ciphers) -> (mtimes,ssl.SSLContext)
+
+        # This is the listening context. it only selects the context of the route
+        self.context=ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.context.sni_callback=self._on_sni
+
+        if config_file is not None:
+            self.reload()
+        else:
+            self.load(routes or {})
+
+    def reload(self):
+        """
+        Re-read the config file
+        """
+        with open(self.config_file) as f:
+            routes=json.load(f)
+        self.load(routes,os.path.dirname(os.path.abspath(self.config_file)))
+
+    def load(self,routes,base_dir=None):
+        """
+        Replace the routes table (see the class documentation)
+        """
+        table={}
+        contexts={}
+        default_key=None
+        for hostname,options in routes.items():
+            certfile=options["certfile"]
+            keyfile=options.get("keyfile")
+            if base_dir:
+                certfile=os.path.join(base_dir,certfile)
+                keyfile=os.path.join(base_dir,keyfile) if keyfile else None
+            key=(certfile,keyfile,options.get("ciphers"))
+            if key not in contexts:
+                contexts[key]=self._get_context(key)
+            table[hostname.lower()]=SNIRoute(hostname,contexts[key][1],options.get("target_server"),options.get("target_port"))
+            if default_key is None or hostname=="*":
+                default_key=key
+
+        # The listening context needs a certificate of its own (the default route , or any route)
+        if default_key is not None:
+            self.context.load_cert_chain(default_key[0],default_key[1])
+        self._routes=table
+        self._contexts=contexts
+
+    def _get_context(self,key):
+        """
+        Return (mtimes,context) for the given certificate. reuse the cached context if the files didn't change
+        """
+        certfile,keyfile,ciphers=key
+        mtimes=(os.path.getmtime(certfile),os.path.getmtime(keyfile) if keyfile else None)
+        cached=self._contexts.get(key)
+        if cached is not None and cached[0]==mtimes:
+            return cached
+        context=ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile,keyfile)
+        if ciphers:
+            context.set_ciphers(ciphers)
+        if hasattr(ssl,"OP_NO_COMPRESSION"):
+            context.options|=ssl.OP_NO_COMPRESSION
+        return (mtimes,context)
+
+    def lookup(self,hostname):
+        """
+        Find the route of a hostname: exact match , wildcard match , or the default route ("*"). None if not found
+        """
+        routes=self._routes
+        if hostname:
+            hostname=hostname.lower()
+            route=routes.get(hostname)
+            if route is not None:
+                return route
+            parts=hostname.split(".",1)
+            if len(parts)==2:
+                route=routes.get("*."+parts[1])
+                if route is not None:
+                    return route
+        return routes.get("*")
+
+    def get_routes_count(self):
+        return len(self._routes)
+
+    def _on_sni(self,sslsock,server_name,context):
+        """
+        SNI callback (during the handshake): switch to the route's context, and remember the route on
+        the socket so the ProxyServer will be able to select the target
+        """
+        route=self.lookup(server_name)
+        if route is None:
+            return ssl.ALERT_DESCRIPTION_UNRECOGNIZED_NAME
+        sslsock.context=route.context
+        sslsock.sni_route=route
+        return None
+
+
+def get_route(sslsock):
+    """
+    Return the SNIRoute that was selected during the handshake of this socket (or None)
+    """
+    return getattr(sslsock,"sni_route",None)
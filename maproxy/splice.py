@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+import os
+import fcntl
+import tornado.ioloop
+
+
+def is_supported():
+    return hasattr(os,"splice")
+
+
+class _Direction(object):
+    """
+    One direction of the relay: src socket -> pipe -> dst socket
+    """
+    __slots__=("src","dst","pipe_r","pipe_w","pending","eof","c2s")
+
+    def __init__(self,src,dst,pipe_size,c2s):
+        self.src=src
+        self.dst=dst
+        self.pipe_r,self.pipe_w=os.pipe()
+        os.set_blocking(self.pipe_r,False)
+        os.set_blocking(self.pipe_w,False)
+        if pipe_size and hasattr(fcntl,"F_SETPIPE_SZ"):
+            try:
+                fcntl.fcntl(self.pipe_w,fcntl.F_SETPIPE_SZ,pipe_size)
+            except OSError:
+                pass    # above /proc/sys/fs/pipe-max-size , keep the default
+        self.pending=0          # bytes in the pipe
+        self.eof=False          # the source closed the connection
+        self.c2s=c2s            # True: client->server
+
+
+class SpliceRelay(object):
+    """
+    Relay the data of a connected (plain TCP) session inside the kernel: each direction moves the data
+    from one socket into a pipe and from the pipe to the other socket with splice(2), so the data is never
+    copied into Python. We only handle the sockets' readiness events.
+    - We wait for "readable" on a source only when its pipe is empty, and for "writable" on a destination
+      only when its pipe has data (the pipe is the only buffer, so a slow peer stops the reading)
+    - Like the stream engine: when one side closes the connection, we flush what's left in its pipe and
+      close the session
+    """
+    FLAGS=getattr(os,"SPLICE_F_MOVE",0)|getattr(os,"SPLICE_F_NONBLOCK",0)
+
+    def __init__(self,session,client,server,pipe_size=None):
+        """
+        Input Parameters:
+            session     : the Session (we call session.on_splice_done() once the relay is done)
+            client      : the client's socket (this relay owns it)
+            server      : the server's socket (this relay owns it)
+            pipe_size   : size (bytes) of each direction's pipe (None: the system's default)
+        """
+        self.session=session
+        self.metrics=session.proxy.metrics
+        self.client=client
+        self.server=server
+        self.ioloop=tornado.ioloop.IOLoop.current()
+        self.c2s=_Direction(client.fileno(),server.fileno(),pipe_size,True)
+        self.s2c=_Direction(server.fileno(),client.fileno(),pipe_size,False)
+        self._events={ client.fileno():None , server.fileno():None }   # fd -> registered events
+        self._closed=False
+        for fd in self._events:
+            self.ioloop.add_handler(fd,self._on_events,0)
+            self._events[fd]=0
+        self._relay()
+
+    def _on_events(self,fd,events):
+        progress=self._relay()
+        if not progress and events & tornado.ioloop.IOLoop.ERROR and not self._closed:
+            # Reset/hang-up and nothing can move
+            self.close()
+
+    def _relay(self):
+        """
+        Move as much data as we can in both directions, then update the events we wait for.
+        Returns True if some data moved (or the relay was closed)
+        """
+        if self._closed:
+            return True
+        try:
+            progress=self._pump(self.c2s)
+            progress=self._pump(self.s2c) or progress
+        except OSError:
+            # ECONNRESET , EPIPE ...
+            self.close()
+            return True
+        if (self.c2s.eof and not self.c2s.pending) or (self.s2c.eof and not self.s2c.pending):
+            self.close()
+            return True
+        read=tornado.ioloop.IOLoop.READ
+        write=tornado.ioloop.IOLoop.WRITE
+        client_fd,server_fd=self.client.fileno(),self.server.fileno()
+        self._set_events(client_fd,(read if not self.c2s.eof and not self.c2s.pending else 0)|(write if self.s2c.pending else 0))
+        self._set_events(server_fd,(read if not self.s2c.eof and not self.s2c.pending else 0)|(write if self.c2s.pending else 0))
+        return progress
+
+    def _pump(self,direction):
+        """
+        src -> pipe -> dst until both block. Returns True if some data moved
+        """
+        moved=False
+        while True:
+            progress=False
+            if not direction.eof:
+                try:
+                    n=os.splice(direction.src,direction.pipe_w,1<<20,flags=SpliceRelay.FLAGS)
+                except BlockingIOError:
+                    pass    # no data , or the pipe is full
+                else:
+                    if n==0:
+                        direction.eof=True
+                    else:
+                        direction.pending+=n
+                        if direction.c2s:
+                            self.metrics.bytes_c2s+=n
+                            self.session.bytes_c2s+=n
+                        else:
+                            self.metrics.bytes_s2c+=n
+                            self.session.bytes_s2c+=n
+                    progress=True
+            if direction.pending:
+                try:
+                    n=os.splice(direction.pipe_r,direction.dst,direction.pending,flags=SpliceRelay.FLAGS)
+                except BlockingIOError:
+                    pass    # the destination's socket-buffer is full
+                else:
+                    direction.pending-=n
+                    progress=True
+            if not progress:
+                return moved
+            moved=True
+            if direction.eof and not direction.pending:
+                return moved
+
+    def _set_events(self,fd,events):
+        if self._events[fd]!=events:
+            self._events[fd]=events
+            self.ioloop.update_handler(fd,events)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed=True
+        for fd in self._events:
+            self.ioloop.remove_handler(fd)
+        for direction in (self.c2s,self.s2c):
+            os.close(direction.pipe_r)
+            os.close(direction.pipe_w)
+        self.client.close()
+        self.server.close()
+        self.session.on_splice_done()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+import math
+import weakref
+import tornado.ioloop
+
+
+class Timer(object):
+    """
+    A timer of a TimerWheel (see TimerWheel.add , TimerWheel.cancel)
+    """
+    __slots__=("slot","rounds","callback")
+
+    def __init__(self,slot,rounds,callback):
+        self.slot=slot
+        self.rounds=rounds
+        self.callback=callback
+
+
+class TimerWheel(object):
+    """
+    A hashed timing-wheel: "size" slots , one slot per "tick" seconds. A timer is kept in the slot of its
+    deadline (modulo the wheel) , with the number of full rotations that are left.
+    Adding and cancelling a timer is O(1) , and every tick visits only the timers of one slot , so 100k timers
+    (e.g. a timeout per session) cost one IOLoop timeout instead of 100k.
+    Timers fire up to one tick late. The wheel runs (one IOLoop timeout per tick) only while it has timers.
+    """
+    def __init__(self,tick=0.5,size=512,ioloop=None):
+        """
+        Input Parameters:
+            tick    : (seconds) the wheel's resolution
+            size    : number of slots (a rotation is tick*size seconds , longer timers wait a few rotations)
+        """
+        self.tick=tick
+        self.size=size
+        self._slots=[ set() for i in range(size) ]
+        self._position=0        # The slot of the next tick
+        self._next_tick=None    # When we run the next tick (None: not running)
+        self._count=0
+        self._ioloop=ioloop
+
+    def __len__(self):
+        return self._count
+
+    def add(self,delay,callback):
+        """
+        Call callback() in "delay" seconds. Returns a Timer (see cancel)
+        """
+        ioloop=self._get_ioloop()
+        now=ioloop.time()
+        if self._next_tick is None:
+            self._next_tick=now+self.tick
+            ioloop.add_timeout(self._next_tick,self._on_tick)
+        ticks=max(0,int(math.ceil((now+delay-self._next_tick)/self.tick)))
+        timer=Timer((self._position+ticks)%self.size,ticks//self.size,callback)
+        self._slots[timer.slot].add(timer)
+        self._count+=1
+        return timer
+
+    def cancel(self,timer):
+        """
+        Cancel a timer (that did not fire yet)
+        """
+        slot=self._slots[timer.slot]
+        if timer in slot:
+            slot.discard(timer)
+            self._count-=1
+
+    def _get_ioloop(self):
+        if self._ioloop is None:
+            self._ioloop=tornado.ioloop.IOLoop.current()
+        return self._ioloop
+
+    def _on_tick(self):
+        now=self._ioloop.time()
+        # (catch up if the IOLoop was late)
+        while self._next_tick<=now:
+            slot=self._slots[self._position]
+            self._position=(self._position+1)%self.size
+            self._next_tick+=self.tick
+            expired=[]
+            for timer in slot:
+                if timer.rounds:
+                    timer.rounds-=1
+                else:
+                    expired.append(timer)
+            for timer in expired:
+                slot.discard(timer)
+                self._count-=1
+            for timer in expired:
+                try:
+                    timer.callback()
+                except Exception:
+                    self._ioloop.handle_callback_exception(timer.callback)
+        if self._count:
+            self._ioloop.add_timeout(self._next_tick,self._on_tick)
+        else:
+            self._next_tick=None
+
+
+_wheels=weakref.WeakKeyDictionary()     # IOLoop -> TimerWheel
+
+def get_wheel(ioloop=None):
+    """
+    The shared TimerWheel of an IOLoop (default: the current IOLoop)
+    """
+    if ioloop is None:
+        ioloop=tornado.ioloop.IOLoop.current()
+    wheel=_wheels.get(ioloop)
+    if wheel is None:
+        wheel=_wheels[ioloop]=TimerWheel(ioloop=ioloop)
+    return wheel
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+import ssl
+import collections
+import tornado.iostream
+
+
+class TLSSessionCache(object):
+    """
+    LRU cache of ssl.SSLSession objects, one (the most recent) per target (peer address).
+    Reusing a session lets the next connection to the same target resume with an abbreviated handshake
+    """
+    def __init__(self,max_targets=1024):
+        self.max_targets=max_targets
+        self._sessions=collections.OrderedDict()   # target -> ssl.SSLSession , least-recently-used first
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self,target):
+        session=self._sessions.get(target)
+        if session is not None:
+            self._sessions.move_to_end(target)
+        return session
+
+    def put(self,target,session):
+        self._sessions[target]=session
+        self._sessions.move_to_end(target)
+        while len(self._sessions) > self.max_targets:
+            self._sessions.popitem(last=False)
+
+    def discard(self,target):
+        self._sessions.pop(target,None)
+
+
+class ClientSSLContext(ssl.SSLContext):
+    """
+    SSL context for the Proxy->Server connections.
+    The ProxyServer builds one context at startup and all its sessions (and its connection-pool) share it,
+    instead of building a new context for every connection.
+    When wrapping a (connected) socket, we pass the cached TLS-session of the same target so the
+    connection can be resumed. Once the handshake is done, the caller should call "handshake_done" so we
+    can count the handshakes and cache the (new) session.
+    """
+    # Some statistics
+    full_handshakes=0
+    resumed_handshakes=0
+
+    def wrap_socket(self,sock,server_side=False,do_handshake_on_connect=True,suppress_ragged_eofs=True,
+                    server_hostname=None,session=None):
+        if session is None and not server_side:
+            try:
+                session=self.sessions.get(sock.getpeername())
+            except OSError:
+                pass
+        return super(ClientSSLContext,self).wrap_socket(sock,server_side=server_side,
+                                                         do_handshake_on_connect=do_handshake_on_connect,
+                                                         suppress_ragged_eofs=suppress_ragged_eofs,
+                                                         server_hostname=server_hostname,
+                                                         session=session)
+
+    def handshake_done(self,sslsock,target=None):
+        """
+        Called after the handshake of a socket (or an ssl.SSLObject) that was wrapped by this context.
+        target: the (server,port) of the connection (default: the socket's peer)
+        Returns None if the session was cached, or the socket's target if the session cannot be cached yet
+        (the caller should call store_session(target,sslsock) again later)
+        """
+        if sslsock.session_reused:
+            self.resumed_handshakes+=1
+        else:
+            self.full_handshakes+=1
+        if target is None:
+            target=sslsock.getpeername()
+        if self.store_session(target,sslsock):
+            return None
+        return target
+
+    def store_session(self,target,sslsock):
+        """
+        Cache the socket's session (if it can be resumed).
+        Note: with TLS 1.3 the session-ticket arrives after the handshake, once we read from the socket,
+              so the caller may need to call this function again later
+        Returns True if the session was cached.
+        """
+        try:
+            session=sslsock.session
+        except (ValueError,AttributeError):
+            return False
+        if session is None or not (session.has_ticket or session.id):
+            return False
+        if sslsock.version()=="TLSv1.3" and not session.has_ticket:
+            return False
+        self.sessions.put(target,session)
+        return True
+
+    def get_stats(self):
+        """
+        Handshakes counts and resumption hit-rate
+        """
+        handshakes=self.full_handshakes+self.resumed_handshakes
+        return {
+            "full_handshakes": self.full_handshakes,
+            "resumed_handshakes": self.resumed_handshakes,
+            "resumption_hit_rate": float(self.resumed_handshakes)/handshakes if handshakes else 0.0,
+            "cached_sessions": len(self.sessions),
+        }
+
+
+class ClientSSLIOStream(tornado.iostream.SSLIOStream):
+    """
+    SSLIOStream (for a ClientSSLContext) that caches its TLS-session just before the socket is closed.
+    With TLS 1.3 the session-ticket arrives only after the handshake, so short connections would
+    otherwise never cache their session
+    """
+    def __init__(self,*args,**kwargs):
+        self.ssl_context=kwargs["ssl_options"]
+        super(ClientSSLIOStream,self).__init__(*args,**kwargs)
+
+    def close_fd(self):
+        sslsock=self.socket
+        if isinstance(sslsock,ssl.SSLSocket):   # (not wrapped yet if we're still connecting)
+            try:
+                self.ssl_context.store_session(sslsock.getpeername(),sslsock)
+            except OSError:
+                pass
+        super(ClientSSLIOStream,self).close_fd()
+
+
+def create_client_context(ssl_options,session_cache_size=1024):
+    """
+    Build a ClientSSLContext out of Tornado's SSL options dictionary
+    (same keys and same defaults as tornado.netutil.ssl_options_to_context:
+     ssl_version , certfile , keyfile , cert_reqs , ca_certs , ciphers).
+    An empty dictionary means "SSL with default settings" (no certificate validation)
+    """
+    context=ClientSSLContext(ssl_options.get("ssl_version",ssl.PROTOCOL_TLS_CLIENT))
+    context.sessions=TLSSessionCache(session_cache_size)
+    context.check_hostname=False
+    context.verify_mode=ssl_options.get("cert_reqs",ssl.CERT_NONE)
+    if "certfile" in ssl_options:
+        context.load_cert_chain(ssl_options["certfile"],ssl_options.get("keyfile",None))
+    if "ca_certs" in ssl_options:
+        context.load_verify_locations(ssl_options["ca_certs"])
+    if "ciphers" in ssl_options:
+        context.set_ciphers(ssl_options["ciphers"])
+    if hasattr(ssl,"OP_NO_COMPRESSION"):
+        context.options|=ssl.OP_NO_COMPRESSION
+    return context
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+import ssl
+import errno
+import socket
+import concurrent.futures
+import tornado
+import tornado.iostream
+import tornado.log
+import maproxy.tls
+
+
+# How much plaintext we encrypt per write (ciphertext that the socket didn't accept is kept until it does)
+WRITE_CHUNK=64*1024
+
+# How much ciphertext we read from the socket at once
+RECEIVE_SIZE=64*1024
+
+_WOULDBLOCK=(errno.EWOULDBLOCK,errno.EAGAIN)
+
+
+def create_executor(threads):
+    """
+    The thread-pool of the handshakes (see ProxyServer's tls_offload)
+    """
+    return concurrent.futures.ThreadPoolExecutor(max_workers=threads,thread_name_prefix="maproxy-tls")
+
+
+def is_supported():
+    """
+    OffloadSSLIOStream replaces parts of Tornado 5.x's SSLIOStream (read_from_fd into a buffer , write_to_fd ,
+    the handshake and connect internals)
+    """
+    return (5,0)<=tornado.version_info<(6,0)
+
+
+def prepare_context(context,owned=True):
+    """
+    Let the handshake check the target's name (OffloadSSLIOStream has no separate certificate check): a context
+    that verifies the certificate (verify_mode is not CERT_NONE) gets check_hostname. The name is the
+    server_hostname of the connection , or its IP address.
+    owned: False for an SSLContext that the caller gave us (it may be shared , so we don't change it): it must
+    already have check_hostname if it verifies the certificate
+    """
+    if context.verify_mode!=ssl.CERT_NONE and not context.check_hostname:
+        assert owned , "tls_offload requires check_hostname in an SSLContext that verifies the certificate"
+        context.check_hostname=True
+    return context
+
+
+def get_ssl_object(stream):
+    """
+    The object that holds the TLS state of an SSL stream: the ssl.SSLObject of an OffloadSSLIOStream ,
+    or the stream's ssl.SSLSocket
+    """
+    return getattr(stream,"ssl_object",None) or stream.socket
+
+
+class OffloadSSLIOStream(tornado.iostream.SSLIOStream):
+    """
+    SSLIOStream whose handshake runs on a thread-pool.
+    The socket stays a plain socket, the TLS state is an ssl.SSLObject on a pair of MemoryBIOs. The IOLoop only
+    moves the ciphertext between the socket and the BIOs, and each handshake step (the public-key operations)
+    runs in the pool (the ssl module releases the GIL), so a burst of handshakes doesn't stall the other sessions
+    and it can use more than one core.
+    After the handshake, the records are encrypted and decrypted inline: the symmetric ciphers are cheaper than
+    passing every chunk to a thread and back.
+    """
+    def __init__(self,sock,executor,server_side=False,*args,**kwargs):
+        """
+        Input Parameters:
+            sock        : the (plain) socket
+            executor    : concurrent.futures.Executor that runs the handshake steps
+            server_side : True for an accepted connection (the handshake starts right away),
+                          False for a connection that we make (see connect)
+            ssl_options : the ssl.SSLContext (maproxy.tls.ClientSSLContext resumes the target's cached TLS-session)
+            args,kwargs : will be passed to the SSLIOStream
+        """
+        self.executor=executor
+        self.ssl_object=None
+        self._server_side=server_side
+        self._incoming=ssl.MemoryBIO()
+        self._outgoing=ssl.MemoryBIO()
+        self._received=bytearray()      # Ciphertext that we read while a handshake step was running
+        self._eof=False
+        self._unsent=b""                # Ciphertext that the socket didn't accept yet
+        self._unsent_plaintext=0        # The size of the plaintext (at the head of the write buffer) in _unsent
+        self._step_running=False
+        self._want_read=False           # The last handshake step needs more data from the peer
+        super(OffloadSSLIOStream,self).__init__(sock,*args,**kwargs)
+        if server_side:
+            self._wrap()
+
+    def _wrap(self):
+        context=self._ssl_options
+        session=None
+        server_hostname=self._server_hostname
+        if not self._server_side:
+            if isinstance(context,maproxy.tls.ClientSSLContext):
+                session=context.sessions.get(self.socket.getpeername())
+            if server_hostname is None and context.check_hostname:
+                # (a target that we connect to by its address: the certificate must be for that address)
+                server_hostname=self.socket.getpeername()[0]
+        self.ssl_object=context.wrap_bio(self._incoming,self._outgoing,server_side=self._server_side,
+                                         server_hostname=server_hostname,session=session)
+
+    def _handle_connect(self):
+        # (SSLIOStream's wraps the socket. We keep it plain)
+        tornado.iostream.IOStream._handle_connect(self)
+        if not self.closed():
+            self._wrap()
+
+    def close_fd(self):
+        # Cache the TLS-session before closing (see maproxy.tls.ClientSSLIOStream)
+        context=self._ssl_options
+        if isinstance(context,maproxy.tls.ClientSSLContext) and self.ssl_object is not None and not self._ssl_accepting:
+            try:
+                context.store_session(self.socket.getpeername(),self.ssl_object)
+            except OSError:
+                pass
+        super(OffloadSSLIOStream,self).close_fd()
+
+    ###############
+    ## Handshake ##
+    ###############
+    def _do_ssl_handshake(self):
+        # Called on the socket's events until the handshake is done
+        self._handshake_reading=False
+        self._handshake_writing=False
+        if not self._receive():
+            return
+        if self._step_running:
+            # (we keep reading , so the socket doesn't stay readable. The data goes to the next step)
+            return
+        if not self._send():
+            self._handshake_writing=True
+            return
+        if self._want_read and not self._received:
+            if self._eof:
+                self.close()
+                return
+            self._handshake_reading=True
+            return
+        if self._received:
+            self._incoming.write(bytes(self._received))
+            del self._received[:]
+        if self._eof:
+            self._incoming.write_eof()
+        self._step_running=True
+        self.io_loop.add_future(self.executor.submit(self._handshake_step),self._on_handshake_step)
+
+    def _handshake_step(self):
+        # (in the pool)
+        try:
+            self.ssl_object.do_handshake()
+        except ssl.SSLWantReadError:
+            return False
+        return True
+
+    def _on_handshake_step(self,future):
+        self._step_running=False
+        if self.closed():
+            return
+        try:
+            done=future.result()
+        except (ssl.SSLEOFError,ssl.SSLZeroReturnError) as err:
+            return self.close(exc_info=err)
+        except ssl.SSLError as err:
+            try:
+                peer=self.socket.getpeername()
+            except Exception:
+                peer='(not connected)'
+            tornado.log.gen_log.warning("SSL Error on %s %s: %s",self.socket.fileno(),peer,err)
+            try:
+                # (the alert , so the peer knows why)
+                self._send()
+            except (socket.error,IOError,OSError):
+                pass
+            return self.close(exc_info=err)
+        self._want_read=not done
+        if done:
+            # (the certificate and the target's name were checked by the handshake , see prepare_context)
+            self._ssl_accepting=False
+            self._run_ssl_connect_callback()
+        # Send what the step wrote , and handle what arrived meanwhile (and the reads/writes that were waiting)
+        self._handle_events(self.fileno(),self.io_loop.READ|self.io_loop.WRITE)
+
+    ################
+    ## Ciphertext ##
+    ################
+    def _receive(self):
+        """
+        Read the available ciphertext into _received. Returns False if the stream was closed
+        """
+        while not self._eof and len(self._received)<RECEIVE_SIZE:
+            try:
+                data=self.socket.recv(RECEIVE_SIZE)
+            except (socket.error,IOError,OSError) as err:
+                if err.args[0] in _WOULDBLOCK:
+                    break
+                self.close(exc_info=err)
+                return False
+            if not data:
+                self._eof=True
+                break
+            self._received+=data
+        return True
+
+    def _send(self):
+        """
+        Send the ciphertext of the outgoing BIO (and what's left from before). Returns True if it was all sent
+        """
+        if self._outgoing.pending:
+            self._unsent+=self._outgoing.read()
+        while self._unsent:
+            try:
+                sent=self.socket.send(self._unsent)
+            except (socket.error,IOError,OSError) as err:
+                if err.args[0] in _WOULDBLOCK:
+                    return False
+                raise
+            self._unsent=self._unsent[sent:]
+        return True
+
+    ###############
+    ## Plaintext ##
+    ###############
+    def writing(self):
+        return bool(self._unsent) or super(OffloadSSLIOStream,self).writing()
+
+    def _handle_write(self):
+        if not self._ssl_accepting and self._unsent and not self._unsent_plaintext:
+            # Handshake data (e.g. TLS 1.3 session-tickets) , when there's nothing else to write
+            if not self._send():
+                return
+        super(OffloadSSLIOStream,self)._handle_write()
+
+    def write_to_fd(self,data):
+        # The plaintext is "written" (removed from the write buffer) only once its ciphertext was sent
+        if not self._send():
+            return 0
+        if self._unsent_plaintext:
+            size=self._unsent_plaintext
+            self._unsent_plaintext=0
+            return size
+        size=min(len(data),WRITE_CHUNK)
+        self.ssl_object.write(data[:size])
+        if self._send():
+            return size
+        self._unsent_plaintext=size
+        return 0
+
+    def read_from_fd(self,buf):
+        if self._ssl_accepting:
+            return None
+        while True:
+            try:
+                size=self.ssl_object.read(len(buf),buf)
+                if self._outgoing.pending:
+                    # (e.g. a TLS 1.3 key-update)
+                    self._unsent+=self._outgoing.read()
+                return size
+            except ssl.SSLWantReadError:
+                pass
+            except (ssl.SSLEOFError,ssl.SSLZeroReturnError):
+                return 0
+            # The BIO needs more ciphertext
+            if self._received:
+                self._incoming.write(bytes(self._received))
+                del self._received[:]
+                continue
+            if self._eof:
+                return 0
+            try:
+                data=self.socket.recv(RECEIVE_SIZE)
+            except (socket.error,IOError,OSError) as err:
+                if err.args[0] in _WOULDBLOCK:
+                    return None
+                raise
+            if not data:
+                self._incoming.write_eof()
+                self._eof=True
+                continue
+            self._incoming.write(data)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+import os
+import signal
+import logging
+import ctypes
+import asyncio
+import traceback
+import multiprocessing.sharedctypes
+import tornado.ioloop
+import maproxy.metrics
+
+
+class WorkerPool(object):
+    """
+    Multi-process ("worker") mode for the IOManager.
+    - The parent process forks N workers. Each worker runs its own IOLoop and creates its own
+      SO_REUSEPORT listener for every registered server, so the kernel spreads new connections
+      between the workers (one CPU core each).
+    - The parent does not accept connections. It supervises the workers and restarts any worker that dies.
+    - The parent and the workers share a small array of counters:
+        shared[0]          : stop flag . when set, the workers stop listening (and exit once they are idle)
+        shared[1..workers] : number of connections of each worker , so the parent can sum them up
+      and a second array with the metrics values (see maproxy.metrics) of each server in each worker.
+      When a worker dies its counters are kept (so the totals never go backwards)
+    """
+    # How often (seconds) a worker reports its connections-count (and checks the stop-flag)
+    REPORT_INTERVAL=0.25
+
+    def __init__(self,servers,workers):
+        """
+        Input Parameters:
+            servers : list of ProxyServer objects (already listening in this process)
+            workers : number of worker processes. 0/None means one worker per CPU core
+        """
+        if not workers or workers<=0:
+            workers=multiprocessing.cpu_count()
+        self.workers=workers
+        self.servers=servers
+        self._addresses=[]      # For each server (same order) : list of (address,port) to listen on
+        self._pids={}           # pid -> worker-index
+        self._stopping=False
+        self._shared=multiprocessing.sharedctypes.RawArray(ctypes.c_long,workers+1)
+        self._metrics=multiprocessing.sharedctypes.RawArray(ctypes.c_double,workers*len(servers)*maproxy.metrics.VALUES_COUNT)
+        self._retired=[ [0]*maproxy.metrics.VALUES_COUNT for server in servers ]   # counters of dead workers
+
+    def start(self):
+        """
+        Start the workers. Must be called from the parent, before its IOLoop is started.
+        """
+        # Remember where each server listens, and close the parent's listeners.
+        # The parent's sockets are not SO_REUSEPORT so the workers cannot bind as long as they're open
+        for server in self.servers:
+            self._addresses.append(server.get_listen_addresses())
+            server.stop()
+
+        for index in range(self.workers):
+            self._spawn(index)
+
+    def get_connections_count(self):
+        return sum(self._shared[1:])
+
+    def get_workers_count(self):
+        """
+        Number of running workers (that were not reaped yet , see supervise)
+        """
+        return len(self._pids)
+
+    def get_metrics_values(self):
+        """
+        For each server (same order as "servers"): the metrics values summed over all the workers
+        """
+        result=[]
+        for server_index,retired in enumerate(self._retired):
+            total=list(retired)
+            for index in range(self.workers):
+                maproxy.metrics.add_values(total,self._metrics[self._metrics_slice(index,server_index)])
+            result.append(total)
+        return result
+
+    def _metrics_slice(self,index,server_index):
+        start=(index*len(self.servers)+server_index)*maproxy.metrics.VALUES_COUNT
+        return slice(start,start+maproxy.metrics.VALUES_COUNT)
+
+    def _retire_metrics(self,index):
+        # Keep the counters of a dead worker (the gauges - sessions and queues - are gone with it)
+        for server_index,retired in enumerate(self._retired):
+            area=self._metrics_slice(index,server_index)
+            values=self._metrics[area]
+            values[:maproxy.metrics.GAUGES_COUNT]=[0]*maproxy.metrics.GAUGES_COUNT
+            maproxy.metrics.add_values(retired,values)
+            self._metrics[area]=[0.0]*maproxy.metrics.VALUES_COUNT
+
+    def supervise(self):
+        """
+        Reap dead workers and restart them (unless we're stopping).
+        The parent calls this function periodically from its IOLoop
+        """
+        # (only our own workers: other children of the process belong to someone else)
+        for pid in list(self._pids):
+            try:
+                pid,status=os.waitpid(pid,os.WNOHANG)
+            except ChildProcessError:
+                status=-1
+            if pid==0:
+                continue
+            index=self._pids.pop(pid)
+            self._shared[index+1]=0
+            self._retire_metrics(index)
+            if not self._stopping:
+                logging.warning("maproxy: worker #%d (pid %d) died (status %d), restarting",index,pid,status)
+                self._spawn(index)
+
+    def stop_listening(self):
+        """
+        Ask all the workers to stop listening. Each worker exits once it has no more connections
+        """
+        self._stopping=True
+        self._shared[0]=1
+
+    def terminate(self):
+        """
+        Kill all the (remaining) workers and wait for them
+        """
+        self._stopping=True
+        for pid in list(self._pids):
+            try:
+                os.kill(pid,signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in list(self._pids):
+            try:
+                os.waitpid(pid,0)
+            except ChildProcessError:
+                pass
+            index=self._pids.pop(pid)
+            self._shared[index+1]=0
+            self._retire_metrics(index)
+
+    def _spawn(self,index):
+        pid=os.fork()
+        if pid:
+            # Parent
+            self._pids[pid]=index
+            return
+        # Child - never returns
+        exit_code=0
+        try:
+            self._run_worker(index)
+        except Exception:
+            traceback.print_exc()
+            exit_code=1
+        finally:
+            os._exit(exit_code)
+
+    def _run_worker(self,index):
+        # The parent handles Ctrl-C (SIGINT is sent to the entire process-group) and kills us with SIGTERM
+        signal.signal(signal.SIGINT,signal.SIG_IGN)
+        signal.signal(signal.SIGTERM,signal.SIG_DFL)
+        signal.signal(signal.SIGCHLD,signal.SIG_DFL)
+
+        # We might have been forked from within the parent's (running) IOLoop ,
+        # so detach from it and create our own IOLoop (asyncio ignores a running loop of another pid)
+        asyncio.set_event_loop(None)
+        tornado.ioloop.IOLoop.clear_instance()
+        ioloop=tornado.ioloop.IOLoop()
+        ioloop.make_current()
+
+        for server,addresses in zip(self.servers,self._addresses):
+            server.listen_reuse_port(addresses)
+
+        stopped=[False]
+        def report():
+            count=0
+            for server_index,server in enumerate(self.servers):
+                count+=server.get_connections_count()
+                self._metrics[self._metrics_slice(index,server_index)]=server.get_metrics_values()
+            self._shared[index+1]=count
+            if self._shared[0] and not stopped[0]:
+                stopped[0]=True
+                for server in self.servers:
+                    server.stop()
+                    # Exit as soon as the last session ends (the parent gets SIGCHLD)
+                    server.set_drained_callback(drained)
+            if stopped[0] and count==0:
+                ioloop.stop()
+                return
+            ioloop.add_timeout(ioloop.time()+WorkerPool.REPORT_INTERVAL,report)
+
+        def drained():
+            if not any( server.get_connections_count() for server in self.servers ):
+                self._shared[index+1]=0
+                ioloop.stop()
+
+        ioloop.add_callback(report)
+        ioloop.start()
@@ -2,10 +2,15 @@
 SSL_MQTT_SERVER_IP = "127.0.0.1"
 SSL_MQTT_SERVER_PORT = 8883
 
+# The broker's keepalive (seconds). The proxy answers the devices' PINGREQs itself and pings the broker
+# only when the TLS link is idle for most of this time (None: use each device's own keepalive)
+UPSTREAM_KEEPALIVE = 600
+
 
 import tornado.ioloop
 from maproxy.proxyserver import ProxyServer
-# HTTP->HTTPS
+from maproxy.mqtt import MQTTSessionFactory
+# MQTT->MQTT over TLS
 # "server_ssl_options=True" simply means "connect to server with SSL"
 
 #sl_certs={     "certfile":  "./certificate.pem",
@@ -15,7 +20,10 @@ from maproxy.proxyserver import ProxyServer
 #                                         client_ssl_options=ssl_certs)
 
 
-server = ProxyServer(SSL_MQTT_SERVER_IP,SSL_MQTT_SERVER_PORT, server_ssl_options=True)
+# MQTTSessionFactory: MQTT-aware sessions (local PINGRESP , whole frames upstream , per-client-id counters,
+# see factory.get_client_stats() and factory.get_stats())
+factory = MQTTSessionFactory(upstream_keepalive=UPSTREAM_KEEPALIVE)
+server = ProxyServer(SSL_MQTT_SERVER_IP,SSL_MQTT_SERVER_PORT, server_ssl_options=True, session_factory=factory)
 server.listen(1883,address='0.0.0.0')
-print("http://0.0.0.0:1883")
+print("mqtt://0.0.0.0:1883 -> mqtts://%s:%d" % (SSL_MQTT_SERVER_IP,SSL_MQTT_SERVER_PORT))
 tornado.ioloop.IOLoop.instance().start();
@@ -0,0 +1,52 @@
+import socket
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
+import tornado.netutil
+import maproxy.proxyserver
+
+
+def connect_timeout_counters(engine):
+    """
+    One session whose connect times out: (connect_failures , connect_timeouts , the backend's connect_failures)
+    """
+    # A listener whose accept queue is full: its SYNs are dropped , so the connect hangs
+    target=socket.socket()
+    target.bind(("127.0.0.1",0))
+    target.listen(0)
+    port=target.getsockname()[1]
+    fillers=[]
+    for _ in range(3):
+        filler=socket.socket()
+        filler.setblocking(False)
+        try:
+            filler.connect(("127.0.0.1",port))
+        except BlockingIOError:
+            pass
+        fillers.append(filler)
+
+    async def run():
+        await tornado.gen.sleep(0.2)
+        server=maproxy.proxyserver.ProxyServer("127.0.0.1",port,engine=engine,connect_timeout=0.5)
+        listener=tornado.netutil.bind_sockets(0,"127.0.0.1")[0]
+        server.add_socket(listener)
+        client=tornado.iostream.IOStream(socket.socket())
+        await client.connect(listener.getsockname()[:2])
+        await tornado.gen.sleep(2.5)
+        client.close()
+        server.stop()
+        assert not server.sessions
+        return server.metrics.connect_failures,server.metrics.connect_timeouts,server.backends[0].connect_failures
+
+    try:
+        return tornado.ioloop.IOLoop.current().run_sync(run)
+    finally:
+        for filler in fillers:
+            filler.close()
+        target.close()
+
+
+def test_connect_timeout_counted_once():
+    # (the asyncio relay used to count the cancelled connect again)
+    assert connect_timeout_counters("stream")==(1,1,1)
+    assert connect_timeout_counters("asyncio")==(1,1,1)
@@ -0,0 +1,80 @@
+import io
+import struct
+import maproxy.capture
+
+
+def read_packets(f):
+    """
+    The Enhanced Packet Blocks of a pcap-ng file: list of (packet , original length)
+    """
+    data=f.getvalue()
+    offset=0
+    packets=[]
+    while offset<len(data):
+        block_type,block_size=struct.unpack_from("<II",data,offset)
+        if block_type==6:
+            captured,original=struct.unpack_from("<II",data,offset+20)
+            packets.append((data[offset+28:offset+28+captured],original))
+        offset+=block_size
+    return packets
+
+
+def write_chunk(data,original_size,client="10.0.0.1:5000",server="10.0.0.2:80"):
+    writer=maproxy.capture.PcapngWriter()
+    f=io.BytesIO()
+    writer.start(f)
+    writer.write(f,maproxy.capture.OPEN,1,0.0,(client+" "+server).encode("ascii"),0)
+    writer.write(f,maproxy.capture.C2S,1,0.0,data,original_size)
+    # (the 3 packets of the handshake)
+    return read_packets(f)[3:]
+
+
+def check_segments(packets,original_size,ip_length):
+    """
+    The segments are in sequence , cover the entire chunk , and their IP lengths are valid
+    """
+    total=0
+    sequence=None
+    for packet,original in packets:
+        ip_header=20 if packet[0]>>4==4 else 40
+        assert ip_length(packet)==original<=65535
+        tcp_sequence=struct.unpack_from("!I",packet,ip_header+4)[0]
+        if sequence is not None:
+            assert tcp_sequence==sequence
+        sequence=tcp_sequence+original-ip_header-20
+        total+=original-ip_header-20
+    assert total==original_size
+
+
+def ipv4_length(packet):
+    return struct.unpack_from("!H",packet,2)[0]
+
+
+def ipv6_length(packet):
+    return struct.unpack_from("!H",packet,4)[0]+40
+
+
+def test_truncated_64k_chunk():
+    # snaplen cut a 64 KB read to 100 bytes
+    packets=write_chunk(b"x"*100,64*1024)
+    assert len(packets)==2
+    check_segments(packets,64*1024,ipv4_length)
+    assert packets[0][0].endswith(b"x"*100)
+
+
+def test_truncated_64k_chunk_ipv6():
+    packets=write_chunk(b"x"*100,64*1024,client="[::1]:5000",server="[::1]:80")
+    check_segments(packets,64*1024,ipv6_length)
+
+
+def test_large_chunk():
+    packets=write_chunk(b"y"*200000,200000)
+    assert len(packets)==4
+    check_segments(packets,200000,ipv4_length)
+    assert all( original==len(packet) for packet,original in packets )
+
+
+def test_empty_chunk():
+    packets=write_chunk(b"",0)
+    assert len(packets)==1
+    check_segments(packets,0,ipv4_length)
@@ -0,0 +1,117 @@
+import socket
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
+import tornado.netutil
+import tornado.tcpserver
+import maproxy.httpsession
+import maproxy.proxyserver
+
+
+class BufferStream(object):
+    """
+    The reads of a _Framer over a buffer (the callback is called at once)
+    """
+    read_chunk_size=4
+
+    def __init__(self,data):
+        self.data=data
+
+    def read_until(self,delimiter,callback,max_bytes=None):
+        end=self.data.index(delimiter)+len(delimiter)
+        self._complete(end,callback)
+
+    def read_bytes(self,size,callback,partial=False):
+        self._complete(min(size,len(self.data)),callback)
+
+    def _complete(self,end,callback):
+        data,self.data=self.data[:end],self.data[end:]
+        callback(data)
+
+
+def read_message(stream):
+    """
+    Read one message through a _Framer. Returns the message (the stream keeps what follows it)
+    """
+    framer=maproxy.httpsession._Framer()
+    parts=[]
+    def on_read(data):
+        parts.append(data)
+        if framer.state==maproxy.httpsession.HEAD:
+            start_line,headers=maproxy.httpsession.parse_head(data)
+            chunked=maproxy.httpsession.get_tokens(headers,b"transfer-encoding")==[b"chunked"]
+            framer.start_body(chunked,maproxy.httpsession.get_content_length(headers) or 0)
+        else:
+            framer.body_read(data)
+    while framer.state!=maproxy.httpsession.DONE:
+        framer.start_read(stream,on_read,64*1024)
+    return b"".join(parts)
+
+
+def test_content_length_messages_on_one_connection():
+    first=b"POST /a HTTP/1.1\r\nContent-Length: 10\r\n\r\n0123456789"
+    second=b"GET /b HTTP/1.1\r\nHost: x\r\n\r\n"
+    stream=BufferStream(first+second)
+    assert read_message(stream)==first
+    assert read_message(stream)==second
+    assert stream.data==b""
+
+
+def test_chunked_message_stops_at_its_end():
+    message=(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+             b"5;ext=1\r\nhello\r\n10\r\n0123456789abcdef\r\n0\r\nTrailer: 1\r\n\r\n")
+    stream=BufferStream(message+b"HTTP/1.1 204 No Content\r\n\r\n")
+    assert read_message(stream)==message
+    assert stream.data==b"HTTP/1.1 204 No Content\r\n\r\n"
+
+
+def test_invalid_chunk_size():
+    stream=BufferStream(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\n")
+    try:
+        read_message(stream)
+    except maproxy.httpsession.HTTPError:
+        pass
+    else:
+        assert False , "HTTPError expected"
+
+
+class ChunkedServer(tornado.tcpserver.TCPServer):
+    """
+    Responds to every request with a chunked body , and counts its connections
+    """
+    connections=0
+
+    async def handle_stream(self,stream,address):
+        ChunkedServer.connections+=1
+        try:
+            while True:
+                await stream.read_until(b"\r\n\r\n")
+                await stream.write(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                                   b"3\r\nabc\r\n2\r\nde\r\n0\r\n\r\n")
+        except tornado.iostream.StreamClosedError:
+            pass
+
+
+def test_keepalive_reuses_the_server_connection():
+    response=b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n3\r\nabc\r\n2\r\nde\r\n0\r\n\r\n"
+
+    async def run():
+        backend=ChunkedServer()
+        backend_socket=tornado.netutil.bind_sockets(0,"127.0.0.1")[0]
+        backend.add_socket(backend_socket)
+        factory=maproxy.httpsession.HTTPSessionFactory()
+        server=maproxy.proxyserver.ProxyServer("127.0.0.1",backend_socket.getsockname()[1],session_factory=factory)
+        listener=tornado.netutil.bind_sockets(0,"127.0.0.1")[0]
+        server.add_socket(listener)
+        client=tornado.iostream.IOStream(socket.socket())
+        await client.connect(listener.getsockname()[:2])
+        for i in range(3):
+            await client.write(b"GET /%d HTTP/1.1\r\nHost: x\r\n\r\n" % i)
+            assert await client.read_bytes(len(response))==response
+        client.close()
+        server.stop()
+        backend.stop()
+        return factory.requests
+
+    assert tornado.ioloop.IOLoop.current().run_sync(run,timeout=10)==3
+    assert ChunkedServer.connections==1
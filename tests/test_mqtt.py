@@ -0,0 +1,103 @@
+import types
+import maproxy.mqtt
+
+
+class RecordingSession(maproxy.mqtt.MQTTSession):
+    """
+    An MQTTSession without streams: the writes are recorded , the reads are started by the test
+    """
+    def c2p_start_write(self,data):
+        self.to_client+=data
+
+    def p2s_start_write(self,data):
+        self.to_server+=data
+
+    def c2p_start_read(self):
+        pass
+
+    def p2s_start_read(self):
+        pass
+
+    def close(self,gracefully=False):
+        self.closed=True
+
+
+def create_session(max_frame_size=1024*1024):
+    proxy=types.SimpleNamespace(session_factory=maproxy.mqtt.MQTTSessionFactory(max_frame_size=max_frame_size),
+                                metrics=types.SimpleNamespace(bytes_c2s=0,bytes_s2c=0),shaper=None)
+    session=RecordingSession.__new__(RecordingSession)
+    session.proxy=proxy
+    session.bytes_c2s=session.bytes_s2c=0
+    session.c2p_read_paused=session.p2s_read_paused=False
+    session.c2p_shaped=session.p2s_shaped=False
+    session.mqtt_buffer=None
+    session.mqtt_s2c_skip=0
+    session.mqtt_s2c_header=None
+    session.mqtt_client_id=None
+    session.mqtt_pings_pending=0
+    session.mqtt_pingresps_pending=0
+    session.mqtt_stats=None
+    session.to_client=bytearray()
+    session.to_server=bytearray()
+    session.closed=False
+    return session
+
+
+def from_client(session,data):
+    session.c2p_reading=True
+    session.on_c2p_done_read(bytearray(data))
+
+
+def from_broker(session,data):
+    session.p2s_reading=True
+    session.on_p2s_done_read(bytearray(data))
+
+
+def publish(payload):
+    return bytes([maproxy.mqtt.PUBLISH<<4,len(payload)])+payload
+
+
+def test_split_frame_forwarded_whole():
+    session=create_session()
+    frame=publish(b"x"*100)
+    from_client(session,frame[:1])
+    from_client(session,frame[1:60])
+    assert session.to_server==b""
+    from_client(session,frame[60:])
+    assert session.to_server==frame
+
+
+def test_coalesced_frames_and_local_pingresp():
+    session=create_session()
+    frames=publish(b"a"*10)+maproxy.mqtt.PINGREQ_FRAME+publish(b"b"*20)
+    from_client(session,frames+publish(b"c"*5)[:3])
+    assert session.to_server==publish(b"a"*10)+publish(b"b"*20)
+    assert session.to_client==maproxy.mqtt.PINGRESP_FRAME
+    assert session.proxy.session_factory.pings_answered==1
+    assert session.bytes_c2s==len(frames)+3
+
+
+def test_oversized_frame_closes_session():
+    session=create_session(max_frame_size=64)
+    from_client(session,publish(b"x"*100))
+    assert session.closed
+    assert session.to_server==b""
+    assert session.proxy.session_factory.protocol_errors==1
+
+
+def test_pingresp_waits_for_broker_frame_boundary():
+    session=create_session()
+    frame=publish(b"y"*98)
+    from_broker(session,frame[:54])
+    from_client(session,maproxy.mqtt.PINGREQ_FRAME)
+    assert session.to_client==frame[:54]
+    from_broker(session,frame[54:]+publish(b"z")[:1])
+    assert session.to_client==frame+maproxy.mqtt.PINGRESP_FRAME
+
+
+def test_our_pingresp_is_cut_out():
+    session=create_session()
+    session.mqtt_pings_pending=1
+    from_broker(session,publish(b"a")+maproxy.mqtt.PINGRESP_FRAME+publish(b"b"))
+    assert session.to_client==publish(b"a")+publish(b"b")
+    assert session.mqtt_pings_pending==0